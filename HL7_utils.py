@@ -1,9 +1,13 @@
-from datetime import date, timedelta, datetime
-import phonenumbers
-import us
+import os
+from datetime import datetime
+from functools import lru_cache
 import re
+from lazy_utils import lazyImport
 from dateutil.relativedelta import relativedelta
 
+phonenumbers = lazyImport("phonenumbers")
+us = lazyImport("us")
+
 VACCINE_TYPE_MODERNA = "Moderna"
 VACCINE_TYPE_PFIZER = "Pfizer"
 VACCINE_TYPE_OXFORD = "Astra"
@@ -67,6 +71,26 @@ ADMINISTER_PROCESS = {
     "TL": "Translingual",
 }
 
+# bound on each memoized lookup below; the inputs repeat heavily, a few states, sites
+# and routes and many duplicate phone numbers, so a modest size covers a whole file
+LOOKUP_CACHE_SIZE = int(os.environ.get("LOOKUP_CACHE_SIZE", 4096))
+
+
+# maps every substring of every value (lower case) to the first key, in dictionary
+# order, whose value contains it: the same answer searchDictonary gives, in one lookup
+def buildSubstringIndex(a_dictionary):
+    index = {}
+    for key, value in a_dictionary.items():
+        lowered = value.lower()
+        for start in range(len(lowered) + 1):
+            for end in range(start, len(lowered) + 1):
+                index.setdefault(lowered[start:end], key)
+    return index
+
+
+BODY_SITE_INDEX = buildSubstringIndex(BODY_SITE_DICT)
+ADMINISTER_PROCESS_INDEX = buildSubstringIndex(ADMINISTER_PROCESS)
+
 
 # substitutes a caret if the string is blank from the input stream
 def hl7StringRead(some_string):
@@ -82,12 +106,17 @@ def hl7StringRead(some_string):
         return ""
 
 
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def lookupState(raw_value):
+    return us.states.lookup(raw_value)
+
+
 # looks up the state abbreviation code from the name
 def findStateAbbreviation(state_name):
     raw_value = hl7StringRead(state_name)
 
     if len(raw_value) > 2:
-        state = us.states.lookup(raw_value)
+        state = lookupState(raw_value)
         return state.abbr
 
     return ""
@@ -101,11 +130,28 @@ def searchDictonary(a_dictionary, some_value):
             return key
 
 
+# the (code, description) for a raw string, ("", "") when no entry contains it
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def lookupAdministration(raw_string):
+    key = ADMINISTER_PROCESS_INDEX.get(raw_string.lower())
+    if key is None:
+        return "", ""
+    return key, ADMINISTER_PROCESS[key]
+
+
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def lookupBodySite(raw_string):
+    key = BODY_SITE_INDEX.get(raw_string.lower())
+    if key is None:
+        return "", ""
+    return key, BODY_SITE_DICT[key]
+
+
 def getAdministration(administration_string):
     try:
         raw_string = hl7StringRead(administration_string)
-        key = searchDictonary(ADMINISTER_PROCESS, raw_string)
-        administration_dict = {"code": key, "description": ADMINISTER_PROCESS[key]}
+        code, description = lookupAdministration(raw_string)
+        administration_dict = {"code": code, "description": description}
         return administration_dict
     except Exception:
         return {"code": "", "description": ""}
@@ -114,17 +160,18 @@ def getAdministration(administration_string):
 def getBodySite(site_string):
     try:
         raw_string = hl7StringRead(site_string)
-        key = searchDictonary(BODY_SITE_DICT, raw_string)
-        site_dict = {"code": key, "description": BODY_SITE_DICT[key]}
+        code, description = lookupBodySite(raw_string)
+        site_dict = {"code": code, "description": description}
         return site_dict
     except Exception:
         return {"code": "", "description": ""}
 
 
-def convertStringDateToHL7(inputDate):
+# century_cutoff is the run's RunContext.century_cutoff, computed here when not given
+def convertStringDateToHL7(inputDate, century_cutoff=None):
     try:
         if isinstance(inputDate, str):
-            future = datetime.today() + relativedelta(years=1)
+            future = century_cutoff or datetime.today() + relativedelta(years=1)
             timestamp = datetime.strptime(inputDate, "%m/%d/%y")
             if future <= timestamp:  # must be in the past
                 timestamp = timestamp.replace(year=timestamp.year - 100)
@@ -136,10 +183,11 @@ def convertStringDateToHL7(inputDate):
         return ""
 
 
-def convertStringDateTimeToHL7(inputDate):
+# century_cutoff is the run's RunContext.century_cutoff, computed here when not given
+def convertStringDateTimeToHL7(inputDate, century_cutoff=None):
     try:
         if isinstance(inputDate, str):
-            future = datetime.today() + relativedelta(years=1)
+            future = century_cutoff or datetime.today() + relativedelta(years=1)
             timestamp = datetime.strptime(inputDate, "%m/%d/%y %H:%M")
             if future <= timestamp:  # must be in the past
                 timestamp = timestamp.replace(year=timestamp.year - 100)
@@ -151,19 +199,24 @@ def convertStringDateTimeToHL7(inputDate):
         return ""
 
 
-def convertPhoneNumberToHL7(inputPhoneNumber):
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def formatPhoneNumber(inputPhoneNumber):
     try:
-        if isinstance(inputPhoneNumber, str):
-            phone_number = phonenumbers.parse(inputPhoneNumber, "US")
-            digits = str(phone_number.national_number)
-            formatted = digits[:3] + "^" + digits[-7:]
-            return formatted
-        else:
-            return ""
+        phone_number = phonenumbers.parse(inputPhoneNumber, "US")
+        digits = str(phone_number.national_number)
+        formatted = digits[:3] + "^" + digits[-7:]
+        return formatted
     except Exception:
         return ""
 
 
+def convertPhoneNumberToHL7(inputPhoneNumber):
+    if isinstance(inputPhoneNumber, str):
+        return formatPhoneNumber(inputPhoneNumber)
+    else:
+        return ""
+
+
 def convertPatientGender(gender_string):
     raw_string = hl7StringRead(gender_string)
     if raw_string.lower().startswith("m"):
@@ -217,3 +270,23 @@ def findVaccineLot(lot_string):
     segments = re.split(r"[\s-]+", raw_string)
 
     return segments[-1]
+
+
+MEMOIZED_LOOKUPS = {
+    "state": lookupState,
+    "phone": formatPhoneNumber,
+    "body_site": lookupBodySite,
+    "route": lookupAdministration,
+}
+
+
+# hits, misses and size of every memoized lookup, e.g. for the end-of-run log line
+def lookupCacheStats():
+    return {
+        name: lookup.cache_info()._asdict() for name, lookup in MEMOIZED_LOOKUPS.items()
+    }
+
+
+def clearLookupCaches():
+    for lookup in MEMOIZED_LOOKUPS.values():
+        lookup.cache_clear()
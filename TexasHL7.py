@@ -1,23 +1,71 @@
-import random
-import pandas as pd
 import os
-import boto3
-import botocore
 from segment_utils import *
 from datetime import date, datetime
-from io import StringIO
-from botocore.exceptions import ClientError
 from urllib.parse import unquote_plus
 from aws_lambda_powertools import Logger
-import json
 import time
-import paramiko
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sftp_utils import SFTPConnectionManager, isAuthenticationError
+from sink_utils import S3Sink, S3BundleSink, SFTPSink
+from archive_utils import archiveMode
+from delivery_utils import (
+    DeliveryController,
+    ControlledSink,
+    DeliveryManifest,
+    deliveryManifestEnabled,
+)
+from sequence_utils import SequenceCounter, controlNumber
+from retry_utils import RetryQueue, RETRY_EVENT_KEY
+from credential_utils import CachedCredentialProvider
+from batch_utils import HL7BatchWriter, batchModeEnabled
+from log_utils import BufferedLogWriter, ThreadLogKeys
+from dedup_utils import loadDedupIndex
+from ledger_utils import writeLedgerPart
+from checkpoint_utils import Checkpointer, CHECKPOINT_EVENT_KEY
+from pipeline_utils import StagedPipeline, HL7Delivery, FileSequence, pipelineSettings
+from parallel_utils import generateMessages, generationWorkers
+from normalize_utils import normalizeFrame
+from lazy_utils import lazyImport
+from aws_utils import awsClient
+from csv_utils import readCsvChunks, useFastPath, EmptyCsvError
+from metrics_utils import (
+    startMetrics,
+    publishMetrics,
+    timed,
+    timedIteration,
+    observe,
+    count,
+)
+from shard_utils import (
+    SHARD_EVENT_KEY,
+    FINISH_EVENT_KEY,
+    coordinate,
+    shouldShard,
+    shardMinBytes,
+    loadManifest,
+    openShard,
+    shardPartKind,
+    shardEvent,
+    markShardDone,
+    allShardsDone,
+    finishExport,
+)
+
+pd = lazyImport("pandas")
 
 
 logger = Logger(service="texasHL7sftp")
 logger.append_keys(doh="")
 logger.append_keys(patientid="")
 logger.append_keys(vaccinedate="")
+# the row being processed, per file thread, see ThreadLogKeys
+row_log_keys = ThreadLogKeys()
+logger.registered_handler.addFilter(row_log_keys)
+
+DEFAULT_CHUNK_ROWS = 1000
+TIME_BUDGET_SECONDS = 840
+DEFAULT_FILE_WORKERS = 4
 
 
 def datestdtojd(stddate):
@@ -38,301 +86,685 @@ def year():
     return year
 
 
+# SFTP credentials from Secrets Manager, cached across rows and warm invocations
+credential_provider = CachedCredentialProvider()
+
+
 def get_credentials():
-    secret_name = os.environ["SECRET_NAME"]
-    region_name = os.environ["AWS_REGION"]
+    return credential_provider.get()
 
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
-    get_secret_value_response = client.get_secret_value(SecretId=secret_name)
 
-    try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as ex:
-        if ex.response["Error"]["Code"] == "ResourceNotFoundException":
-            logger.info("The requested secret was not found")
-        elif ex.response["Error"]["Code"] == "InvalidRequestException":
-            logger.info("The request was invalid due to:", ex)
-        elif ex.response["Error"]["Code"] == "InvalidParameterException":
-            logger.info("The request had invalid params:", ex)
-    else:
-        # Secrets Manager decrypts the secret value using the associated KMS CMK
-        # Depending on whether the secret was a string or binary, only one of these fields will be populated
-        if "SecretString" in get_secret_value_response:
-            text_secret_data = get_secret_value_response["SecretString"]
-        # else:
-        #     binary_secret_data = get_secret_value_response["SecretBinary"]
+# one SFTP session shared by every message in the invocation, see sftp_utils
+sftp_connection = SFTPConnectionManager(credential_provider)
 
-    credentials = json.loads(text_secret_data)
-    username = credentials["username"]
-    password = credentials["password"]
 
-    return username, password
+# error and status entries, buffered and written as part objects under vaccine-logs/
+error_log = BufferedLogWriter()
 
 
 # logs the HL7 message to a log file in the S3 bucket
 def log_to_bucket(logType, status):
-    s3 = boto3.resource("s3")
-    today = datetime.today().strftime("%Y-%m-%d")
-    fileName = "vaccine-logs/" + logType + "/" + today + ".json"
-    obj = s3.Object(os.environ["BUCKET_NAME"], fileName)
     if logType == "Errors":
         logger.info("HL7 message error. Error: " + status)
-    hl7List = [status]
-    try:
-        currentLog = json.load(obj.get()["Body"])
-    except:
-        logger.info("Creating new JSON for this date: " + str(today))
-        currentLog = []
+    error_log.write(logType, status)
 
-    currentLog = currentLog + hl7List
-    jsonStr = json.dumps(currentLog)
-    obj.put(Body=jsonStr)
-    return
 
+def hl7FileName(index):
+    return f"NOMIHEALTV{str(year())}{str(datestdtojd(date.today().strftime('%Y-%m-%d')))}.{str(index)}.hl7"
 
-def writeHL7DocumentToFile(
-    hl7_string, upload_bucket, patient_id, vaccination_date, error_dict, index
-):
-    try:
-        logger.info("Writing HL7 Document to file...")
-        logger.info(
-            "Using patient_id {} and bucket {}".format(patient_id, upload_bucket)
-        )
-        today = datetime.today().strftime("%Y-%m-%d")
-        document_string = "".join(hl7_string)
-        hl7_file_name = f"NOMIHEALTV{str(year())}{str(datestdtojd(date.today().strftime('%Y-%m-%d')))}.{str(index)}.hl7"
 
-        s3 = boto3.client("s3")
+_results_lock = threading.Lock()
 
-        s3.put_object(
-            Bucket=upload_bucket,
-            Key="texas-hl7-messages/" + hl7_file_name,
-            Body=bytes(document_string, encoding="utf-8"),
-        )
 
-        logger.info("Write to HL7 successful")
-        submit_hl7(
-            document_string,
-            hl7_file_name,
-            patient_id,
-            vaccination_date,
-            error_dict,
-            hl7_string,
-        )
-    except Exception as ex:
-        error_str = f"Unable to submit HL7 to sftp with PatientID {patient_id} and vaccination date {vaccination_date}. {ex}"
-        logger.error(error_str)
-        log_to_bucket("Errors", error_str)
+# appends one row outcome to error_dict; rows are recorded from the pipeline threads, so
+# all four columns are appended together under a lock to keep them aligned
+def recordResult(error_dict, patient_id, vaccination_date, hl7_message, error=""):
+    with _results_lock:
+        error_dict["Patient ID"].append(patient_id)
+        error_dict["Vaccine Date"].append(vaccination_date)
+        error_dict["HL7 Message"].append(hl7_message)
+        error_dict["Error"].append(error)
 
 
-def submit_hl7(
-    document_string, hl7_file_name, patient_id, vaccination_date, error_dict, hl7_string
-):
-    username, password = get_credentials()
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname="immtrac-ftps1.dshs.state.tx.us",
-        port=22,
-        username=username,
-        password=password,
-        look_for_keys=False,
+# records every message of a delivery once it has gone through the pipeline: sent
+# messages go to the error_dict of the file they came from, failed ones to the error
+# log. Parked messages are recorded with the reason, so they are deduplicated and in
+# the ledger while the retry queue sees them delivered
+def recordDelivery(delivery):
+    if delivery.error is not None:
+        count("deliveries.failed")
+        count(f"deliveries.failed.{delivery.failed_stage}")
+    elif delivery.parked is None:
+        count("deliveries.sent")
+        count("messages.delivered", len(delivery.records))
+    for patient_id, vaccination_date, hl7_string in delivery.records:
+        if delivery.error is not None:
+            error_str = f"Unable to submit HL7 {delivery.label} to {delivery.failed_stage} with PatientID {patient_id} and vaccination date {vaccination_date}. {delivery.error}"
+            logger.error(error_str)
+            log_to_bucket("Errors", error_str)
+        elif delivery.parked is not None:
+            recordResult(
+                delivery.results,
+                patient_id,
+                vaccination_date,
+                hl7_string,
+                f"Queued for retry. {delivery.parked}",
+            )
+        else:
+            logger.info(
+                "Patient ID: "
+                + str(patient_id)
+                + " Vaccination Date: "
+                + str(vaccination_date)
+            )
+            recordResult(delivery.results, patient_id, vaccination_date, hl7_string)
+
+
+# generate -> deliver to each sink in turn -> record result. Generation runs on the
+# thread processing each input file, which assigns file indices in row order; every
+# sink is a stage with its own worker threads behind a bounded queue shared by every
+# file of the event. A delivery that fails at one sink skips the sinks after it
+def startDeliveryPipeline(sinks):
+    pipeline = StagedPipeline(pipelineSettings()["queue_size"])
+    for sink in sinks:
+        pipeline.addStage(sink.name, sink, sink.workers, batch=sink.batch)
+    pipeline.addStage(
+        "record",
+        recordDelivery,
+        handles_failures=True,
     )
-    sftp = ssh.open_sftp()
-    logger.info("Connection established.")
+    return pipeline.start()
 
-    sftp.putfo(StringIO(document_string), "/users/NOMIHEALTV/hl7-dropoff/" + hl7_file_name)
-    logger.info("HL7 file transferred.")
-    
-    ssh.close()
-    logger.info("Connection closed.")
 
-    logger.info("Patient ID: " + patient_id + " Vaccination Date: " + vaccination_date)
+# where the Lambda delivers: archived to S3, in bundles written by one thread before the
+# files they hold are uploaded, or one object per file on PIPELINE_S3_WORKERS threads
+# with HL7_ARCHIVE_MODE=loose, then uploaded to ImmTrac
+def lambdaSinks(upload_bucket, s3):
+    settings = pipelineSettings()
+    if archiveMode() == "loose":
+        archive = S3Sink(s3, upload_bucket, workers=settings["s3_workers"])
+    else:
+        archive = S3BundleSink(s3, upload_bucket)
+    return [archive, immtracSink(s3, upload_bucket)]
+
+
+# the ImmTrac upload, on up to PIPELINE_SFTP_WORKERS threads behind the adaptive
+# delivery controller; what it cannot deliver is parked in the bucket's retry queue.
+# With a manifest (retry-queue drains), documents it has seen are not uploaded again
+def immtracSink(s3, upload_bucket, manifest=None):
+    return ControlledSink(
+        SFTPSink(sftp_connection),
+        DeliveryController(pipelineSettings()["sftp_workers"], "sftp"),
+        RetryQueue(s3, upload_bucket),
+        manifest,
+        permanent=isAuthenticationError,
+    )
 
-    error_dict["Patient ID"].append(patient_id)
-    error_dict["Vaccine Date"].append(vaccination_date)
-    error_dict["HL7 Message"].append(hl7_string)
 
+def messageDelivery(hl7_string, patient_id, vaccination_date, index, error_dict):
+    return HL7Delivery(
+        hl7FileName(index),
+        hl7_string,
+        [(patient_id, vaccination_date, hl7_string)],
+        f"row {index}",
+        error_dict,
+    )
 
-def lambda_handler(event, context):
-    start_time = time.time()
-    logger.info("Beginning lambda.")
-    upload_bucket = os.environ["BUCKET_NAME"]
-    object_key = unquote_plus(
-        event["Records"][0]["s3"]["object"]["key"], encoding="utf-8"
+
+# one FHS/BHS batch file, see batch_utils
+def batchDelivery(batch, error_dict):
+    logger.info(
+        f"Writing HL7 batch {batch.batch_number} with {batch.message_count} messages..."
     )
-    logger.info("File being used is: " + object_key)
-    region = os.environ["AWS_REGION"]
-    s3 = boto3.client(
-        "s3", region, config=botocore.config.Config(s3={"addressing_style": "path"})
+    return HL7Delivery(
+        hl7FileName(batch.batch_number),
+        batch.document_string,
+        batch.records,
+        f"batch {batch.batch_number}",
+        error_dict,
     )
-    csv_obj = s3.get_object(Bucket=upload_bucket, Key=object_key)
-    body = csv_obj["Body"]
-    csv_string = body.read().decode("utf-8")
-    input_df = pd.read_csv(StringIO(csv_string))
-    # check the log of records we've already sent
-    error_csv_obj = s3.get_object(Bucket=upload_bucket, Key="texas-vax/MessageLog.txt")
-    error_body = error_csv_obj["Body"]
-    error_csv_string = error_body.read().decode("utf-8")
-    error_df = pd.read_csv(StringIO(error_csv_string))
-    error_dict = {"Patient ID": [], "Vaccine Date": [], "HL7 Message": [], "Error": []}
-    # don't bother with records we've already checked
+
+
+# every invocation publishes its stage timings and counters once at the end, see
+# metrics_utils
+def lambda_handler(event, context):
+    startMetrics()
     try:
-        error_df["ID Date Combo"] = error_df.apply(
-            lambda row: (row["Patient ID"], row["Vaccine Date"]), axis=1
-        )
-        input_df["ID Date Combo"] = input_df.apply(
-            lambda row: (row["Patient ID"], row["Vaccine Administered Date"]), axis=1
-        )
-        sent_list = error_df["ID Date Combo"].unique()
-        input_data = input_df[~input_df["ID Date Combo"].isin(sent_list)]
-    except Exception as e:
-        logger.error(f"File uploaded to bucket is blank. {e}")
+        return process_event(event, context)
+    finally:
+        sftp_connection.release()
+        with timed("log.flush"):
+            error_log.flush()
+        publishMetrics()
+
+
+def inputChunkRows():
+    return int(os.environ.get("INPUT_CHUNK_ROWS", DEFAULT_CHUNK_ROWS))
+
+
+# skip_rows data rows are skipped after the header when resuming from a checkpoint
+def readInputChunks(body, chunk_rows=None, skip_rows=0):
+    if chunk_rows is None:
+        chunk_rows = inputChunkRows()
+    return pd.read_csv(
+        body,
+        encoding="utf-8",
+        chunksize=chunk_rows,
+        skiprows=range(1, skip_rows + 1) if skip_rows else None,
+    )
 
-    for index in range(len(input_data)):
-        state = input_data["Vaccine_State"][index]
-        patientid = input_data["Patient ID"][index]
-        vaxdate = input_data["Vaccine Administered Date"][index]
-        logger.append_keys(doh=state)
-        logger.append_keys(patientid=patientid)
-        logger.append_keys(vaccinedate=vaxdate)
 
-        cur_time = time.time()
+# records a row whose message could not be generated
+def recordGenerationFailure(patient_record, index, failure, error_dict):
+    patient_id = patient_record["Patient ID"]
+    vaccination_date = patient_record["Vaccine Administered Date"]
+    segment_name, ex = failure
+    error_str = f"{index} failed at {segment_name} message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
+    logger.error(error_str)
+    log_to_bucket("Errors", error_str)
+
+    recordResult(
+        error_dict,
+        patient_id,
+        vaccination_date,
+        "COULD NOT GENERATE",
+        f"Failed at {segment_name} segment",
+    )
 
-        time_diff = cur_time - start_time
-        if time_diff >= 840:
-            break
 
-        control_number: str = "7501" + str(random.randrange(10000, 99999))
-        logger.info("control_number: " + control_number)
-        hl7_document = []
-        patient_record = input_data.iloc[index]
+# builds the seven segments of one message, recording the row as failed and returning
+# None if any of them cannot be generated
+def generateHL7Message(patient_record, control_number, index, error_dict):
+    hl7_string, failure = buildHL7Message(patient_record, control_number)
+    if failure is not None:
+        recordGenerationFailure(patient_record, index, failure, error_dict)
+    return hl7_string
+
+
+# Yields (records, row numbers) for every deduplicated chunk of the input object, row
+# numbers counting data rows from skip_rows. Objects up to CSV_FAST_PATH_MAX_BYTES are
+# read with the csv module and never import pandas; the builders then work the
+# demographic and code columns out row by row instead of from normalized columns
+def inputChunks(csv_obj, skip_rows, dedup_index, run):
+    if useFastPath(csv_obj.get("ContentLength")):
+        for records, row_numbers in timedIteration(
+            "csv.read", readCsvChunks(csv_obj["Body"], inputChunkRows(), skip_rows)
+        ):
+            with timed("dedup.filter"):
+                sent = dedup_index.containsRecords(records)
+            count("rows.read", len(records))
+            count("rows.duplicate", sum(sent))
+            yield (
+                [record for record, seen in zip(records, sent) if not seen],
+                [number for number, seen in zip(row_numbers, sent) if not seen],
+            )
+        return
+    for input_df in timedIteration(
+        "csv.read", readInputChunks(csv_obj["Body"], skip_rows=skip_rows)
+    ):
+        # don't bother with records we've already checked
+        with timed("dedup.filter"):
+            input_data = dedup_index.antiJoin(input_df)
+        count("rows.read", len(input_df))
+        count("rows.duplicate", len(input_df) - len(input_data))
+        # HL7-ready columns for the whole chunk at once, see normalize_utils
+        with timed("normalize"):
+            input_data = normalizeFrame(input_data, run)
+            records = rowRecords(input_data)
+        yield records, input_data.index
+
+
+# generates and delivers every row of a deduplicated chunk. index_offset is the file
+# index of its first row, reserved from the event's FileSequence; each row's control
+# number is derived from its file index. Returns how many rows were handled, fewer than
+# len(records) once the time budget has run out
+def processRows(
+    records,
+    index_offset,
+    start_time,
+    pipeline,
+    error_dict,
+    batch_writer,
+):
+    control_numbers = [
+        controlNumber(index_offset + position) for position in range(len(records))
+    ]
+    # with GENERATION_WORKERS above 1 the whole chunk is built up front in a process
+    # pool; results come back in row order so delivery below is unchanged
+    generated = None
+    workers = generationWorkers()
+    if workers > 1:
+        with timed("generate.chunk"):
+            generated = generateMessages(records, control_numbers, workers)
+
+    for position, patient_record in enumerate(records):
+        index = index_offset + position
+        state = patient_record["Vaccine_State"]
         patient_id = patient_record["Patient ID"]
         vaccination_date = patient_record["Vaccine Administered Date"]
-        # Vaccine_timestamp = datetime.strptime(date_time_vaccine_string, '%Y-%m-%d')
-        # vaccination_date = str(Vaccine_timestamp.strftime('%Y%m%d'))
-        message_timestamp = datetime.now().strftime("%Y%m%d%H%M%S") + "+0000"
-        index: int
-        msh_dict = dict()
-        msh_dict["message_time_stamp"] = message_timestamp
-        msh_dict["message_control_id"] = control_number
-
-        try:
-            MSHSegment = createMSHBlock(msh_dict)
-            hl7_document.append(MSHSegment)
-        except Exception as ex:
-            error_str = f"{index} failed at MSH message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
-
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at MSH segment")
-            continue
-
-        try:
-            PIDSegment = createPIDBlock(patient_record)
-            hl7_document.append(PIDSegment)
-        except Exception as ex:
-            error_str = f"{index} failed at PID message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
+        row_log_keys.set(doh=state, patientid=patient_id, vaccinedate=vaccination_date)
 
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at PID segment")
-            continue
-
-        try:
-            PD1Segment = createPD1Block(patient_record)
-            hl7_document.append(PD1Segment)
-        except Exception as ex:
-            error_str = f"{index} failed at PD1 message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
-
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at PD1 segment")
-            continue
-
-        try:
-            ORCSegment = createORCBlock(patient_record, control_number)
-            hl7_document.append(ORCSegment)
-        except Exception as ex:
-            error_str = f"{index} failed at ORC message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
+        cur_time = time.time()
 
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at MSH segment")
+        time_diff = cur_time - start_time
+        if time_diff >= TIME_BUDGET_SECONDS:
+            return position
+
+        row_control_number: str = control_numbers[position]
+        logger.info("control_number: " + row_control_number)
+        if generated is None:
+            started = time.perf_counter_ns()
+            hl7_string = generateHL7Message(
+                patient_record, row_control_number, index, error_dict
+            )
+            observe("generate", time.perf_counter_ns() - started)
+        else:
+            hl7_string, failure = generated[position]
+            if failure is not None:
+                recordGenerationFailure(patient_record, index, failure, error_dict)
+        if hl7_string is None:
+            count("messages.failed")
             continue
+        count("messages.generated")
+        # time spent blocked on a full pipeline queue, i.e. waiting on S3 or SFTP
+        started = time.perf_counter_ns()
+        if batch_writer is not None:
+            for batch in batch_writer.add(hl7_string, patient_id, vaccination_date):
+                pipeline.submit(batchDelivery(batch, error_dict))
+        else:
+            pipeline.submit(
+                messageDelivery(
+                    hl7_string, patient_id, vaccination_date, index, error_dict
+                )
+            )
+        observe("pipeline.submit", time.perf_counter_ns() - started)
+        logger.info(f"{state} COMPLETED ROW " + str(index))
+    return len(records)
+
+
+def fileWorkers():
+    return max(1, int(os.environ.get("EVENT_FILE_WORKERS", DEFAULT_FILE_WORKERS)))
+
+
+# every object key in the event, in order and without repeats; S3 can batch several
+# notifications into one event
+def eventObjectKeys(event):
+    object_keys = []
+    for record in event.get("Records", []):
+        object_key = unquote_plus(record["s3"]["object"]["key"], encoding="utf-8")
+        if object_key not in object_keys:
+            object_keys.append(object_key)
+    return object_keys
+
+
+# The state of one input file of an event. error_dict collects its row outcomes from
+# the shared pipeline; error is set when the file could not be processed, which stops
+# that file but none of the others
+class FileRun:
+    ledger_day = None
+    ledger_kind = "run"
+
+    def __init__(self, object_key):
+        self.object_key = object_key
+        self.error_dict = {
+            "Patient ID": [],
+            "Vaccine Date": [],
+            "HL7 Message": [],
+            "Error": [],
+        }
+        self.checkpointer = None
+        self.cursor = 0
+        self.resume_cursor = None
+        self.error = None
+
+    def open(self, s3, bucket):
+        return s3.get_object(Bucket=bucket, Key=self.object_key)
+
+    def newCheckpointer(self, s3, bucket, etag):
+        return Checkpointer(s3, bucket, self.object_key, etag)
+
+    def result(self):
+        return {"object_key": self.object_key}
+
+
+# One shard of a sharded object (see shard_utils), processed by its own invocation. It
+# reads only the shard's byte range, under the header, and numbers its files and
+# control numbers from the block of indices the manifest gave it. Its checkpoint and
+# ledger parts are its own, and its continuation is another shard event
+class ShardRun(FileRun):
+    def __init__(self, manifest_key, manifest, shard_number):
+        super().__init__(manifest["object_key"])
+        self.manifest_key = manifest_key
+        self.manifest = manifest
+        self.shard = manifest["shards"][shard_number]
+        self.ledger_day = manifest["day"]
+        self.ledger_kind = shardPartKind(manifest["export_id"], shard_number)
+
+    def open(self, s3, bucket):
+        return openShard(s3, bucket, self.manifest, self.shard["shard"])
+
+    def newCheckpointer(self, s3, bucket, etag):
+        shard_number = self.shard["shard"]
+        continuation = lambda key: dict(
+            shardEvent(self.manifest_key, shard_number),
+            **{CHECKPOINT_EVENT_KEY: {"key": key}},
+        )
+        return Checkpointer(
+            s3,
+            bucket,
+            self.object_key,
+            etag,
+            name=f"{self.object_key}#{self.ledger_kind}",
+            continuation=continuation,
+        )
 
-        try:
-            RXASegment = createRXABlock(patient_record)
-            hl7_document.append(RXASegment)
-        except Exception as ex:
-            error_str = f"{index} failed at RXA message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
+    def result(self):
+        return {
+            "object_key": self.object_key,
+            "export_id": self.manifest["export_id"],
+            "shard": self.shard["shard"],
+        }
 
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at RXA segment")
-            continue
 
-        try:
-            RXRSegment = createRXRBlock(patient_record)
-            hl7_document.append(RXRSegment)
-        except Exception as ex:
-            error_str = f"{index} failed at RXR message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
+# reads, deduplicates and generates one input file, submitting its deliveries to the
+# event's pipeline. Runs on a file worker thread next to the other files of the event
+def processFile(
+    file_run, run, s3, upload_bucket, dedup_index, sequences, pipeline, start_time
+):
+    object_key = file_run.object_key
+    logger.info("File being used is: " + object_key)
+    csv_obj = file_run.open(s3, upload_bucket)
+    checkpointer = file_run.newCheckpointer(s3, upload_bucket, csv_obj["ETag"])
+    file_run.checkpointer = checkpointer
+    # rows before cursor were handled by an earlier invocation of this file
+    cursor, index_offset = checkpointer.load()
+    file_run.cursor = cursor
+    sequences["message"].advanceTo(index_offset)
+    if index_offset:
+        # an earlier invocation wrote at most one batch per message it sent
+        sequences["batch"].advanceTo(index_offset + 1)
+    # with HL7_BATCH_MODE set, messages are uploaded in batch files instead of one by one
+    batch_writer = None
+    if batchModeEnabled():
+        batch_writer = HL7BatchWriter(next_number=lambda: sequences["batch"].reserve(1))
+
+    # the CSV is parsed straight off the S3 stream in bounded chunks, and each chunk is
+    # deduplicated and sent before the next one is read
+    try:
+        for records, row_numbers in inputChunks(csv_obj, cursor, dedup_index, run):
+            handled = processRows(
+                records,
+                sequences["message"].reserve(len(records)),
+                start_time,
+                pipeline,
+                file_run.error_dict,
+                batch_writer,
+            )
+            if handled < len(records):
+                # row numbers count data rows from the cursor this run started at
+                file_run.resume_cursor = cursor + int(row_numbers[handled])
+                break
+    except (EmptyCsvError, pd.errors.EmptyDataError) as e:
+        logger.error(f"File uploaded to bucket is blank. {e}")
+    finally:
+        if batch_writer is not None:
+            for batch in batch_writer.flush():
+                pipeline.submit(batchDelivery(batch, file_run.error_dict))
 
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at RXR segment")
-            continue
 
-        try:
-            OBXSegment = createOBXBlock(patient_record)
-            hl7_document.append(OBXSegment)
-        except Exception as ex:
-            error_str = f"{index} failed at OBX message generation, Patient ID is : {patient_id} and Vaccination Date is : {vaccination_date}. {ex}"
-            logger.error(error_str)
-            log_to_bucket("Errors", error_str)
+def runFile(file_run, process):
+    try:
+        process(file_run)
+    except Exception as ex:
+        file_run.error = ex
+        error_str = f"Unable to process {file_run.object_key}. {ex}"
+        logger.exception(error_str)
+        log_to_bucket("Errors", error_str)
 
-            error_dict["Patient ID"].append(patient_id)
-            error_dict["Vaccine Date"].append(vaccination_date)
-            error_dict["HL7 Message"].append("COULD NOT GENERATE")
-            error_dict["Error"].append("Failed at OBX segment")
-            continue
-        hl7_string = "".join(hl7_document)
-        writeHL7DocumentToFile(
-            hl7_string, upload_bucket, patient_id, vaccination_date, error_dict, index
-        )
-        logger.info(f"{state} COMPLETED ROW " + str(index))
 
-    cur_df = pd.DataFrame.from_dict(error_dict, orient="index")
-    df = cur_df.transpose()
-    df = error_df.append(cur_df, ignore_index=True)
-    csv_buffer = StringIO()
-    df.to_csv(
-        csv_buffer,
-        columns=["Patient ID", "HL7 Message", "Vaccine Date", "Error"],
-        index=False,
+# writes the ledger part of a file once all of its deliveries have been recorded and
+# hands the rest of an unfinished file to a continuation. Returns its per-file result
+def finishFile(file_run, context, s3, upload_bucket, next_index):
+    error_dict = file_run.error_dict
+    result = dict(
+        file_run.result(),
+        status="complete",
+        rows=len(error_dict["Patient ID"]),
+        failed_rows=sum(1 for error in error_dict["Error"] if error),
     )
-    s3.put_object(
-        Bucket=upload_bucket, Key="texas-vax/MessageLog.txt", Body=csv_buffer.getvalue()
+    try:
+        with timed("ledger.write"):
+            writeLedgerPart(
+                s3,
+                upload_bucket,
+                error_dict,
+                day=file_run.ledger_day,
+                kind=file_run.ledger_kind,
+            )
+        if file_run.error is not None:
+            result["status"] = "failed"
+            result["error"] = str(file_run.error)
+        elif file_run.resume_cursor is not None:
+            file_run.checkpointer.handOff(context, file_run.resume_cursor, next_index)
+            result["status"] = "checkpointed"
+            result["resume_cursor"] = file_run.resume_cursor
+        elif file_run.cursor:
+            file_run.checkpointer.clear()
+    except Exception as ex:
+        result["status"] = "failed"
+        result["error"] = str(ex)
+        logger.exception(f"Unable to finish {file_run.object_key}. {ex}")
+    logger.info(f"File result: {result}")
+    return result
+
+
+# Records a finished shard and, once every shard of its export has finished, merges
+# their ledger parts. Two shards finishing together may both merge; the second finds
+# nothing left to merge and only rewrites the summary
+def finishShard(file_run, result, s3, upload_bucket):
+    if result["status"] == "checkpointed":
+        return
+    manifest = file_run.manifest
+    markShardDone(s3, upload_bucket, manifest, file_run.shard["shard"], result)
+    if allShardsDone(s3, upload_bucket, manifest):
+        result["export"] = finishExport(s3, upload_bucket, manifest)
+
+
+# Splits object_key and fans it out to shard invocations if it is large enough, returning
+# its "sharded" result; None for an object to process in this invocation
+def shardObject(s3, upload_bucket, object_key, context):
+    head = s3.head_object(Bucket=upload_bucket, Key=object_key)
+    if not shouldShard(head["ContentLength"]):
+        return None
+    manifest = coordinate(
+        s3, upload_bucket, object_key, head["ETag"], head["ContentLength"], context
     )
+    return {
+        "object_key": object_key,
+        "export_id": manifest["export_id"],
+        "status": "sharded",
+        "shards": len(manifest["shards"]),
+    }
+
+
+# The runs an event asks for: one shard of a sharded object for a shard event, else one
+# run per object in its S3 records. With SHARD_MIN_BYTES set, new objects at least that
+# large are split and fanned out to shard invocations instead (see shard_utils); their
+# results come back with status "sharded", or "failed" when that did not work out
+def eventRuns(event, context, s3, upload_bucket):
+    if SHARD_EVENT_KEY in event:
+        manifest_key = event[SHARD_EVENT_KEY]["manifest_key"]
+        manifest = loadManifest(s3, upload_bucket, manifest_key)
+        return [ShardRun(manifest_key, manifest, event[SHARD_EVENT_KEY]["shard"])], []
+    file_runs = []
+    sharded = []
+    for object_key in eventObjectKeys(event):
+        if shardMinBytes() and CHECKPOINT_EVENT_KEY not in event:
+            # planning and dispatching shards can fail for one object, which then
+            # fails on its own like any other file of the event
+            try:
+                result = shardObject(s3, upload_bucket, object_key, context)
+            except Exception as ex:
+                error_str = f"Unable to shard {object_key}. {ex}"
+                logger.exception(error_str)
+                log_to_bucket("Errors", error_str)
+                result = {
+                    "object_key": object_key,
+                    "status": "failed",
+                    "rows": 0,
+                    "failed_rows": 0,
+                    "error": str(ex),
+                }
+            if result is not None:
+                sharded.append(result)
+                continue
+        file_runs.append(FileRun(object_key))
+    return file_runs, sharded
+
+
+# Uploads the deliveries parked in the retry queue, oldest file names first, until the
+# time budget runs out (what is left waits for the next drain). Each goes through the
+# same controller as a fresh upload: delivered ones leave the queue and are written to a
+# ledger part, the others are parked again. Entries an earlier drain delivered but did
+# not get to remove are found in the delivery manifest and not uploaded twice. Sent for
+# the {"retry_queue": {}} event
+def drainRetryQueue(s3, upload_bucket, start_time):
+    retry_queue = RetryQueue(s3, upload_bucket)
+    file_run = FileRun(retry_queue.prefix)
+    manifest = None
+    if deliveryManifestEnabled():
+        manifest = DeliveryManifest(s3, upload_bucket)
+    pipeline = startDeliveryPipeline([immtracSink(s3, upload_bucket, manifest)])
+    deliveries = []
+    try:
+        for key in retry_queue.keys():
+            if time.time() - start_time >= TIME_BUDGET_SECONDS:
+                break
+            entry = retry_queue.load(key)
+            delivery = HL7Delivery(
+                entry["file_name"],
+                entry["document"],
+                [tuple(record) for record in entry["records"]],
+                entry["label"],
+                file_run.error_dict,
+            )
+            pipeline.submit(delivery)
+            deliveries.append((key, delivery))
+    finally:
+        pipeline.close()
+
+    delivered = [
+        key
+        for key, delivery in deliveries
+        if delivery.error is None and delivery.parked is None
+    ]
+    for key in delivered:
+        retry_queue.remove(key)
+    # rows parked again are already in the ledger from when they were first parked
+    errors = file_run.error_dict["Error"]
+    sent = {
+        column: [value for value, error in zip(values, errors) if not error]
+        for column, values in file_run.error_dict.items()
+    }
+    with timed("ledger.write"):
+        writeLedgerPart(s3, upload_bucket, sent, kind="retry")
+    result = {
+        "retried": len(deliveries),
+        "delivered": len(delivered),
+        "remaining": len(deliveries) - len(delivered),
+    }
+    logger.info(f"Retry queue result: {result}")
+    return result
+
+
+# Processes every file in the event, EVENT_FILE_WORKERS at a time. The files share the
+# SFTP session, the credential cache, the dedup index and one delivery pipeline, and
+# reserve HL7 file numbers from one sequence so their uploads never collide. Ledger
+# parts and checkpoints are written per file once the pipeline has drained; the dedup
+# index is saved once for the whole event. Returns the per-file results
+def process_event(event, context):
+    start_time = time.time()
+    logger.info("Beginning lambda.")
+    # century cutoff and report date, shared by every row of this run
+    run = startRun()
+    upload_bucket = os.environ["BUCKET_NAME"]
+    region = os.environ["AWS_REGION"]
+    s3 = awsClient("s3", region, path_style=True)
+    if FINISH_EVENT_KEY in event:
+        manifest_key = event[FINISH_EVENT_KEY]["manifest_key"]
+        manifest = loadManifest(s3, upload_bucket, manifest_key)
+        return {"export": finishExport(s3, upload_bucket, manifest)}
+    if RETRY_EVENT_KEY in event:
+        return {"retry_queue": drainRetryQueue(s3, upload_bucket, start_time)}
+    file_runs, results = eventRuns(event, context, s3, upload_bucket)
+    if not file_runs:
+        logger.info("FUNCTION COMPLETE")
+        return {"files": results}
+    # check the index of records we've already sent
+    with timed("dedup.load"):
+        dedup_index = loadDedupIndex(s3, upload_bucket)
+    # a shard numbers its files from the block of indices its manifest reserved for it,
+    # and fails rather than run into the next shard's block (see planShards); other
+    # runs take blocks from the bucket's counter as they go, and number messages and
+    # batches from the same blocks
+    if isinstance(file_runs[0], ShardRun):
+        index_base = file_runs[0].shard["index_base"]
+        index_end = index_base + file_runs[0].shard["index_stride"]
+        sequences = {
+            "message": FileSequence(index_base, end=index_end),
+            "batch": FileSequence(index_base + 1, end=index_end),
+        }
+    else:
+        sequence = FileSequence(counter=SequenceCounter(s3, upload_bucket))
+        sequences = {"message": sequence, "batch": sequence}
 
+    pipeline = startDeliveryPipeline(lambdaSinks(upload_bucket, s3))
+    process = lambda file_run: processFile(
+        file_run, run, s3, upload_bucket, dedup_index, sequences, pipeline, start_time
+    )
+    try:
+        workers = min(fileWorkers(), len(file_runs))
+        if workers <= 1:
+            for file_run in file_runs:
+                runFile(file_run, process)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="file"
+            ) as executor:
+                list(
+                    executor.map(lambda file_run: runFile(file_run, process), file_runs)
+                )
+    finally:
+        pipeline.close()
+
+    for file_run in file_runs:
+        error_dict = file_run.error_dict
+        dedup_index.addMany(error_dict["Patient ID"], error_dict["Vaccine Date"])
+        results.append(
+            finishFile(
+                file_run,
+                context,
+                s3,
+                upload_bucket,
+                sequences["message"].next_number,
+            )
+        )
+    with timed("dedup.save"):
+        dedup_index.save(s3, upload_bucket)
+    # a shard reports done only once its rows are in the ledger and the dedup index. Its
+    # rows are delivered by now, so a failure to report or finish is logged and left for
+    # a finish event (see shard_utils.finishEvent) rather than failing the invocation
+    for file_run, result in zip(file_runs, results[-len(file_runs) :]):
+        if isinstance(file_run, ShardRun):
+            try:
+                finishShard(file_run, result, s3, upload_bucket)
+            except Exception as ex:
+                error_str = f"Unable to finish shard of {file_run.object_key}. {ex}"
+                logger.exception(error_str)
+                log_to_bucket("Errors", error_str)
+                result["finish_error"] = str(ex)
+
+    # lookups done in this process; rows built in generation workers count there
+    logger.info(f"Lookup cache usage: {lookupCacheStats()}")
     logger.info("FUNCTION COMPLETE")
+    return {"files": results}
@@ -0,0 +1,161 @@
+# Works with the bundled HL7 archive (see archive_utils) outside Lambda.
+#
+#   python archive_tool.py migrate BUCKET [--source-prefix P] [--prefix P] [--delete]
+#                                         [--workers N] [--region REGION]
+#   python archive_tool.py get BUCKET FILE_NAME [--day YYYY-MM-DD] [--prefix P]
+#
+# migrate packs the loose objects the Lambda used to write, one per file under
+# texas-hl7-messages/, into bundles in the date partition of the day each was written
+# (its LastModified). File names repeat across runs, so a loose object is skipped only
+# when its day's partition already holds a file of that name with the same bytes, which
+# lets a migration that stopped part way be run again. One whose name is there with
+# other bytes is a conflict: it is left in place, and counted, for someone to look at.
+# With --delete, the loose objects of a day that were archived or found archived are
+# deleted once its bundles and indexes are written; conflicts never are. Compression
+# and bundle sizes come from HL7_ARCHIVE_COMPRESSION, HL7_ARCHIVE_FRAME_BYTES and
+# HL7_ARCHIVE_BUNDLE_BYTES. The last line of output is a JSON summary.
+#
+# get writes one archived file to stdout, read with a ranged GET; --day limits the
+# indexes loaded to that day's partition.
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from aws_utils import awsClient
+from aws_lambda_powertools import Logger
+from archive_utils import ArchiveReader, BundleWriter, readArchived, ARCHIVE_PREFIX
+from sink_utils import HL7_ARCHIVE_PREFIX
+from log_utils import setCommandLineLogLevel
+
+DEFAULT_WORKERS = 16
+DELETE_BATCH = 1000
+FETCH_BATCH = 1000
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# the loose objects under source_prefix, grouped by the day they were written:
+# {day: [key, ...]}
+def looseObjectsByDay(s3, bucket, source_prefix):
+    days = dict()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=source_prefix):
+        for item in page.get("Contents", []):
+            written = item.get("LastModified") or datetime.utcnow()
+            days.setdefault(written.strftime("%Y-%m-%d"), []).append(item["Key"])
+    return days
+
+
+def deleteKeys(s3, bucket, keys):
+    for start in range(0, len(keys), DELETE_BATCH):
+        batch = keys[start : start + DELETE_BATCH]
+        s3.delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch]}
+        )
+
+
+# (file name, bytes) of a loose object, and whether archived, the locations of its
+# day's partition, already holds those bytes under that name: None when the name is
+# not there, else True or False
+def fetchLoose(s3, bucket, key, source_prefix, archived):
+    name = key[len(source_prefix) :]
+    data = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    if name not in archived:
+        return name, data, None
+    return name, data, readArchived(s3, bucket, *archived[name]) == data
+
+
+def migrate(
+    s3,
+    bucket,
+    source_prefix=HL7_ARCHIVE_PREFIX,
+    prefix=ARCHIVE_PREFIX,
+    delete=False,
+    workers=DEFAULT_WORKERS,
+):
+    reader = ArchiveReader(s3, bucket, prefix)
+    summary = {
+        "objects": 0,
+        "skipped": 0,
+        "conflicts": 0,
+        "bytes": 0,
+        "bundles": 0,
+        "deleted": 0,
+    }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for day, keys in sorted(looseObjectsByDay(s3, bucket, source_prefix).items()):
+            archived = reader.locations(day)
+            fetch = lambda key: fetchLoose(s3, bucket, key, source_prefix, archived)
+            writer = BundleWriter(s3, bucket, prefix, day=day)
+            done = []
+            found = {"archived": 0, "skipped": 0, "conflicts": 0}
+            # fetched FETCH_BATCH at a time so a large day is never all in memory
+            for start in range(0, len(keys), FETCH_BATCH):
+                batch = keys[start : start + FETCH_BATCH]
+                for key, (name, data, same) in zip(batch, executor.map(fetch, batch)):
+                    if same is None:
+                        writer.add(name, data)
+                        found["archived"] += 1
+                        summary["bytes"] += len(data)
+                    elif same:
+                        found["skipped"] += 1
+                    else:
+                        logger.warning(
+                            f"{key} differs from {name} archived for {day}, leaving it"
+                        )
+                        found["conflicts"] += 1
+                        continue
+                    done.append(key)
+            summary["objects"] += found["archived"]
+            summary["skipped"] += found["skipped"]
+            summary["conflicts"] += found["conflicts"]
+            summary["bundles"] += len(writer.flush())
+            if delete:
+                deleteKeys(s3, bucket, done)
+                summary["deleted"] += len(done)
+            print(
+                f"{day}: {found['archived']} files archived, {found['skipped']} "
+                f"skipped, {found['conflicts']} conflicting"
+            )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate")
+    migrate_parser.add_argument("bucket")
+    migrate_parser.add_argument("--source-prefix", default=HL7_ARCHIVE_PREFIX)
+    migrate_parser.add_argument("--prefix", default=ARCHIVE_PREFIX)
+    migrate_parser.add_argument("--delete", action="store_true")
+    migrate_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    migrate_parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    get_parser = commands.add_parser("get")
+    get_parser.add_argument("bucket")
+    get_parser.add_argument("file_name")
+    get_parser.add_argument("--day", default=None)
+    get_parser.add_argument("--prefix", default=ARCHIVE_PREFIX)
+    get_parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    args = parser.parse_args()
+
+    setCommandLineLogLevel(os.environ.get("LOG_LEVEL", "WARNING"))
+    os.environ.setdefault("METRICS_EMF", "0")
+    s3 = awsClient("s3", args.region, path_style=True)
+    if args.command == "get":
+        reader = ArchiveReader(s3, args.bucket, args.prefix)
+        try:
+            sys.stdout.buffer.write(reader.get(args.file_name, args.day))
+        except KeyError as ex:
+            sys.exit(ex.args[0])
+    else:
+        summary = migrate(
+            s3,
+            args.bucket,
+            args.source_prefix,
+            args.prefix,
+            args.delete,
+            args.workers,
+        )
+        print(json.dumps(summary))
@@ -0,0 +1,239 @@
+import os
+import json
+import gzip
+import uuid
+import importlib
+import threading
+from io import BytesIO
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from metrics_utils import timed, count
+
+ARCHIVE_PREFIX = "texas-hl7-archive/"
+INDEX_SUFFIX = ".index.json"
+DEFAULT_COMPRESSION = "gzip"
+DEFAULT_FRAME_BYTES = 128 * 1024
+DEFAULT_BUNDLE_BYTES = 16 * 1024 * 1024
+# a batch is held back from the uploads until its bundle is written, so it is kept to
+# about one pipeline queue (see pipeline_utils.DEFAULT_QUEUE_SIZE) of files
+DEFAULT_BATCH_FILES = 16
+DEFAULT_LINGER = 0.01
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# HL7_ARCHIVE_MODE: "bundle" (default) archives a run's files in compressed bundles,
+# "loose" as one object per file under texas-hl7-messages/ as before
+def archiveMode():
+    return os.environ.get("HL7_ARCHIVE_MODE", "bundle").lower()
+
+
+def archiveSettings():
+    return {
+        "compression": os.environ.get(
+            "HL7_ARCHIVE_COMPRESSION", DEFAULT_COMPRESSION
+        ).lower(),
+        "frame_bytes": int(
+            os.environ.get("HL7_ARCHIVE_FRAME_BYTES", DEFAULT_FRAME_BYTES)
+        ),
+        "bundle_bytes": int(
+            os.environ.get("HL7_ARCHIVE_BUNDLE_BYTES", DEFAULT_BUNDLE_BYTES)
+        ),
+        "batch_files": int(
+            os.environ.get("HL7_ARCHIVE_BATCH_FILES", DEFAULT_BATCH_FILES)
+        ),
+        "linger": float(os.environ.get("HL7_ARCHIVE_LINGER", DEFAULT_LINGER)),
+    }
+
+
+# level 6, zlib's default, compresses HL7 about twice as fast as gzip's 9 and only ~5%
+# larger
+class GzipCodec:
+    name = "gzip"
+    suffix = ".hl7.gz"
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=6)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+# needs the zstandard package, which the Lambda does not ship; for exports run elsewhere
+class ZstdCodec:
+    name = "zstd"
+    suffix = ".hl7.zst"
+
+    def __init__(self):
+        self.zstandard = importlib.import_module("zstandard")
+
+    def compress(self, data):
+        return self.zstandard.ZstdCompressor().compress(data)
+
+    def decompress(self, data):
+        return self.zstandard.ZstdDecompressor().decompress(data)
+
+
+def archiveCodec(name):
+    if name == "gzip":
+        return GzipCodec()
+    if name == "zstd":
+        return ZstdCodec()
+    raise ValueError(f"Unknown archive compression {name!r}")
+
+
+def archivePartitionPrefix(day, prefix=ARCHIVE_PREFIX):
+    return f"{prefix}date={day}/"
+
+
+# Collects HL7 files into bundles: one S3 object holding a run of independently
+# compressed frames, each frame the concatenation of up to frame_bytes of files, and
+# next to it an index object mapping every file name to
+#
+#   [offset, length, start, size]
+#
+# the frame's byte range in the bundle and the file's within the decompressed frame.
+# A gzip bundle is a valid multi-member .gz file, so the whole of it decompresses with
+# gzip too. Bundles roll over at bundle_bytes compressed and are written under
+# date=YYYY-MM-DD/, bundle first and index after, so an index never names a missing
+# bundle. add() may be called from several threads and uploads outside the lock, and
+# flush() writes whatever is still held back; both raise when an upload fails
+class BundleWriter:
+    def __init__(self, s3, bucket, prefix=ARCHIVE_PREFIX, settings=None, day=None):
+        settings = settings or archiveSettings()
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.codec = archiveCodec(settings["compression"])
+        self.frame_bytes = max(1, settings["frame_bytes"])
+        self.bundle_bytes = max(1, settings["bundle_bytes"])
+        self.day = day
+        self.bundles = []
+        self._lock = threading.Lock()
+        self._frame = []
+        self._frame_size = 0
+        self._buffer = BytesIO()
+        self._entries = dict()
+
+    def add(self, name, data):
+        full = None
+        with self._lock:
+            self._frame.append((name, data))
+            self._frame_size += len(data)
+            if self._frame_size >= self.frame_bytes:
+                self._sealFrame()
+                if self._buffer.tell() >= self.bundle_bytes:
+                    full = self._takeBundle()
+        if full is not None:
+            self._upload(*full)
+
+    # writes out the frame and bundle being filled; returns the keys of every bundle
+    # written so far
+    def flush(self):
+        with self._lock:
+            self._sealFrame()
+            full = self._takeBundle()
+        if full is not None:
+            self._upload(*full)
+        return list(self.bundles)
+
+    def _sealFrame(self):
+        if not self._frame:
+            return
+        frame = BytesIO()
+        positions = []
+        for name, data in self._frame:
+            positions.append((name, frame.tell(), len(data)))
+            frame.write(data)
+        compressed = self.codec.compress(frame.getvalue())
+        offset = self._buffer.tell()
+        self._buffer.write(compressed)
+        for name, start, size in positions:
+            self._entries[name] = [offset, len(compressed), start, size]
+        self._frame = []
+        self._frame_size = 0
+
+    def _takeBundle(self):
+        if not self._entries:
+            return None
+        full = (self._buffer.getvalue(), self._entries)
+        self._buffer = BytesIO()
+        self._entries = dict()
+        return full
+
+    def _upload(self, body, entries):
+        day = self.day or datetime.utcnow().strftime("%Y-%m-%d")
+        name = (
+            "bundle-"
+            + datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+            + "-"
+            + uuid.uuid4().hex[:8]
+        )
+        key = archivePartitionPrefix(day, self.prefix) + name + self.codec.suffix
+        index = {
+            "bundle": key,
+            "compression": self.codec.name,
+            "created_at": datetime.utcnow().isoformat(),
+            "messages": entries,
+        }
+        with timed("archive.upload"):
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=key + INDEX_SUFFIX,
+                Body=json.dumps(index).encode("utf-8"),
+            )
+        count("archive.bundles")
+        count("archive.bytes", len(body))
+        with self._lock:
+            self.bundles.append(key)
+        logger.info(f"Archived {len(entries)} HL7 files in {key}")
+
+
+# Finds and reads archived files. The indexes of a day's partition (or of the whole
+# archive) are loaded once, then every file is one ranged GET of its frame
+class ArchiveReader:
+    def __init__(self, s3, bucket, prefix=ARCHIVE_PREFIX):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self._locations = dict()
+
+    def indexKeys(self, day=None):
+        prefix = archivePartitionPrefix(day, self.prefix) if day else self.prefix
+        keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(INDEX_SUFFIX):
+                    keys.append(item["Key"])
+        return sorted(keys)
+
+    # file name -> (bundle key, compression, [offset, length, start, size])
+    def locations(self, day=None):
+        if day not in self._locations:
+            locations = dict()
+            for key in self.indexKeys(day):
+                body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+                index = json.loads(body)
+                for name, entry in index["messages"].items():
+                    locations[name] = (index["bundle"], index["compression"], entry)
+            self._locations[day] = locations
+        return self._locations[day]
+
+    def get(self, name, day=None):
+        try:
+            bundle, compression, entry = self.locations(day)[name]
+        except KeyError:
+            raise KeyError(f"{name} is not in the archive")
+        return readArchived(self.s3, self.bucket, bundle, compression, entry)
+
+
+def readArchived(s3, bucket, bundle, compression, entry):
+    offset, length, start, size = entry
+    with timed("archive.read"):
+        response = s3.get_object(
+            Bucket=bucket, Key=bundle, Range=f"bytes={offset}-{offset + length - 1}"
+        )
+        frame = archiveCodec(compression).decompress(response["Body"].read())
+    return frame[start : start + size]
@@ -0,0 +1,94 @@
+import threading
+from lazy_utils import lazyImport
+
+boto3 = lazyImport("boto3")
+botocore_config = lazyImport("botocore.config")
+
+_clients = dict()
+_clients_lock = threading.Lock()
+
+# error codes S3 answers a conditional write with when the object changed in between,
+# and a read or HEAD of a key that does not exist
+CONDITION_CONFLICT_CODES = (
+    "PreconditionFailed",
+    "ConditionalRequestConflict",
+    "412",
+    "409",
+)
+MISSING_KEY_CODES = ("NoSuchKey", "NotFound", "404")
+
+# condition headers for the PutObject this thread is making, see conditionalPut
+_conditions = threading.local()
+_hooked_clients = set()
+
+
+# One boto3 client per (service, region, addressing style), created on first use and
+# kept at module scope so pipeline threads and warm invocations share it instead of
+# paying for client creation (and the boto3 import) every time. Creation is locked
+# because the default boto3 session is not thread safe; the clients themselves are.
+def awsClient(service, region_name=None, path_style=False):
+    key = (service, region_name, path_style)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                config = None
+                if path_style:
+                    config = botocore_config.Config(s3={"addressing_style": "path"})
+                client = boto3.client(service, region_name, config=config)
+                _clients[key] = client
+    return client
+
+
+def errorCode(ex):
+    return getattr(ex, "response", {}).get("Error", {}).get("Code")
+
+
+def isConditionConflict(ex):
+    return errorCode(ex) in CONDITION_CONFLICT_CODES
+
+
+def isMissingKey(s3, ex):
+    return isinstance(ex, s3.exceptions.NoSuchKey) or errorCode(ex) in MISSING_KEY_CODES
+
+
+def acceptsConditions(s3):
+    meta = getattr(s3, "meta", None)
+    if meta is None:
+        return True
+    members = meta.service_model.operation_model("PutObject").input_shape.members
+    return "IfNoneMatch" in members
+
+
+def _addConditionHeaders(request, **kwargs):
+    headers = getattr(_conditions, "headers", None)
+    if headers:
+        request.headers.update(headers)
+
+
+# PutObject that only succeeds if the object still has ETag if_match, or, with
+# if_none_match="*", does not exist yet; S3 rejects it with 412 (or 409 when racing
+# another conditional write) otherwise, see isConditionConflict. botocore only takes
+# IfMatch/IfNoneMatch on PutObject from 1.35, so on the pinned SDK the same headers are
+# added to the request just before it is signed
+def conditionalPut(s3, bucket, key, body, if_match=None, if_none_match=None):
+    conditions = dict()
+    if if_match is not None:
+        conditions["IfMatch"] = if_match
+    if if_none_match is not None:
+        conditions["IfNoneMatch"] = if_none_match
+    if acceptsConditions(s3):
+        return s3.put_object(Bucket=bucket, Key=key, Body=body, **conditions)
+    with _clients_lock:
+        if id(s3) not in _hooked_clients:
+            s3.meta.events.register("before-sign.s3.PutObject", _addConditionHeaders)
+            _hooked_clients.add(id(s3))
+    _conditions.headers = {
+        {"IfMatch": "If-Match", "IfNoneMatch": "If-None-Match"}[name]: value
+        for name, value in conditions.items()
+    }
+    try:
+        return s3.put_object(Bucket=bucket, Key=key, Body=body)
+    finally:
+        _conditions.headers = None
@@ -0,0 +1,101 @@
+import os
+from datetime import datetime
+
+DEFAULT_BATCH_MAX_MESSAGES = 500
+DEFAULT_BATCH_MAX_BYTES = 5 * 1024 * 1024
+ENCODING_CHARACTERS = "^~\\&"
+
+
+def batchModeEnabled():
+    return os.environ.get("HL7_BATCH_MODE", "").lower() in ("1", "true", "yes")
+
+
+# returns the segment terminator a generated message uses so the envelope segments match
+def segmentTerminator(hl7_message):
+    stripped = hl7_message.rstrip("\r\n")
+    return hl7_message[len(stripped) :] or "\r"
+
+
+def envelopeTimestamp():
+    return datetime.now().strftime("%Y%m%d%H%M%S") + "+0000"
+
+
+# A completed batch file: the wrapped payload plus the (patient id, vaccine date,
+# message) of every message it carries so the caller can record each one as sent
+class HL7Batch:
+    def __init__(self, batch_number, document_string, records):
+        self.batch_number = batch_number
+        self.document_string = document_string
+        self.records = records
+
+    @property
+    def message_count(self):
+        return len(self.records)
+
+
+# Collects generated messages and wraps them in FHS/BHS ... BTS/FTS envelopes. A batch is
+# closed and returned from add() as soon as it holds max_messages messages, or before a
+# message that would push it past max_bytes, so each one becomes a single upload.
+class HL7BatchWriter:
+    # next_number, when given, is called for each batch number instead of counting up
+    # from first_batch_number, so several writers can share one sequence
+    def __init__(
+        self, max_messages=None, max_bytes=None, first_batch_number=1, next_number=None
+    ):
+        if max_messages is None:
+            max_messages = int(
+                os.environ.get("HL7_BATCH_MAX_MESSAGES", DEFAULT_BATCH_MAX_MESSAGES)
+            )
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("HL7_BATCH_MAX_BYTES", DEFAULT_BATCH_MAX_BYTES))
+        self.max_messages = max(1, max_messages)
+        self.max_bytes = max_bytes
+        self.next_batch_number = first_batch_number
+        self.next_number = next_number
+        self._messages = []
+        self._records = []
+        self._size = 0
+
+    def add(self, hl7_message, patient_id, vaccination_date):
+        completed = []
+        message_size = len(hl7_message.encode("utf-8"))
+        if self._messages and self._size + message_size > self.max_bytes:
+            completed.append(self._close())
+        self._messages.append(hl7_message)
+        self._records.append((patient_id, vaccination_date, hl7_message))
+        self._size += message_size
+        if len(self._messages) >= self.max_messages:
+            completed.append(self._close())
+        return completed
+
+    # closes the partially filled batch, if any, at the end of a run
+    def flush(self):
+        if self._messages:
+            return [self._close()]
+        return []
+
+    def _close(self):
+        if self.next_number is not None:
+            batch_number = self.next_number()
+        else:
+            batch_number = self.next_batch_number
+            self.next_batch_number += 1
+        terminator = segmentTerminator(self._messages[0])
+        timestamp = envelopeTimestamp()
+        header = (
+            f"FHS|{ENCODING_CHARACTERS}|||||{timestamp}||{batch_number}{terminator}"
+            f"BHS|{ENCODING_CHARACTERS}|||||{timestamp}||{batch_number}{terminator}"
+        )
+        trailer = (
+            f"BTS|{len(self._messages)}{terminator}"
+            f"FTS|1{terminator}"
+        )
+        body = "".join(
+            message if message.endswith(terminator) else message + terminator
+            for message in self._messages
+        )
+        batch = HL7Batch(batch_number, header + body + trailer, self._records)
+        self._messages = []
+        self._records = []
+        self._size = 0
+        return batch
@@ -0,0 +1,220 @@
+# Micro-benchmarks for the per-row segment builders and the per-chunk normalizers, on a
+# synthetic export (see synthetic.py).
+#
+#   python benchmarks/builders.py [--rows N] [--dirty F] [--workdir DIR] [--json]
+#
+# Builders are timed one call at a time, on rows as read (every value worked out by the
+# scalar HL7_utils functions) and on rows normalizeFrame has prepared, after one warm-up
+# pass so the lookup caches are in their steady state. Normalizers are timed per
+# INPUT_CHUNK_ROWS chunk and reported per row. Each figure is the fastest of --repeat
+# passes. Run it from (or point --workdir at) an existing directory holding the Lambda
+# package's templates/, which this repository does not include.
+import os
+import sys
+import json
+import time
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pandas as pd
+from measure import latencySummary, enterDeploymentDir
+from synthetic import syntheticCsvBytes
+from segment_utils import (
+    startRun,
+    rowRecords,
+    prepareRecord,
+    buildHL7Message,
+    createMSHBlock,
+    createPIDBlock,
+    createPD1Block,
+    createORCBlock,
+    createRXABlock,
+    createRXRBlock,
+    createOBXBlock,
+)
+from normalize_utils import (
+    normalizeFrame,
+    normalizeGender,
+    normalizeRace,
+    normalizeEthnicity,
+    normalizeLot,
+    normalizeExpiration,
+    formatDates,
+    mapUnique,
+    ADMINISTERED_FORMAT,
+)
+from HL7_utils import (
+    findStateAbbreviation,
+    convertPhoneNumberToHL7,
+    hl7StringRead,
+    getAdministration,
+    getBodySite,
+)
+
+CONTROL_NUMBER = "750112345"
+MESSAGE_TIMESTAMP = "20220101000000+0000"
+
+BUILDERS = [
+    (
+        "MSH",
+        lambda row: createMSHBlock(
+            {
+                "message_time_stamp": MESSAGE_TIMESTAMP,
+                "message_control_id": CONTROL_NUMBER,
+            }
+        ),
+    ),
+    ("PID", createPIDBlock),
+    ("PD1", createPD1Block),
+    ("ORC", lambda row: createORCBlock(row, CONTROL_NUMBER)),
+    ("RXA", createRXABlock),
+    ("RXR", createRXRBlock),
+    ("OBX", createOBXBlock),
+]
+
+
+def normalizers(run):
+    return [
+        ("gender", lambda frame: normalizeGender(frame["Gender"])),
+        ("race", lambda frame: normalizeRace(frame["Race"])),
+        ("ethnicity", lambda frame: normalizeEthnicity(frame["Ethnicity"])),
+        ("state", lambda frame: mapUnique(frame["State"], findStateAbbreviation)),
+        (
+            "phone",
+            lambda frame: mapUnique(
+                frame["Phone Number"],
+                lambda value: convertPhoneNumberToHL7(hl7StringRead(value)),
+            ),
+        ),
+        ("lot", lambda frame: normalizeLot(frame["Lot"])),
+        (
+            "expiration",
+            lambda frame: normalizeExpiration(frame["Expiration"], run.century_cutoff),
+        ),
+        (
+            "administered_date",
+            lambda frame: formatDates(
+                frame["Vaccine Administered Date/Time"], ADMINISTERED_FORMAT, "%Y%m%d"
+            ),
+        ),
+        ("route", lambda frame: mapUnique(frame["Injection Route"], getAdministration)),
+        ("site", lambda frame: mapUnique(frame["Administration Site"], getBodySite)),
+        ("normalizeFrame", lambda frame: normalizeFrame(frame, run)),
+    ]
+
+
+def timeCalls(func, items):
+    samples = []
+    failures = 0
+    for item in items:
+        started = time.perf_counter_ns()
+        try:
+            func(item)
+        except Exception:
+            failures += 1
+        samples.append(time.perf_counter_ns() - started)
+    return samples, failures
+
+
+# the fastest of repeat passes over items, as timeit does: slower passes measure
+# whatever else the machine was doing
+def bestPass(func, items, repeat):
+    passes = [timeCalls(func, items) for _ in range(repeat)]
+    return min(passes, key=lambda timed: sum(timed[0]))
+
+
+def summarize(samples, rows, failures=0):
+    summary = latencySummary(samples)
+    total_seconds = sum(samples) / 1e9
+    summary["rows_per_sec"] = rows / total_seconds if total_seconds else 0.0
+    summary["failures"] = failures
+    return summary
+
+
+def benchBuilders(records, run, label, repeat):
+    results = dict()
+    prepared = [prepareRecord(record, run) for record in records]
+    samples, _ = bestPass(lambda record: prepareRecord(record, run), records, repeat)
+    results[f"prepare/{label}"] = summarize(samples, len(records))
+    for name, build in BUILDERS:
+        timeCalls(build, prepared)
+        samples, failures = bestPass(build, prepared, repeat)
+        results[f"{name}/{label}"] = summarize(samples, len(prepared), failures)
+
+    def message(record):
+        hl7_string, failure = buildHL7Message(
+            record, CONTROL_NUMBER, MESSAGE_TIMESTAMP, run
+        )
+        if failure is not None:
+            raise ValueError(failure)
+        return hl7_string
+
+    samples, failures = bestPass(message, records, repeat)
+    results[f"message/{label}"] = summarize(samples, len(records), failures)
+    return results
+
+
+# per-row cost of each normalizer: chunk time / chunk rows, the fastest of repeat runs
+# for every chunk
+def benchNormalizers(frame, run, chunk_rows, repeat):
+    results = dict()
+    chunks = [
+        frame.iloc[start : start + chunk_rows]
+        for start in range(0, len(frame), chunk_rows)
+    ]
+    for name, normalize in normalizers(run):
+        normalize(chunks[0])
+        samples = []
+        for chunk in chunks:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter_ns()
+                normalize(chunk)
+                elapsed = time.perf_counter_ns() - started
+                best = elapsed if best is None else min(best, elapsed)
+            samples.append(best // len(chunk))
+        summary = latencySummary(samples)
+        summary["rows_per_sec"] = 1e6 / summary["mean_us"] if samples else 0.0
+        results[f"normalize/{name}"] = summary
+    return results
+
+
+def runMicro(rows=5000, dirty=0.1, chunk_rows=1000, repeat=5, seed=1):
+    run = startRun()
+    frame = pd.read_csv(BytesIO(syntheticCsvBytes(rows, dirty, seed=seed)))
+    results = dict()
+    results.update(benchBuilders(rowRecords(frame), run, "raw", repeat))
+    normalized = rowRecords(normalizeFrame(frame, run))
+    results.update(benchBuilders(normalized, run, "normalized", repeat))
+    results.update(benchNormalizers(frame, run, chunk_rows, repeat))
+    return results
+
+
+def printResults(results):
+    print(f"{'benchmark':32} {'rows/s':>10} {'p50 us':>9} {'p99 us':>9} {'failed':>7}")
+    for name, summary in results.items():
+        print(
+            f"{name:32} {summary['rows_per_sec']:10.0f} {summary['p50_us']:9.2f}"
+            f" {summary['p99_us']:9.2f} {summary.get('failures', 0):7d}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dirty", type=float, default=0.1)
+    parser.add_argument("--chunk-rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    enterDeploymentDir(args.workdir)
+    results = runMicro(args.rows, args.dirty, args.chunk_rows, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printResults(results)
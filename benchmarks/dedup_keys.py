@@ -0,0 +1,68 @@
+# Checks that a row gets the same dedup key however its chunk was typed: one chunk with
+# a blank Patient ID (so pandas and the csv fast path read the IDs as floats) and one
+# without, read by both readers, and the legacy MessageLog.txt read with pandas.
+#
+#   python benchmarks/dedup_keys.py
+#
+# Exits 1 when any reader keys the row differently, so a CI job can run it as a check.
+import os
+import sys
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pandas as pd
+from csv_utils import readCsvChunks
+from dedup_utils import dedupKey
+
+PATIENT_ID = "123"
+VACCINE_DATE = "2021-03-04"
+INPUT_CSV = (
+    "Patient ID,Vaccine Administered Date\n"
+    f"{PATIENT_ID},{VACCINE_DATE}\n"
+    f"456,{VACCINE_DATE}\n"
+    f"{PATIENT_ID},{VACCINE_DATE}\n"
+    f",{VACCINE_DATE}\n"
+).encode("utf-8")
+MESSAGE_LOG = (
+    "Patient ID,HL7 Message,Vaccine Date,Error\n"
+    f"{PATIENT_ID},MSH|...,{VACCINE_DATE},\n"
+).encode("utf-8")
+
+
+# {reader: [key of the row in each chunk]}, chunks of two rows: the first without a
+# blank Patient ID, the second with one
+def inputKeys():
+    keys = {"pandas": [], "csv": []}
+    for chunk in pd.read_csv(BytesIO(INPUT_CSV), chunksize=2):
+        row = chunk.iloc[0]
+        keys["pandas"].append(
+            dedupKey(row["Patient ID"], row["Vaccine Administered Date"])
+        )
+    for records, _ in readCsvChunks(BytesIO(INPUT_CSV), 2):
+        record = records[0]
+        keys["csv"].append(
+            dedupKey(record["Patient ID"], record["Vaccine Administered Date"])
+        )
+    return keys
+
+
+def messageLogKey():
+    message_log = pd.read_csv(
+        BytesIO(MESSAGE_LOG), usecols=["Patient ID", "Vaccine Date"]
+    )
+    return dedupKey(message_log["Patient ID"][0], message_log["Vaccine Date"][0])
+
+
+if __name__ == "__main__":
+    expected = dedupKey(PATIENT_ID, VACCINE_DATE)
+    keys = dict(inputKeys(), message_log=[messageLogKey()])
+    mismatched = {
+        reader: found
+        for reader, found in keys.items()
+        if any(key != expected for key in found)
+    }
+    for reader, found in keys.items():
+        print(f"{reader:12} {'ok' if reader not in mismatched else found}")
+    if mismatched:
+        sys.exit(1)
@@ -0,0 +1,155 @@
+# End-to-end throughput of lambda_handler on a synthetic export (see synthetic.py), with
+# S3 replaced by an in-process MemoryS3 and uploads going over SSH to a local paramiko
+# SFTP server through the handler's own SFTPConnectionManager (see fakes.py).
+#
+#   python benchmarks/end_to_end.py [--rows N] [--dirty F] [--env KEY=VALUE ...]
+#                                   [--workdir DIR] [--json]
+#
+# Reports rows/sec over the whole invocation, per-row latencies (message generation,
+# and from a delivery being queued to its row being recorded) with the latency of each
+# SFTP upload, and the peak RSS of the process. Handler settings such as
+# HL7_BATCH_MODE=1 or CSV_FAST_PATH_MAX_BYTES go in --env. Run one scenario per process
+# so the peak memory belongs to it; suite.py does that. --workdir is an existing
+# directory holding the Lambda package's templates/, as for suite.py.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from measure import latencySummary, peakRssMb, enterDeploymentDir
+from synthetic import syntheticCsvBytes
+from fakes import MemoryS3, MemoryAws, LocalSFTPServer
+
+BUCKET = "benchmark"
+OBJECT_KEY = "texas-vax/input/synthetic.csv"
+
+
+# wraps module attribute name so every call appends its duration to samples
+def timeAttribute(module, name, samples):
+    original = getattr(module, name)
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter_ns()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter_ns() - started)
+
+    setattr(module, name, timed)
+
+
+def runEndToEnd(rows=5000, dirty=0.1, duplicates=0.0, env=None, seed=1):
+    os.environ.update(BUCKET_NAME=BUCKET, SECRET_NAME="benchmark")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    # dirty rows log an error each; keep the log off the clock unless asked for
+    os.environ.setdefault("POWERTOOLS_LOG_LEVEL", "CRITICAL")
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    os.environ.update(env or {})
+
+    import aws_utils
+    from sftp_utils import SFTPConnectionManager
+    from sink_utils import SFTPSink
+
+    s3 = MemoryS3()
+    aws_utils.boto3 = MemoryAws(s3)
+    import TexasHL7
+
+    sftp_root = tempfile.mkdtemp(prefix="sftp-")
+    server = LocalSFTPServer(sftp_root).start()
+    TexasHL7.sftp_connection = SFTPConnectionManager(
+        server.credentials, "127.0.0.1", server.port
+    )
+
+    generation = []
+    uploads = []
+    queued_at = dict()
+    delivery_latency = []
+    lock = threading.Lock()
+    timeAttribute(TexasHL7, "buildHL7Message", generation)
+    timeAttribute(SFTPSink, "write", uploads)
+
+    def stamped(build):
+        def queue(*args):
+            delivery = build(*args)
+            queued_at[id(delivery)] = time.perf_counter_ns()
+            return delivery
+
+        return queue
+
+    TexasHL7.messageDelivery = stamped(TexasHL7.messageDelivery)
+    TexasHL7.batchDelivery = stamped(TexasHL7.batchDelivery)
+    record = TexasHL7.recordDelivery
+
+    def recordDelivery(delivery):
+        record(delivery)
+        latency = time.perf_counter_ns() - queued_at.pop(id(delivery))
+        with lock:
+            delivery_latency.extend([latency] * len(delivery.records))
+
+    TexasHL7.recordDelivery = recordDelivery
+
+    s3.put_object(BUCKET, OBJECT_KEY, syntheticCsvBytes(rows, dirty, duplicates, seed))
+    event = {"Records": [{"s3": {"object": {"key": OBJECT_KEY}}}]}
+    try:
+        started = time.perf_counter()
+        response = TexasHL7.lambda_handler(event, None)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+    uploaded = len(server.uploaded())
+    shutil.rmtree(sftp_root, ignore_errors=True)
+
+    result = response["files"][0]
+    return {
+        "rows": rows,
+        "recorded_rows": result["rows"],
+        "failed_rows": result["failed_rows"],
+        "uploaded_files": uploaded,
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed,
+        "generation": latencySummary(generation),
+        "delivery": latencySummary(delivery_latency),
+        "sftp_upload": latencySummary(uploads),
+        "peak_rss_mb": peakRssMb(),
+    }
+
+
+def printResult(result):
+    print(
+        f"{result['rows']} rows in {result['seconds']:.2f} s: "
+        f"{result['rows_per_sec']:.0f} rows/s, {result['uploaded_files']} files "
+        f"uploaded, {result['failed_rows']} rows failed, "
+        f"peak RSS {result['peak_rss_mb']:.0f} MB"
+    )
+    for name in ("generation", "delivery", "sftp_upload"):
+        summary = result[name]
+        print(
+            f"  {name:12} p50 {summary['p50_us']:10.1f} us   "
+            f"p99 {summary['p99_us']:10.1f} us   ({summary['count']} samples)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dirty", type=float, default=0.1)
+    parser.add_argument("--duplicates", type=float, default=0.0)
+    parser.add_argument("--env", nargs="*", default=[])
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    enterDeploymentDir(args.workdir)
+    env = dict(setting.split("=", 1) for setting in args.env)
+    result = runEndToEnd(args.rows, args.dirty, args.duplicates, env)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        printResult(result)
@@ -0,0 +1,200 @@
+# Local stand-ins for the services the handler talks to, so an end-to-end benchmark
+# measures our code and a real SFTP round trip rather than the network:
+#
+# - MemoryS3: an in-process S3 client with the calls the handler makes, conditional
+#   PUTs included
+# - LocalSFTPServer: a paramiko SFTP server on 127.0.0.1 that writes uploads to a
+#   directory, reached through the handler's own SFTPConnectionManager
+import os
+import socket
+import hashlib
+import threading
+from io import BytesIO
+import paramiko
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class PreconditionFailed(Exception):
+    response = {"Error": {"Code": "PreconditionFailed"}}
+
+
+class MemoryS3:
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = dict()
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == "*" and current is not None:
+                raise PreconditionFailed(Key)
+            if IfMatch is not None and (current is None or IfMatch != etagOf(current)):
+                raise PreconditionFailed(Key)
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {"ETag": etagOf(Body)}
+
+    def _get(self, Bucket, Key):
+        try:
+            return self.objects[(Bucket, Key)]
+        except KeyError:
+            raise NoSuchKey(Key)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self._get(Bucket, Key)
+        return {"ETag": etagOf(data), "ContentLength": len(data)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self._get(Bucket, Key)
+        etag = etagOf(data)
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": BytesIO(data), "ETag": etag, "ContentLength": len(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete["Objects"]:
+            self.delete_object(Bucket, item["Key"])
+
+    def get_paginator(self, operation):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=""):
+                with s3._lock:
+                    keys = sorted(
+                        key
+                        for bucket, key in s3.objects
+                        if bucket == Bucket and key.startswith(Prefix)
+                    )
+                yield {"Contents": [{"Key": key} for key in keys]}
+
+        return Paginator()
+
+
+def etagOf(data):
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+# stands in for boto3 in aws_utils
+class MemoryAws:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def client(self, service, region_name=None, config=None):
+        return self.s3
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.username, self.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.writefile.fileno()))
+
+
+# maps every remote path under root, creating directories as uploads need them
+def _sftpInterface(root):
+    class Interface(paramiko.SFTPServerInterface):
+        def _local(self, path):
+            return os.path.join(root, path.lstrip("/"))
+
+        def open(self, path, flags, attr):
+            local = self._local(path)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            handle = _Handle(flags)
+            handle.writefile = handle.readfile = open(local, "w+b")
+            return handle
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+            except OSError as ex:
+                return paramiko.SFTPServer.convert_errno(ex.errno)
+
+        lstat = stat
+
+        def canonicalize(self, path):
+            return "/" + path.lstrip("/")
+
+    return Interface
+
+
+# An SFTP server on 127.0.0.1 (a free port) accepting one username/password and
+# writing uploads under root. Each connection is served on its own thread.
+class LocalSFTPServer:
+    def __init__(self, root, username="bench", password="bench"):
+        self.root = root
+        self.username = username
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", 0))
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._socket.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, _sftpInterface(self.root)
+            )
+            transport.start_server(server=_Server(self.username, self.password))
+            self._transports.append(transport)
+
+    def credentials(self):
+        return self.username, self.password
+
+    def uploaded(self):
+        return [
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(self.root)
+            for name in names
+        ]
+
+    def stop(self):
+        self._stopped.set()
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
@@ -0,0 +1,49 @@
+# Shared helpers for the benchmark scripts: latency percentiles and peak memory.
+import os
+import sys
+import resource
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    position = min(
+        len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1)))
+    )
+    return sorted_samples[position]
+
+
+# p50/p99/max/mean of a list of per-item durations in nanoseconds, in microseconds
+def latencySummary(samples_ns):
+    ordered = sorted(samples_ns)
+    count = len(ordered)
+    return {
+        "count": count,
+        "p50_us": percentile(ordered, 0.50) / 1000,
+        "p99_us": percentile(ordered, 0.99) / 1000,
+        "max_us": (ordered[-1] if ordered else 0) / 1000,
+        "mean_us": (sum(ordered) / count if count else 0) / 1000,
+    }
+
+
+# the high-water mark of this process's resident memory in MB (ru_maxrss is KB on
+# Linux and bytes on macOS)
+def peakRssMb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+# the handler reads its templates from templates/ under the working directory, as in
+# the Lambda package; the benchmarks run from workdir (default: where they are started)
+def enterDeploymentDir(workdir=None):
+    if workdir:
+        if not os.path.isdir(workdir):
+            raise SystemExit(f"--workdir {workdir} is not an existing directory")
+        os.chdir(workdir)
+    if not os.path.isdir("templates"):
+        raise SystemExit(
+            f"no templates/ in {os.getcwd()}; run from the deployment directory or "
+            "pass --workdir"
+        )
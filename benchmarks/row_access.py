@@ -0,0 +1,99 @@
+# Per-row cost of handing a row to the segment builders: a pandas Series from
+# DataFrame.iloc, as processRows used to, against segment_utils.RowRecord.
+#
+#   python benchmarks/row_access.py [rows]
+#
+# Each variant materialises every row and reads the columns the builders read, so the
+# difference is the overhead the record type adds per row before any HL7 work.
+import os
+import sys
+import time
+import random
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from segment_utils import rowRecords
+
+# every column createXXXBlock reads from a row
+BUILDER_COLUMNS = [
+    "Patient ID",
+    "Last Name",
+    "First Name",
+    "Middle Initial",
+    "Date of Birth",
+    "Gender",
+    "Race",
+    "Street Address",
+    "City",
+    "State",
+    "Zip Code",
+    "Phone Number",
+    "Ethnicity",
+    "Medical Professional",
+    "Patient Checked in By",
+    "Appointment Service Name",
+    "Manufacturer",
+    "Age",
+    "Lot",
+    "Expiration",
+    "Vaccine Administered Date/Time",
+    "Injection Route",
+    "Administration Site",
+    "Appointment Location Name",
+]
+LOOP_COLUMNS = ["Vaccine_State", "Patient ID", "Vaccine Administered Date"]
+
+
+def syntheticFrame(rows, seed=1):
+    rng = random.Random(seed)
+    data = {
+        column: [f"{column} {rng.randint(0, 99)}" for _ in range(rows)]
+        for column in BUILDER_COLUMNS
+    }
+    data["Age"] = [rng.randint(5, 90) for _ in range(rows)]
+    data["Vaccine_State"] = [rng.choice(["TX", "OK"]) for _ in range(rows)]
+    data["Vaccine Administered Date"] = ["2022-01-01"] * rows
+    return pd.DataFrame(data)
+
+
+def readColumns(record):
+    for column in LOOP_COLUMNS:
+        record[column]
+    for column in BUILDER_COLUMNS:
+        record[column]
+
+
+def viaIloc(input_data):
+    for position in range(len(input_data)):
+        readColumns(input_data.iloc[position])
+
+
+def viaRowRecords(input_data):
+    for record in rowRecords(input_data):
+        readColumns(record)
+
+
+def timeRows(func, input_data, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(input_data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(input_data) * 1e6
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    input_data = syntheticFrame(rows)
+    iloc_us = timeRows(viaIloc, input_data)
+    record_us = timeRows(viaRowRecords, input_data)
+    print(
+        f"rows: {rows}, columns read per row: {len(BUILDER_COLUMNS) + len(LOOP_COLUMNS)}"
+    )
+    print(f"iloc Series: {iloc_us:8.2f} us/row")
+    print(f"RowRecord:   {record_us:8.2f} us/row")
+    print(
+        f"saved:       {iloc_us - record_us:8.2f} us/row ({iloc_us / record_us:.1f}x)"
+    )
@@ -0,0 +1,84 @@
+# Cold-start cost of the Lambda module: imports TexasHL7 in fresh interpreters under
+# python -X importtime and reports the cumulative import time, with deferred imports
+# (the default) and with LAZY_IMPORTS=0.
+#
+#   python benchmarks/startup.py [--runs N] [--top N] [--budget-ms MS]
+#
+# With --budget-ms the script exits 1 when the median lazy import time is over budget,
+# so a CI job can run it as a check and keep the cold start from creeping back up.
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HANDLER_MODULE = "TexasHL7"
+
+
+# {module: (self us, cumulative us)} from the stderr of python -X importtime
+def parseImportTimes(stderr):
+    times = dict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def importOnce(lazy):
+    env = dict(os.environ, LAZY_IMPORTS="1" if lazy else "0")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {HANDLER_MODULE}"],
+        cwd=PACKAGE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parseImportTimes(completed.stderr)
+
+
+def measure(lazy, runs):
+    samples = [importOnce(lazy) for _ in range(runs)]
+    totals = [sample[HANDLER_MODULE][1] / 1000 for sample in samples]
+    return statistics.median(totals), samples[-1]
+
+
+# the heaviest modules imported directly by the handler's own modules
+def heaviest(times, top):
+    local = {
+        name[: -len(".py")] for name in os.listdir(PACKAGE_DIR) if name.endswith(".py")
+    }
+    first_level = {
+        name: cumulative
+        for name, (_, cumulative) in times.items()
+        if "." not in name and name not in local
+    }
+    return sorted(first_level.items(), key=lambda item: -item[1])[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    lazy_ms, lazy_times = measure(True, args.runs)
+    eager_ms = measure(False, args.runs)[0]
+    print(f"import {HANDLER_MODULE}, median of {args.runs} fresh interpreters")
+    print(f"  deferred imports (default): {lazy_ms:8.1f} ms")
+    print(f"  LAZY_IMPORTS=0:             {eager_ms:8.1f} ms")
+    # modules imported through importlib.import_module are not itemised by importtime,
+    # so only the deferred run gives a useful breakdown of what is still on the path
+    print("heaviest top-level imports still on the cold path:")
+    for name, cumulative in heaviest(lazy_times, args.top):
+        print(f"  {name:28} {cumulative / 1000:8.1f} ms")
+
+    if args.budget_ms is not None and lazy_ms > args.budget_ms:
+        print(f"FAIL: {lazy_ms:.1f} ms is over the {args.budget_ms:.1f} ms budget")
+        sys.exit(1)
@@ -0,0 +1,190 @@
+# Runs the builder/normalizer micro-benchmarks and the end-to-end scenarios, each
+# end-to-end scenario in a fresh interpreter, and writes or checks a baseline.
+#
+#   python benchmarks/suite.py [--workdir DIR] [--write-baseline [PATH]]
+#                              [--compare [PATH]] [--tolerance 0.25] [--runs 5]
+#
+# --workdir names an existing directory holding the Lambda package's templates/ (msh.txt
+# and the other segment templates), which this repository does not include; the
+# benchmarks run from it and write nothing there. Without --workdir they run from the
+# current directory, which must hold templates/ instead.
+#
+# PATH defaults to benchmarks/baseline.json. --write-baseline stores the results (and
+# the machine they came from) as JSON. --compare checks the current run against such a
+# file and exits 1 when any tracked metric is worse by more than the tolerance: lower
+# rows/sec, or higher p50/p99 latency or peak memory. Numbers are only comparable on
+# the same kind of machine, so a baseline records its environment and the comparison
+# warns when it differs. Each metric is the best of --runs runs of the whole suite,
+# both in a baseline and when comparing: on a shared machine a single run can come out
+# twice as slow as the next for seconds at a time, more than any tolerance could cover.
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from measure import enterDeploymentDir
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# name -> handler settings
+E2E_SCENARIOS = {
+    "per_message": {},
+    "batch": {"HL7_BATCH_MODE": "1"},
+    "fast_path": {"CSV_FAST_PATH_MAX_BYTES": str(1 << 30)},
+}
+# metric -> True when higher is better
+TRACKED = {
+    "rows_per_sec": True,
+    "p50_us": False,
+    "p99_us": False,
+    "peak_rss_mb": False,
+}
+
+
+def environment():
+    import pandas
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "pandas": pandas.__version__,
+    }
+
+
+def runScenario(settings, rows, dirty):
+    command = [
+        sys.executable,
+        os.path.join(BENCHMARK_DIR, "end_to_end.py"),
+        "--rows",
+        str(rows),
+        "--dirty",
+        str(dirty),
+        "--json",
+        "--env",
+    ] + [f"{key}={value}" for key, value in settings.items()]
+    completed = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# {benchmark name: {metric: value}} with only the metrics the baseline tracks
+def flatten(micro, end_to_end):
+    metrics = dict()
+    for name, summary in micro.items():
+        metrics[f"micro/{name}"] = {
+            "rows_per_sec": summary["rows_per_sec"],
+            "p50_us": summary["p50_us"],
+        }
+    for name, result in end_to_end.items():
+        metrics[f"e2e/{name}"] = {
+            "rows_per_sec": result["rows_per_sec"],
+            "peak_rss_mb": result["peak_rss_mb"],
+        }
+        for stage in ("generation", "delivery"):
+            metrics[f"e2e/{name}/{stage}"] = {
+                "p50_us": result[stage]["p50_us"],
+                "p99_us": result[stage]["p99_us"],
+            }
+    return metrics
+
+
+# the best value of every metric over several runs' flatten() results
+def bestOf(runs):
+    best = dict()
+    for metrics in runs:
+        for name, values in metrics.items():
+            for metric, value in values.items():
+                current = best.setdefault(name, dict()).get(metric)
+                if current is None:
+                    best[name][metric] = value
+                elif TRACKED[metric]:
+                    best[name][metric] = max(current, value)
+                else:
+                    best[name][metric] = min(current, value)
+    return best
+
+
+# (name, metric, baseline, current, change) for every metric worse than tolerance
+def regressions(baseline, metrics, tolerance):
+    found = []
+    for name, values in metrics.items():
+        for metric, current in values.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before:
+                continue
+            change = (current - before) / before
+            worse = -change if TRACKED[metric] else change
+            if worse > tolerance:
+                found.append((name, metric, before, current, change))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--micro-rows", type=int, default=5000)
+    parser.add_argument("--e2e-rows", type=int, default=2000)
+    parser.add_argument("--dirty", type=float, default=0.1)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--write-baseline", nargs="?", const=DEFAULT_BASELINE)
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    enterDeploymentDir(args.workdir)
+    from builders import runMicro, printResults
+
+    runs = []
+    for run in range(max(1, args.runs)):
+        print(f"run {run + 1} of {max(1, args.runs)}")
+        micro = runMicro(args.micro_rows, args.dirty)
+        printResults(micro)
+        end_to_end = dict()
+        for name, settings in E2E_SCENARIOS.items():
+            end_to_end[name] = runScenario(settings, args.e2e_rows, args.dirty)
+            result = end_to_end[name]
+            print(
+                f"e2e/{name:12} {result['rows_per_sec']:8.0f} rows/s   "
+                f"delivery p50 {result['delivery']['p50_us'] / 1000:8.1f} ms   "
+                f"p99 {result['delivery']['p99_us'] / 1000:8.1f} ms   "
+                f"peak RSS {result['peak_rss_mb']:6.0f} MB"
+            )
+        runs.append(flatten(micro, end_to_end))
+    metrics = bestOf(runs)
+
+    if args.write_baseline:
+        baseline = {
+            "environment": environment(),
+            "settings": {
+                "micro_rows": args.micro_rows,
+                "e2e_rows": args.e2e_rows,
+                "dirty": args.dirty,
+                "runs": max(1, args.runs),
+            },
+            "metrics": metrics,
+        }
+        with open(args.write_baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"baseline written to {args.write_baseline}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["environment"] != environment():
+            print("warning: baseline was recorded on a different environment")
+        found = regressions(baseline["metrics"], metrics, args.tolerance)
+        for name, metric, before, current, change in found:
+            print(
+                f"REGRESSION {name} {metric}: "
+                f"{before:.1f} -> {current:.1f} ({change:+.0%})"
+            )
+        if found:
+            sys.exit(1)
+        print(f"no regressions beyond {args.tolerance:.0%} against {args.compare}")
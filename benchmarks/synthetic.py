@@ -0,0 +1,165 @@
+# Synthetic clinic exports for the benchmarks: the columns the clinic CSV has, with
+# realistic values, in any size, and with a share of "dirty" rows carrying the messy
+# values real exports have (spelled-out or lower-case states, odd phone formats, free
+# text routes and sites, missing cells, unparseable dates, unknown products).
+#
+#   python benchmarks/synthetic.py <rows> [--dirty 0.1] [--duplicates 0.0] [--seed 1]
+#
+# writes the CSV to stdout. The same seed always gives the same file.
+import io
+import sys
+import csv
+import random
+import argparse
+
+EXPORT_COLUMNS = [
+    "Patient ID",
+    "Last Name",
+    "First Name",
+    "Middle Initial",
+    "Date of Birth",
+    "Gender",
+    "Race",
+    "Street Address",
+    "City",
+    "State",
+    "Zip Code",
+    "Phone Number",
+    "Ethnicity",
+    "Medical Professional",
+    "Patient Checked in By",
+    "Appointment Service Name",
+    "Manufacturer",
+    "Age",
+    "Lot",
+    "Expiration",
+    "Vaccine Administered Date/Time",
+    "Vaccine Administered Date",
+    "Injection Route",
+    "Administration Site",
+    "Appointment Location Name",
+    "Vaccine_State",
+]
+
+LAST_NAMES = ["Garcia", "Smith", "Nguyen", "Johnson", "Lopez", "Williams", "Patel"]
+FIRST_NAMES = ["Maria", "James", "Linh", "Robert", "Ana", "Mary", "Ravi", "Jose"]
+CITIES = [("Austin", "78701"), ("Houston", "77002"), ("Tulsa", "74103")]
+CLINICIANS = ["John Smith", "Ann Lee", "Carlos Ruiz", "Priya Shah"]
+STAFF = ["Front Desk", "Kim Tran", "Sam Ortiz"]
+LOCATIONS = ["Austin Clinic", "Houston Clinic", "Tulsa Clinic"]
+# (service name, manufacturer, lot prefix)
+PRODUCTS = [
+    ("COVID-19 Vaccine (Pfizer)", "Pfizer", "FK"),
+    ("COVID-19 Booster (Moderna)", "Moderna", "0A"),
+    ("COVID-19 Vaccine (Janssen)", "Janssen", "JJ"),
+    ("Flu Shot", "Afluria Quadrivalent", "AF"),
+    ("Flu Shot 65+", "Fluad Quadrivalent", "FL"),
+    ("Monkeypox Vaccine", "JYNNEOS", "MX"),
+]
+GENDERS = ["Male", "Female", "Nonbinary", "Transgender", "Other"]
+RACES = ["White", "Asian", "Black or African American", "Alaska Native", "Other"]
+ETHNICITIES = ["Not Hispanic or Latino", "Hispanic or Latino"]
+ROUTES = ["Intramuscular", "Subcutaneous", "Intradermal"]
+SITES = ["Left Deltoid", "Right Deltoid", "Left Thigh", "Right Thigh"]
+
+# values a dirty row gets in one of its columns
+DIRTY_VALUES = {
+    "State": ["texas", "Oklahoma", " TX ", "Tex.", ""],
+    "Phone Number": ["512.555.0134", "+1 (512) 555 0134", "555-0134", "n/a", ""],
+    "Gender": ["m", "F", "unknown", ""],
+    "Race": ["white", "Pacific Islander", "Declined", ""],
+    "Ethnicity": ["latino", "Declined", ""],
+    "Injection Route": ["IM", "intramusc", "oral", ""],
+    "Administration Site": ["left arm", "deltoid", "R thigh", ""],
+    "Manufacturer": ["PFR", "MOD", "J&J", "Unknown", ""],
+    "Appointment Service Name": ["", "Walk-in"],
+    "Lot": ["Pfizer - FK1234", "lot: EW0150", ""],
+    "Expiration": ["12/31/99", "2023-01-15", ""],
+    "Date of Birth": ["01/02/1980", "1980-13-40", ""],
+    "Vaccine Administered Date/Time": ["2022-06-12 11:38", ""],
+    "Medical Professional": ["Cher", ""],
+    "Zip Code": ["787O1", ""],
+}
+
+
+def cleanRow(rng, number):
+    last_name = rng.choice(LAST_NAMES)
+    city, zip_code = rng.choice(CITIES)
+    service, manufacturer, lot_prefix = rng.choice(PRODUCTS)
+    administered = (
+        f"2022-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        f"T{rng.randint(8, 17):02d}:{rng.randint(0, 59):02d}Z"
+    )
+    state = "OK" if city == "Tulsa" else "TX"
+    return {
+        "Patient ID": f"P{number:08d}",
+        "Last Name": last_name,
+        "First Name": rng.choice(FIRST_NAMES),
+        "Middle Initial": rng.choice(["", "A", "J", "M"]),
+        "Date of Birth": (
+            f"{rng.randint(1935, 2016)}-{rng.randint(1, 12):02d}"
+            f"-{rng.randint(1, 28):02d}"
+        ),
+        "Gender": rng.choice(GENDERS),
+        "Race": rng.choice(RACES),
+        "Street Address": f"{rng.randint(1, 9999)} Main St",
+        "City": city,
+        "State": state,
+        "Zip Code": zip_code,
+        "Phone Number": f"({rng.randint(200, 999)}) 555-{rng.randint(0, 9999):04d}",
+        "Ethnicity": rng.choice(ETHNICITIES),
+        "Medical Professional": rng.choice(CLINICIANS),
+        "Patient Checked in By": rng.choice(STAFF),
+        "Appointment Service Name": service,
+        "Manufacturer": manufacturer,
+        "Age": rng.randint(5, 90),
+        "Lot": f"{lot_prefix}{rng.randint(1000, 9999)}",
+        "Expiration": f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/23",
+        "Vaccine Administered Date/Time": administered,
+        "Vaccine Administered Date": administered[:10],
+        "Injection Route": rng.choice(ROUTES),
+        "Administration Site": rng.choice(SITES),
+        "Appointment Location Name": rng.choice(LOCATIONS),
+        "Vaccine_State": state,
+    }
+
+
+# yields rows as lists in EXPORT_COLUMNS order. dirty is the share of rows with one or
+# two messy cells, duplicates the share of rows repeating an earlier (Patient ID,
+# Vaccine Administered Date) pair, as re-sent rows do
+def syntheticRows(rows, dirty=0.0, duplicates=0.0, seed=1):
+    rng = random.Random(seed)
+    earlier = []
+    for number in range(rows):
+        if earlier and rng.random() < duplicates:
+            row = dict(rng.choice(earlier))
+        else:
+            row = cleanRow(rng, number)
+            if rng.random() < dirty:
+                for column in rng.sample(sorted(DIRTY_VALUES), rng.randint(1, 2)):
+                    row[column] = rng.choice(DIRTY_VALUES[column])
+            if len(earlier) < 1000:
+                earlier.append(row)
+        yield [row[column] for column in EXPORT_COLUMNS]
+
+
+def writeSyntheticCsv(out, rows, dirty=0.0, duplicates=0.0, seed=1):
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(syntheticRows(rows, dirty, duplicates, seed))
+
+
+def syntheticCsvBytes(rows, dirty=0.0, duplicates=0.0, seed=1):
+    out = io.StringIO()
+    writeSyntheticCsv(out, rows, dirty, duplicates, seed)
+    return out.getvalue().encode("utf-8")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--dirty", type=float, default=0.0)
+    parser.add_argument("--duplicates", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    writeSyntheticCsv(sys.stdout, args.rows, args.dirty, args.duplicates, args.seed)
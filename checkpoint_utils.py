@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from aws_utils import awsClient
+
+CHECKPOINT_PREFIX = "texas-vax/checkpoints/"
+CHECKPOINT_EVENT_KEY = "checkpoint"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+def checkpointKey(object_key):
+    digest = hashlib.sha1(object_key.encode("utf-8")).hexdigest()
+    return CHECKPOINT_PREFIX + digest + ".json"
+
+
+# the event that continues a file from its checkpoint. It keeps the original S3 record
+# so the handler reads the same object, and a local stand-in can build and pass the same
+# dict to lambda_handler instead of a real asynchronous invoke
+def continuationEvent(object_key, checkpoint_key):
+    return {
+        "Records": [{"s3": {"object": {"key": object_key}}}],
+        CHECKPOINT_EVENT_KEY: {"key": checkpoint_key},
+    }
+
+
+def invokeSelf(context, event):
+    awsClient("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(event).encode("utf-8"),
+    )
+
+
+# Records how far into an input object a run got (object key, ETag and the number of
+# data rows already handled) so that a run which hits the time budget can hand the rest
+# of the file to a fresh invocation. retrigger is called with (context, event); it
+# defaults to an asynchronous self-invoke and can be replaced by a local stand-in.
+# name keys the checkpoint when one object has several (one per shard), and
+# continuation, given the checkpoint key, builds the event that resumes the work.
+class Checkpointer:
+    def __init__(
+        self, s3, bucket, object_key, etag, retrigger=None, name=None, continuation=None
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.object_key = object_key
+        self.etag = etag
+        self.key = checkpointKey(name or object_key)
+        self.retrigger = retrigger or invokeSelf
+        self.continuation = continuation or (
+            lambda key: continuationEvent(object_key, key)
+        )
+
+    # returns (row cursor, file index offset) to resume from, (0, 0) for a fresh start.
+    # A checkpoint written for a different version of the object is discarded
+    def load(self):
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            return 0, 0
+        checkpoint = json.loads(body)
+        if checkpoint["etag"] != self.etag or checkpoint["object_key"] != self.object_key:
+            logger.info("Input object changed since its checkpoint, starting over.")
+            self.clear()
+            return 0, 0
+        logger.info(f"Resuming {self.object_key} at row {checkpoint['cursor']}")
+        return checkpoint["cursor"], checkpoint["index_offset"]
+
+    def save(self, cursor, index_offset):
+        checkpoint = {
+            "object_key": self.object_key,
+            "etag": self.etag,
+            "cursor": cursor,
+            "index_offset": index_offset,
+            "saved_at": datetime.utcnow().isoformat(),
+        }
+        self.s3.put_object(
+            Bucket=self.bucket, Key=self.key, Body=json.dumps(checkpoint).encode("utf-8")
+        )
+
+    def clear(self):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.key)
+
+    # saves the cursor and hands the rest of the file to another invocation, unless
+    # CHECKPOINT_RETRIGGER is "none", in which case the checkpoint waits for a manual
+    # or local re-run
+    def handOff(self, context, cursor, index_offset):
+        self.save(cursor, index_offset)
+        if os.environ.get("CHECKPOINT_RETRIGGER", "lambda").lower() == "none":
+            logger.info(f"Checkpoint saved at row {cursor}, not re-triggering.")
+            return None
+        event = self.continuation(self.key)
+        self.retrigger(context, event)
+        logger.info(f"Checkpoint saved at row {cursor}, continuation triggered.")
+        return event
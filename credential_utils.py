@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+from aws_lambda_powertools import Logger
+from lazy_utils import lazyImport
+
+boto3 = lazyImport("boto3")
+botocore_exceptions = lazyImport("botocore.exceptions")
+
+DEFAULT_SECRET_TTL = 900
+DEFAULT_REFRESH_MARGIN = 60
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# Caches the SFTP username/password pair from Secrets Manager in memory. The secret is
+# fetched once, reused across warm invocations until SECRET_CACHE_TTL seconds have
+# passed, and refreshed on a background thread once it is within
+# SECRET_REFRESH_MARGIN seconds of expiring so callers never wait on the refresh.
+class CachedCredentialProvider:
+    def __init__(self, secret_name=None, region_name=None, ttl=None, refresh_margin=None):
+        self.secret_name = secret_name or os.environ.get("SECRET_NAME")
+        self.region_name = region_name or os.environ.get("AWS_REGION")
+        if ttl is None:
+            ttl = float(os.environ.get("SECRET_CACHE_TTL", DEFAULT_SECRET_TTL))
+        if refresh_margin is None:
+            refresh_margin = float(
+                os.environ.get("SECRET_REFRESH_MARGIN", DEFAULT_REFRESH_MARGIN)
+            )
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self._client = None
+        self._credentials = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _secrets_client(self):
+        if self._client is None:
+            self._client = boto3.session.Session().client(
+                service_name="secretsmanager", region_name=self.region_name
+            )
+        return self._client
+
+    def _fetch(self):
+        try:
+            response = self._secrets_client().get_secret_value(
+                SecretId=self.secret_name
+            )
+        except botocore_exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "ResourceNotFoundException":
+                logger.info("The requested secret was not found")
+            elif ex.response["Error"]["Code"] == "InvalidRequestException":
+                logger.info(f"The request was invalid due to: {ex}")
+            elif ex.response["Error"]["Code"] == "InvalidParameterException":
+                logger.info(f"The request had invalid params: {ex}")
+            raise
+        # Secrets Manager decrypts the secret value using the associated KMS CMK
+        credentials = json.loads(response["SecretString"])
+        return credentials["username"], credentials["password"]
+
+    def _store(self, credentials):
+        self._credentials = credentials
+        self._expires_at = time.monotonic() + self.ttl
+
+    def _background_refresh(self):
+        try:
+            credentials = self._fetch()
+            with self._lock:
+                self._store(credentials)
+        except Exception as ex:
+            logger.info(f"Background secret refresh failed, keeping cached value. {ex}")
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._credentials is None or now >= self._expires_at:
+                self._store(self._fetch())
+            elif now >= self._expires_at - self.refresh_margin and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._background_refresh, daemon=True).start()
+            return self._credentials
+
+    # forgets the cached secret, e.g. after the server rejected it following a rotation
+    def invalidate(self):
+        with self._lock:
+            self._credentials = None
+            self._expires_at = 0.0
+
+    def __call__(self):
+        return self.get()
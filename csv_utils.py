@@ -0,0 +1,106 @@
+import os
+import re
+import csv
+import io
+from segment_utils import RowRecord, recordFields
+
+# files up to this many bytes are read with the csv module instead of pandas; 0 (the
+# default) always uses pandas
+DEFAULT_FAST_PATH_MAX_BYTES = 0
+
+# pandas' default na_values as of the pinned pandas 1.1 ("None" was only added in 2.0)
+NA_VALUES = frozenset(
+    [
+        "",
+        "#N/A",
+        "#N/A N/A",
+        "#NA",
+        "-1.#IND",
+        "-1.#QNAN",
+        "-NaN",
+        "-nan",
+        "1.#IND",
+        "1.#QNAN",
+        "<NA>",
+        "N/A",
+        "NA",
+        "NULL",
+        "NaN",
+        "n/a",
+        "nan",
+        "null",
+    ]
+)
+TRUE_VALUES = frozenset(["True", "TRUE", "true"])
+FALSE_VALUES = frozenset(["False", "FALSE", "false"])
+INT_PATTERN = re.compile(r"[+-]?\d+\Z")
+FLOAT_PATTERN = re.compile(
+    r"[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|inf|infinity)\Z", re.IGNORECASE
+)
+
+
+def fastPathMaxBytes():
+    return int(os.environ.get("CSV_FAST_PATH_MAX_BYTES", DEFAULT_FAST_PATH_MAX_BYTES))
+
+
+def useFastPath(content_length):
+    return content_length is not None and content_length <= fastPathMaxBytes()
+
+
+# Converts one column of raw strings the way pandas.read_csv infers its dtype: all ints
+# stay int unless a value is missing (then float), all numbers become float, all
+# booleans become bool, anything else stays str. Missing values are float("nan"), as
+# pandas returns them from itertuples, so the builders see the same Python values
+# whichever reader produced the row.
+def inferColumn(values):
+    present = [value for value in values if value not in NA_VALUES]
+    missing = len(present) < len(values)
+    stripped = [value.strip() for value in present]
+    if present and all(INT_PATTERN.match(value) for value in stripped):
+        convert = float if missing else int
+    elif present and all(FLOAT_PATTERN.match(value) for value in stripped):
+        convert = float
+    elif present and all(
+        value in TRUE_VALUES or value in FALSE_VALUES for value in stripped
+    ):
+        convert = lambda value: value.strip() in TRUE_VALUES
+    else:
+        convert = str
+    nan = float("nan")
+    return [nan if value in NA_VALUES else convert(value) for value in values]
+
+
+class EmptyCsvError(ValueError):
+    pass
+
+
+# Reads a (small) CSV body into RowRecords without pandas, in the same chunks and with
+# the same per-chunk type inference as TexasHL7.readInputChunks. skip_rows data rows
+# after the header are skipped. Yields (records, row numbers counted from the first row
+# read) per chunk; a blank file raises EmptyCsvError where pandas raises EmptyDataError
+def readCsvChunks(body, chunk_rows, skip_rows=0):
+    # the whole body is small enough to decode at once, and a botocore StreamingBody
+    # cannot be wrapped in a TextIOWrapper on the pinned version
+    reader = csv.reader(io.StringIO(body.read().decode("utf-8-sig"), newline=""))
+    header = next(reader, None)
+    if header is None:
+        raise EmptyCsvError("No columns to parse from file")
+    fields = recordFields(header)
+    rows = []
+    for row in reader:
+        if not row:
+            continue
+        if len(row) > len(header):
+            raise ValueError(
+                f"Expected {len(header)} fields in line {reader.line_num}, saw {len(row)}"
+            )
+        rows.append(row + [""] * (len(header) - len(row)))
+    rows = rows[skip_rows:]
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start : start + chunk_rows]
+        columns = [
+            inferColumn([row[position] for row in chunk])
+            for position in range(len(header))
+        ]
+        records = [RowRecord(values, fields) for values in zip(*columns)]
+        yield records, list(range(start, start + len(records)))
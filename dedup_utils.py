@@ -0,0 +1,159 @@
+import math
+import time
+import random
+import hashlib
+from io import BytesIO
+from aws_lambda_powertools import Logger
+from lazy_utils import lazyImport
+from aws_utils import conditionalPut, isConditionConflict
+from metrics_utils import count
+
+np = lazyImport("numpy")
+pd = lazyImport("pandas")
+
+DEDUP_INDEX_KEY = "texas-vax/dedup-index.npy"
+MESSAGE_LOG_KEY = "texas-vax/MessageLog.txt"
+MAX_SAVE_ATTEMPTS = 20
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# The text a value is keyed by. Columns are typed per chunk, so a numeric Patient ID is
+# 123 in a chunk without blanks and 123.0 in one with a blank; integral floats are keyed
+# as the integer so both give the same key, as they compared equal before the index
+def dedupValue(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+# 64-bit key for a (Patient ID, Vaccine Date) pair. blake2b rather than hash() so the
+# persisted keys stay the same across processes and Python versions
+def dedupKey(patient_id, vaccine_date):
+    raw = f"{dedupValue(patient_id)}\x1f{dedupValue(vaccine_date)}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "little")
+
+
+def dedupKeys(patient_ids, vaccine_dates):
+    return np.fromiter(
+        (dedupKey(p, d) for p, d in zip(patient_ids, vaccine_dates)),
+        dtype=np.uint64,
+        count=len(patient_ids),
+    )
+
+
+# Sorted array of hashed (Patient ID, Vaccine Date) keys for every record already sent,
+# persisted to S3 as a single .npy object. It replaces scanning MessageLog.txt: a run
+# loads it with one GET, anti-joins the input against it and saves back only the keys
+# it added on top of whatever is in S3 at that point.
+class DedupIndex:
+    def __init__(self, keys=None):
+        if keys is None:
+            keys = np.empty(0, dtype=np.uint64)
+        self.keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        self._pending = []
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.keys) + len(self._pending)
+
+    def contains(self, hashed_keys):
+        hashed_keys = np.asarray(hashed_keys, dtype=np.uint64)
+        if not len(self.keys):
+            return np.zeros(len(hashed_keys), dtype=bool)
+        positions = np.searchsorted(self.keys, hashed_keys)
+        positions[positions == len(self.keys)] = 0
+        return self.keys[positions] == hashed_keys
+
+    # returns the rows of input_df whose (id, date) pair has not been sent yet
+    def antiJoin(
+        self, input_df, id_column="Patient ID", date_column="Vaccine Administered Date"
+    ):
+        hashed_keys = dedupKeys(input_df[id_column], input_df[date_column])
+        return input_df[~self.contains(hashed_keys)]
+
+    # the same test for RowRecords read without pandas: one bool per record, True when
+    # its pair has been sent
+    def containsRecords(
+        self, records, id_column="Patient ID", date_column="Vaccine Administered Date"
+    ):
+        hashed_keys = dedupKeys(
+            [record[id_column] for record in records],
+            [record[date_column] for record in records],
+        )
+        return self.contains(hashed_keys).tolist()
+
+    def add(self, patient_id, vaccine_date):
+        self._pending.append(dedupKey(patient_id, vaccine_date))
+
+    def addMany(self, patient_ids, vaccine_dates):
+        self._pending.extend(dedupKeys(patient_ids, vaccine_dates).tolist())
+
+    # Merges the pending keys into the latest stored copy and writes it back with a
+    # conditional PUT on the ETag that copy was read with. Runs saving at the same time
+    # (the shards of an export) would otherwise drop each other's keys; the one that
+    # loses the race gets 412, reads the index again and merges once more
+    def save(self, s3, bucket, key=DEDUP_INDEX_KEY):
+        if not self._pending and not self._dirty:
+            return 0
+        added = np.asarray(self._pending, dtype=np.uint64)
+        for attempt in range(MAX_SAVE_ATTEMPTS):
+            stored, etag = loadIndexObject(s3, bucket, key)
+            keys = np.union1d(self.keys, added)
+            if stored is not None:
+                keys = np.union1d(keys, stored)
+            buffer = BytesIO()
+            np.save(buffer, keys, allow_pickle=False)
+            conditions = {"if_match": etag} if etag else {"if_none_match": "*"}
+            try:
+                conditionalPut(s3, bucket, key, buffer.getvalue(), **conditions)
+            except Exception as ex:
+                if not isConditionConflict(ex):
+                    raise
+                count("dedup.conflicts")
+                time.sleep(random.uniform(0, min(1.0, 0.05 * 2**attempt)))
+                continue
+            self.keys = keys
+            self._pending = []
+            self._dirty = False
+            return len(added)
+        raise RuntimeError(
+            f"Could not save the dedup index {key} after {MAX_SAVE_ATTEMPTS} attempts"
+        )
+
+
+# (keys, ETag) of the stored index, or (None, None) before the first save
+def loadIndexObject(s3, bucket, key=DEDUP_INDEX_KEY):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    keys = np.load(BytesIO(response["Body"].read()), allow_pickle=False)
+    return keys, response["ETag"]
+
+
+def loadIndexKeys(s3, bucket, key=DEDUP_INDEX_KEY):
+    return loadIndexObject(s3, bucket, key)[0]
+
+
+# builds the index from the legacy MessageLog.txt the first time it is missing
+def buildIndexFromMessageLog(s3, bucket, key=MESSAGE_LOG_KEY):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    except s3.exceptions.NoSuchKey:
+        return DedupIndex()
+    message_log = pd.read_csv(body, usecols=["Patient ID", "Vaccine Date"])
+    return DedupIndex(dedupKeys(message_log["Patient ID"], message_log["Vaccine Date"]))
+
+
+def loadDedupIndex(s3, bucket, key=DEDUP_INDEX_KEY):
+    keys = loadIndexKeys(s3, bucket, key)
+    if keys is not None:
+        return DedupIndex(keys)
+    logger.info("No dedup index found, building it from MessageLog.txt")
+    index = buildIndexFromMessageLog(s3, bucket)
+    index._dirty = True
+    return index
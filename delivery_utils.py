@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from aws_lambda_powertools import Logger
+from sink_utils import Sink
+from aws_utils import isMissingKey
+from metrics_utils import count, gauge, observe
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_CAP = 10.0
+DEFAULT_LATENCY_TARGET = 5.0
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_COOLDOWN = 30.0
+DELIVERED_PREFIX = "texas-vax/delivered/"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+def controllerSettings():
+    return {
+        "attempts": int(os.environ.get("SFTP_RETRY_ATTEMPTS", DEFAULT_RETRY_ATTEMPTS)),
+        "backoff_base": float(
+            os.environ.get("SFTP_BACKOFF_BASE", DEFAULT_BACKOFF_BASE)
+        ),
+        "backoff_cap": float(os.environ.get("SFTP_BACKOFF_CAP", DEFAULT_BACKOFF_CAP)),
+        "latency_target": float(
+            os.environ.get("SFTP_LATENCY_TARGET", DEFAULT_LATENCY_TARGET)
+        ),
+        "breaker_failures": int(
+            os.environ.get("SFTP_BREAKER_FAILURES", DEFAULT_BREAKER_FAILURES)
+        ),
+        "breaker_cooldown": float(
+            os.environ.get("SFTP_BREAKER_COOLDOWN", DEFAULT_BREAKER_COOLDOWN)
+        ),
+    }
+
+
+# DELIVERY_MANIFEST=0 turns off the check a retry-queue drain makes for documents it
+# already delivered
+def deliveryManifestEnabled():
+    return os.environ.get("DELIVERY_MANIFEST", "1").lower() not in ("0", "false", "no")
+
+
+class BreakerOpenError(Exception):
+    pass
+
+
+# Decides how many transfers run at once and whether to attempt one at all.
+#
+# Concurrency is AIMD: every transfer that finishes within SFTP_LATENCY_TARGET seconds
+# raises the limit by 1/limit (about one more slot per limit's worth of successes), a
+# failure or a slower transfer halves it, between 1 and max_concurrency (the number of
+# worker threads, which is also where it starts).
+#
+# The circuit breaker opens after SFTP_BREAKER_FAILURES failed attempts in a row. While
+# open no transfer is attempted; after SFTP_BREAKER_COOLDOWN seconds it lets a single
+# probe through, which closes it on success and reopens it on failure.
+#
+# The limit, the number of transfers in flight and whether the breaker is open are
+# published as gauges under name, openings and failures as counters.
+class DeliveryController:
+    def __init__(self, max_concurrency, name="sftp", settings=None, clock=None):
+        settings = settings or controllerSettings()
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.latency_target = settings["latency_target"]
+        self.breaker_failures = max(1, settings["breaker_failures"])
+        self.breaker_cooldown = settings["breaker_cooldown"]
+        self.clock = clock or time.monotonic
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._condition = threading.Condition()
+        gauge(f"{name}.concurrency_limit", self.max_concurrency)
+
+    @property
+    def is_open(self):
+        with self._condition:
+            return self.opened_at is not None
+
+    # whether a transfer may be attempted now; in the half-open state only one caller
+    # gets True until the probe reports back
+    def allow(self):
+        with self._condition:
+            if self.opened_at is None:
+                return True
+            if self.probing or self.clock() - self.opened_at < self.breaker_cooldown:
+                return False
+            self.probing = True
+            return True
+
+    # holds one of the current limit's transfer slots
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            gauge(f"{self.name}.in_flight", self.in_flight)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def success(self, seconds):
+        with self._condition:
+            self.consecutive_failures = 0
+            self.probing = False
+            if self.opened_at is not None:
+                self.opened_at = None
+                gauge(f"{self.name}.breaker_open", 0)
+                logger.info(f"{self.name} circuit breaker closed.")
+            if seconds > self.latency_target:
+                self._decrease()
+            else:
+                self._setLimit(self.limit + 1 / self.limit)
+
+    def failure(self):
+        with self._condition:
+            self.consecutive_failures += 1
+            count(f"{self.name}.failures")
+            self._decrease()
+            if self.probing or (
+                self.opened_at is None
+                and self.consecutive_failures >= self.breaker_failures
+            ):
+                self.probing = False
+                self.opened_at = self.clock()
+                count(f"{self.name}.breaker_opened")
+                gauge(f"{self.name}.breaker_open", 1)
+                logger.info(
+                    f"{self.name} circuit breaker open after "
+                    f"{self.consecutive_failures} failures in a row."
+                )
+
+    def _decrease(self):
+        self._setLimit(self.limit / 2)
+
+    def _setLimit(self, limit):
+        limit = min(float(self.max_concurrency), max(1.0, limit))
+        if int(limit) != int(self.limit):
+            gauge(f"{self.name}.concurrency_limit", int(limit))
+        self.limit = limit
+        self._condition.notify_all()
+
+
+# full jitter: a random delay up to base * 2^attempt seconds, capped
+def backoffDelay(attempt, base=DEFAULT_BACKOFF_BASE, cap=DEFAULT_BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+# What retry-queue drains have delivered, addressed by content: one small object per
+# document under texas-vax/delivered/, named after the SHA-256 of its bytes. A drain
+# removes its delivered entries from the queue only after the last upload, so a drain
+# that stops in between leaves entries behind that went out; the next drain finds them
+# here and does not upload them again. Fresh messages carry a new timestamp and control
+# ID, so they are never looked up. The manifest only saves uploads, so failing to read
+# or write it never fails a delivery
+class DeliveryManifest:
+    def __init__(self, s3, bucket, prefix=DELIVERED_PREFIX):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, delivery):
+        return self.prefix + hashlib.sha256(delivery.document).hexdigest()
+
+    def contains(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as ex:
+            if not isMissingKey(self.s3, ex):
+                logger.info(f"Unable to check the delivery manifest. {ex}")
+            return False
+
+    def add(self, key, delivery):
+        entry = {
+            "file_name": delivery.file_name,
+            "label": delivery.label,
+            "delivered_at": datetime.utcnow().isoformat(),
+        }
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket, Key=key, Body=json.dumps(entry).encode("utf-8")
+            )
+        except Exception as ex:
+            logger.info(f"Unable to record {delivery.label} as delivered. {ex}")
+
+
+# Wraps a sink (the ImmTrac upload) in a DeliveryController: each delivery gets up to
+# SFTP_RETRY_ATTEMPTS attempts with jittered exponential backoff between them, within
+# the controller's concurrency limit. A delivery that runs out of attempts, or finds the
+# breaker open, is parked in retry_queue and marked parked, so the rest of the run goes
+# on without waiting on the server; without a retry queue it fails as before. An error
+# permanent(error) is true for, such as a rejected login, is not retried. With a
+# manifest, documents already delivered count as delivered without another upload
+class ControlledSink(Sink):
+    def __init__(
+        self,
+        sink,
+        controller,
+        retry_queue=None,
+        manifest=None,
+        settings=None,
+        permanent=None,
+    ):
+        super().__init__(controller.max_concurrency)
+        settings = settings or controllerSettings()
+        self.name = sink.name
+        self.sink = sink
+        self.controller = controller
+        self.retry_queue = retry_queue
+        self.manifest = manifest
+        self.permanent = permanent or (lambda error: False)
+        self.attempts = max(1, settings["attempts"])
+        self.backoff_base = settings["backoff_base"]
+        self.backoff_cap = settings["backoff_cap"]
+        self.parked = 0
+
+    def __call__(self, delivery):
+        if self.deliver(delivery):
+            super().__call__(delivery)
+
+    # Sink.__call__ counts a delivery once deliver() has sent it
+    def write(self, delivery):
+        pass
+
+    # returns True once delivered, False once parked
+    def deliver(self, delivery):
+        manifest_key = None
+        if self.manifest is not None:
+            manifest_key = self.manifest.key(delivery)
+            if self.manifest.contains(manifest_key):
+                count("deliveries.skipped")
+                logger.info(f"HL7 {delivery.label} was already delivered, skipping.")
+                return True
+        error = None
+        for attempt in range(self.attempts):
+            if not self.controller.allow():
+                error = error or BreakerOpenError(
+                    f"{self.name} circuit breaker is open"
+                )
+                break
+            with self.controller.slot():
+                started = time.perf_counter()
+                try:
+                    self.sink.write(delivery)
+                    error = None
+                except Exception as ex:
+                    error = ex
+                elapsed = time.perf_counter() - started
+            if error is None:
+                self.controller.success(elapsed)
+                if manifest_key is not None:
+                    self.manifest.add(manifest_key, delivery)
+                return True
+            self.controller.failure()
+            logger.info(f"{self.name} attempt {attempt + 1} failed. {error}")
+            if self.permanent(error):
+                break
+            if attempt + 1 < self.attempts and not self.controller.is_open:
+                delay = backoffDelay(attempt, self.backoff_base, self.backoff_cap)
+                count(f"{self.name}.retries")
+                observe(f"{self.name}.backoff", int(delay * 1e9))
+                time.sleep(delay)
+        return self.park(delivery, error)
+
+    def park(self, delivery, error):
+        if self.retry_queue is None:
+            raise error
+        self.retry_queue.park(delivery, str(error))
+        delivery.parked = str(error)
+        count("deliveries.parked")
+        with self._lock:
+            self.parked += 1
+        return False
+
+    def target(self):
+        return self.sink.target()
+
+    def close(self):
+        self.sink.close()
+
+    def summary(self):
+        return dict(super().summary(), parked=self.parked)
@@ -0,0 +1,157 @@
+# Runs the generator outside Lambda, e.g. for an offline backfill or a profiling run:
+# reads an export CSV from a local path or s3://BUCKET/KEY and delivers every HL7 file
+# to one or more sinks (see sink_utils.parseSink), in the order given.
+#
+#   python export_runner.py INPUT [--sink SPEC ...] [--batch] [--dedup-bucket BUCKET]
+#                           [--results PATH] [--error-log PATH] [--region REGION]
+#
+# The sink defaults to dry-run, which only counts and times the messages. Rows are read,
+# normalized, generated and delivered by the same code as the Lambda, without its time
+# budget or checkpoints. With --dedup-bucket, rows already in that bucket's dedup index
+# are skipped and the rows sent are added to it, and file and control numbers come from
+# that bucket's counter like the Lambda's; without it they count from 0. --results
+# writes the outcome of every row as CSV and --error-log the error entries the Lambda
+# would put under vaccine-logs/. The other handler settings (GENERATION_WORKERS,
+# PIPELINE_*_WORKERS, ...) are read from the environment as usual. The last line of
+# output is a JSON summary with the per-stage metrics.
+import os
+import sys
+import csv
+import json
+import math
+import time
+import argparse
+from urllib.parse import urlsplit
+import TexasHL7
+from TexasHL7 import FileRun
+from aws_utils import awsClient
+from dedup_utils import DedupIndex, loadDedupIndex
+from pipeline_utils import FileSequence, pipelineSettings
+from metrics_utils import startMetrics, publishMetrics, timed
+from sink_utils import parseSink
+from sequence_utils import SequenceCounter
+from log_utils import LocalLogWriter, setCommandLineLogLevel
+
+DEFAULT_ERROR_LOG = "export-errors.jsonl"
+
+
+# there is no time budget outside Lambda, so an export never resumes from a checkpoint
+class NullCheckpointer:
+    def load(self):
+        return 0, 0
+
+
+# one input file, read from local disk or, for s3://BUCKET/KEY, from S3
+class ExportRun(FileRun):
+    def __init__(self, source):
+        url = urlsplit(source)
+        self.bucket = url.netloc if url.scheme == "s3" else None
+        super().__init__(url.path.lstrip("/") if self.bucket else source)
+        self._body = None
+
+    def open(self, s3, bucket):
+        if self.bucket is not None:
+            return super().open(s3, self.bucket)
+        self._body = open(self.object_key, "rb")
+        return {
+            "Body": self._body,
+            "ETag": None,
+            "ContentLength": os.path.getsize(self.object_key),
+        }
+
+    def newCheckpointer(self, s3, bucket, etag):
+        return NullCheckpointer()
+
+    def close(self):
+        if self._body is not None:
+            self._body.close()
+
+
+def writeResults(path, error_dict):
+    with open(path, "w", newline="") as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(list(error_dict))
+        writer.writerows(zip(*error_dict.values()))
+
+
+# Generates every row of source and delivers it to sinks; returns the run's summary
+def runExport(source, sinks, dedup_bucket=None, region=None, results_path=None):
+    startMetrics()
+    started = time.perf_counter()
+    run = TexasHL7.startRun()
+    file_run = ExportRun(source)
+    s3 = None
+    if file_run.bucket is not None or dedup_bucket:
+        s3 = awsClient("s3", region, path_style=True)
+    dedup_index = DedupIndex()
+    if dedup_bucket:
+        with timed("dedup.load"):
+            dedup_index = loadDedupIndex(s3, dedup_bucket)
+    sequences = {"message": FileSequence(), "batch": FileSequence(1)}
+    if dedup_bucket:
+        sequence = FileSequence(counter=SequenceCounter(s3, dedup_bucket))
+        sequences = {"message": sequence, "batch": sequence}
+
+    pipeline = TexasHL7.startDeliveryPipeline(sinks)
+    try:
+        TexasHL7.runFile(
+            file_run,
+            lambda file_run: TexasHL7.processFile(
+                file_run, run, s3, None, dedup_index, sequences, pipeline, math.inf
+            ),
+        )
+    finally:
+        pipeline.close()
+        file_run.close()
+        for sink in sinks:
+            sink.close()
+        TexasHL7.error_log.flush()
+
+    error_dict = file_run.error_dict
+    if dedup_bucket:
+        dedup_index.addMany(error_dict["Patient ID"], error_dict["Vaccine Date"])
+        with timed("dedup.save"):
+            dedup_index.save(s3, dedup_bucket)
+    if results_path:
+        writeResults(results_path, error_dict)
+    return {
+        "input": source,
+        "status": "failed" if file_run.error is not None else "complete",
+        "error": None if file_run.error is None else str(file_run.error),
+        "rows": len(error_dict["Patient ID"]),
+        "failed_rows": sum(1 for error in error_dict["Error"] if error),
+        "seconds": time.perf_counter() - started,
+        "sinks": [sink.summary() for sink in sinks],
+        "metrics": publishMetrics(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("--sink", action="append", default=[])
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--dedup-bucket", default=None)
+    parser.add_argument("--results", default=None)
+    parser.add_argument("--error-log", default=DEFAULT_ERROR_LOG)
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    args = parser.parse_args()
+
+    # per-row INFO lines and the EMF metrics line are for CloudWatch; here the summary
+    # below is the output
+    setCommandLineLogLevel(os.environ.get("LOG_LEVEL", "WARNING"))
+    os.environ.setdefault("METRICS_EMF", "0")
+    if args.batch:
+        os.environ["HL7_BATCH_MODE"] = "1"
+
+    TexasHL7.error_log = LocalLogWriter(args.error_log)
+    settings = pipelineSettings()
+    workers = {"s3": settings["s3_workers"], "sftp": settings["sftp_workers"]}
+    sinks = [
+        parseSink(spec, TexasHL7.sftp_connection, args.region, workers)
+        for spec in args.sink or ["dry-run"]
+    ]
+    summary = runExport(args.input, sinks, args.dedup_bucket, args.region, args.results)
+    print(json.dumps(summary))
+    if summary["status"] != "complete":
+        sys.exit(1)
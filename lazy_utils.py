@@ -0,0 +1,40 @@
+import os
+import importlib
+
+
+# LAZY_IMPORTS=0 imports every deferred module at load time again, e.g. to move the cost
+# into the Lambda init phase under provisioned concurrency
+def lazyImportsEnabled():
+    return os.environ.get("LAZY_IMPORTS", "1").lower() not in ("0", "false", "no")
+
+
+# Stands in for a module until one of its attributes is used, then imports it. pandas,
+# numpy, boto3, paramiko, phonenumbers and us take most of a cold start to import and a
+# run does not need all of them (a small file on the csv fast path never touches
+# pandas), so the handler modules bind them through lazyImport instead of import.
+# importlib.import_module does its own per-module locking, so pipeline threads touching
+# the same module for the first time import it once.
+class LazyModule:
+    __slots__ = ("_name", "_module")
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazyImport(name):
+    if not lazyImportsEnabled():
+        return importlib.import_module(name)
+    return LazyModule(name)
@@ -0,0 +1,236 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import math
+import uuid
+from io import BytesIO, StringIO
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from lazy_utils import lazyImport
+from aws_utils import isMissingKey
+
+boto3 = lazyImport("boto3")
+pd = lazyImport("pandas")
+
+LEDGER_PREFIX = "texas-vax/ledger/"
+LEDGER_COLUMNS = ["Patient ID", "Vaccine Date", "Error"]
+HL7_MESSAGE_COLUMN = "HL7 Message"
+PART_SUFFIX = ".csv.gz"
+BODIES_SUFFIX = ".hl7.jsonl.gz"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# where the HL7 bodies go: "separate" (default) writes them to a gzip'd JSON lines
+# sidecar next to the part, "inline" keeps them as a column, "none" drops them
+def ledgerBodyMode():
+    return os.environ.get("LEDGER_HL7_BODIES", "separate").lower()
+
+
+def ledgerPartitionPrefix(day):
+    return f"{LEDGER_PREFIX}date={day}/"
+
+
+def newPartName(kind="run"):
+    return (
+        kind
+        + "-"
+        + datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        + "-"
+        + uuid.uuid4().hex[:8]
+    )
+
+
+def gzipBytes(data):
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as compressed:
+        compressed.write(data)
+    return buffer.getvalue()
+
+
+# missing values (NaN from pandas) are written as empty cells / null, as pandas does
+def ledgerValue(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+# writes one immutable part with this run's results under the date partition. Nothing
+# that is already in the ledger is read or rewritten, so concurrent runs cannot collide.
+# The part is written with the csv and json modules, in the format DataFrame.to_csv
+# produced, so a run on the csv fast path does not import pandas for it
+def writeLedgerPart(s3, bucket, error_dict, day=None, body_mode=None, kind="run"):
+    if not error_dict["Patient ID"]:
+        return None
+    day = day or datetime.today().strftime("%Y-%m-%d")
+    body_mode = body_mode or ledgerBodyMode()
+    columns = LEDGER_COLUMNS + [HL7_MESSAGE_COLUMN]
+    rows = [
+        [ledgerValue(value) for value in row]
+        for row in zip(
+            error_dict["Patient ID"],
+            error_dict["Vaccine Date"],
+            error_dict["Error"],
+            error_dict["HL7 Message"],
+        )
+    ]
+    width = len(columns) if body_mode == "inline" else len(LEDGER_COLUMNS)
+    part = StringIO()
+    writer = csv.writer(part, lineterminator="\n")
+    writer.writerow(columns[:width])
+    writer.writerows(row[:width] for row in rows)
+    part_key = ledgerPartitionPrefix(day) + newPartName(kind)
+    s3.put_object(
+        Bucket=bucket,
+        Key=part_key + PART_SUFFIX,
+        Body=gzipBytes(part.getvalue().encode("utf-8")),
+    )
+    if body_mode == "separate":
+        lines = "\n".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) for row in rows
+        ).encode("utf-8")
+        s3.put_object(Bucket=bucket, Key=part_key + BODIES_SUFFIX, Body=gzipBytes(lines))
+    logger.info(f"Wrote {len(rows)} ledger rows to {part_key}")
+    return part_key
+
+
+def listLedgerKeys(s3, bucket, prefix=LEDGER_PREFIX):
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            keys.append(item["Key"])
+    return sorted(keys)
+
+
+def partitionDay(key):
+    partition = key[len(LEDGER_PREFIX) :].split("/", 1)[0]
+    return partition[len("date=") :]
+
+
+def selectPartitionKeys(s3, bucket, start_day=None, end_day=None, suffix=PART_SUFFIX):
+    selected = []
+    for key in listLedgerKeys(s3, bucket):
+        if not key.endswith(suffix):
+            continue
+        day = partitionDay(key)
+        if start_day and day < start_day:
+            continue
+        if end_day and day > end_day:
+            continue
+        selected.append(key)
+    return selected
+
+
+# scans the date partitions between start_day and end_day (inclusive, YYYY-MM-DD) and
+# returns the requested columns of every part in them as one DataFrame
+def readLedger(s3, bucket, start_day=None, end_day=None, columns=None):
+    frames = []
+    for key in selectPartitionKeys(s3, bucket, start_day, end_day):
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        part_df = pd.read_csv(
+            BytesIO(body),
+            compression="gzip",
+            usecols=lambda column: columns is None or column in columns,
+        )
+        part_df["Date Partition"] = partitionDay(key)
+        frames.append(part_df)
+    if not frames:
+        return pd.DataFrame(columns=columns or LEDGER_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def readLedgerBodies(s3, bucket, start_day=None, end_day=None):
+    frames = []
+    for key in selectPartitionKeys(s3, bucket, start_day, end_day, BODIES_SUFFIX):
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        frames.append(pd.read_json(BytesIO(body), lines=True, compression="gzip"))
+    if not frames:
+        return pd.DataFrame(columns=LEDGER_COLUMNS + [HL7_MESSAGE_COLUMN])
+    return pd.concat(frames, ignore_index=True)
+
+
+# Concatenates csv parts as text with the csv module, so every value is written back
+# exactly as it was read: no leading zeros lost, no IDs turned into floats and no blank
+# errors turned into NaN. Parts written with different body modes are merged under the
+# union of their columns. Returns (payload, rows)
+def mergeCsvParts(chunks):
+    columns = []
+    rows = []
+    for chunk in chunks:
+        reader = csv.DictReader(StringIO(chunk.decode("utf-8")))
+        for column in reader.fieldnames or []:
+            if column not in columns:
+                columns.append(column)
+        rows.extend(reader)
+    merged = StringIO()
+    writer = csv.DictWriter(merged, columns, restval="", lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    return merged.getvalue().encode("utf-8"), len(rows)
+
+
+# the uncompressed contents of the parts that still exist, and their keys; a part that
+# another merge deleted after it was listed is skipped
+def readParts(s3, bucket, keys):
+    chunks = []
+    found = []
+    for key in keys:
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except Exception as ex:
+            if not isMissingKey(s3, ex):
+                raise
+            logger.info(f"Ledger part {key} is gone, skipping it")
+            continue
+        chunks.append(gzip.decompress(body))
+        found.append(key)
+    return chunks, found
+
+
+# merges the given parts (csv parts and their bodies sidecars) into one part named
+# part_name and deletes them; a suffix with fewer than minimum parts is left alone.
+# Returns the number of csv rows merged
+def mergeLedgerParts(s3, bucket, keys, part_name, minimum=2):
+    merged = 0
+    for suffix in (PART_SUFFIX, BODIES_SUFFIX):
+        part_keys = [key for key in keys if key.endswith(suffix)]
+        if not part_keys or len(part_keys) < minimum:
+            continue
+        chunks, part_keys = readParts(s3, bucket, part_keys)
+        if not part_keys:
+            continue
+        if suffix == PART_SUFFIX:
+            payload, merged = mergeCsvParts(chunks)
+        else:
+            payload = b"".join(
+                chunk if chunk.endswith(b"\n") else chunk + b"\n" for chunk in chunks
+            )
+        s3.put_object(Bucket=bucket, Key=part_name + suffix, Body=gzipBytes(payload))
+        for start in range(0, len(part_keys), 1000):
+            s3.delete_objects(
+                Bucket=bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in part_keys[start : start + 1000]]
+                },
+            )
+    return merged
+
+
+# merges every part of one date partition into a single compacted part, bodies sidecars
+# included, and deletes the parts it merged
+def compactLedgerPartition(s3, bucket, day):
+    prefix = ledgerPartitionPrefix(day)
+    keys = listLedgerKeys(s3, bucket, prefix)
+    return mergeLedgerParts(s3, bucket, keys, prefix + newPartName("compacted"))
+
+
+# python ledger_utils.py compact <bucket> <YYYY-MM-DD>
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "compact":
+        print("usage: python ledger_utils.py compact <bucket> <YYYY-MM-DD>")
+        sys.exit(2)
+    count = compactLedgerPartition(boto3.client("s3"), sys.argv[2], sys.argv[3])
+    print(f"Compacted {count} ledger rows for {sys.argv[3]}")
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from aws_utils import awsClient
+
+LOG_PREFIX = "vaccine-logs/"
+DEFAULT_FLUSH_MAX_ENTRIES = 1000
+DEFAULT_FLUSH_MAX_BYTES = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 60
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+def logDay():
+    return datetime.today().strftime("%Y-%m-%d")
+
+
+def logPartPrefix(logType, day):
+    return LOG_PREFIX + logType + "/" + day + "/"
+
+
+def logDailyKey(logType, day):
+    return LOG_PREFIX + logType + "/" + day + ".json"
+
+
+# Buffers log entries in memory and writes them as immutable newline-delimited JSON
+# part objects under vaccine-logs/<type>/<date>/, so a run never reads back the daily
+# log and concurrent invocations cannot overwrite each other. A buffer is flushed once
+# it holds LOG_FLUSH_MAX_ENTRIES entries or LOG_FLUSH_MAX_BYTES bytes, when
+# LOG_FLUSH_INTERVAL seconds have passed since the last flush, and at the end of the
+# handler. compactLogParts merges the parts into the daily <date>.json file.
+class BufferedLogWriter:
+    def __init__(self, bucket=None, max_entries=None, max_bytes=None, interval=None):
+        self.bucket = bucket
+        if max_entries is None:
+            max_entries = int(
+                os.environ.get("LOG_FLUSH_MAX_ENTRIES", DEFAULT_FLUSH_MAX_ENTRIES)
+            )
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("LOG_FLUSH_MAX_BYTES", DEFAULT_FLUSH_MAX_BYTES))
+        if interval is None:
+            interval = float(os.environ.get("LOG_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._buffers = dict()
+        self._sizes = dict()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._s3 = None
+
+    def _client(self):
+        if self._s3 is None:
+            self._s3 = awsClient("s3")
+        return self._s3
+
+    def write(self, logType, entry):
+        line = json.dumps(entry)
+        with self._lock:
+            self._buffers.setdefault(logType, []).append(line)
+            self._sizes[logType] = self._sizes.get(logType, 0) + len(line) + 1
+            due = (
+                len(self._buffers[logType]) >= self.max_entries
+                or self._sizes[logType] >= self.max_bytes
+                or time.monotonic() - self._last_flush >= self.interval
+            )
+            if due:
+                pending = self._take()
+        if due:
+            self._put_parts(pending)
+
+    def flush(self):
+        with self._lock:
+            pending = self._take()
+        self._put_parts(pending)
+
+    def _take(self):
+        pending = self._buffers
+        self._buffers = dict()
+        self._sizes = dict()
+        self._last_flush = time.monotonic()
+        return pending
+
+    def _put_parts(self, pending):
+        bucket = self.bucket or os.environ["BUCKET_NAME"]
+        day = logDay()
+        for logType, lines in pending.items():
+            if not lines:
+                continue
+            part_name = (
+                datetime.utcnow().strftime("part-%Y%m%dT%H%M%S%f-")
+                + uuid.uuid4().hex[:8]
+                + ".jsonl"
+            )
+            try:
+                self._client().put_object(
+                    Bucket=bucket,
+                    Key=logPartPrefix(logType, day) + part_name,
+                    Body="\n".join(lines) + "\n",
+                )
+            except Exception as ex:
+                # the entries were already written to the Lambda log by log_to_bucket
+                logger.error(f"Unable to write {len(lines)} {logType} log entries. {ex}")
+
+
+# Appends log entries to a local JSON-lines file instead of S3, for runs outside
+# Lambda (see export_runner). Each line is {"type": ..., "entry": ...}
+class LocalLogWriter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, logType, entry):
+        line = json.dumps({"type": logType, "entry": entry})
+        with self._lock:
+            with open(self.path, "a") as log_file:
+                log_file.write(line + "\n")
+
+    def flush(self):
+        pass
+
+
+# Log keys that belong to the calling thread. Logger.append_keys changes the formatter
+# every thread shares, so with files processed side by side one file's row keys ended up
+# on another file's lines; as a handler filter this sets the thread's own keys on each
+# record, which the formatter logs in place of the appended defaults
+class ThreadLogKeys(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def set(self, **keys):
+        self._local.keys = keys
+
+    def filter(self, record):
+        for key, value in getattr(self._local, "keys", {}).items():
+            setattr(record, key, value)
+        return True
+
+
+# Sets the level of the handler's logger and of every module's child logger, which
+# carry a level of their own, for command-line runs where the summary is the output.
+# Only loggers that exist already are changed, so call it after the imports
+def setCommandLineLogLevel(level, service="texasHL7sftp"):
+    for name, existing in list(logging.root.manager.loggerDict.items()):
+        if isinstance(existing, logging.Logger) and (
+            name == service or name.startswith(service + ".")
+        ):
+            existing.setLevel(level)
+
+
+def listLogParts(s3, bucket, logType, day):
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=logPartPrefix(logType, day)):
+        for item in page.get("Contents", []):
+            keys.append(item["Key"])
+    return sorted(keys)
+
+
+def readLogParts(s3, bucket, keys):
+    entries = []
+    for key in keys:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
+        for line in body.splitlines():
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+# merges the part objects for one day into the daily <date>.json array and removes them
+def compactLogParts(bucket, logType, day, s3=None):
+    s3 = s3 or awsClient("s3")
+    keys = listLogParts(s3, bucket, logType, day)
+    if not keys:
+        return 0
+    try:
+        current_log = json.load(
+            s3.get_object(Bucket=bucket, Key=logDailyKey(logType, day))["Body"]
+        )
+    except s3.exceptions.NoSuchKey:
+        current_log = []
+    entries = readLogParts(s3, bucket, keys)
+    s3.put_object(
+        Bucket=bucket,
+        Key=logDailyKey(logType, day),
+        Body=json.dumps(current_log + entries),
+    )
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]]},
+        )
+    return len(entries)
+
+
+# python log_utils.py <bucket> <log type> [<YYYY-MM-DD>]
+if __name__ == "__main__":
+    day = sys.argv[3] if len(sys.argv) > 3 else logDay()
+    count = compactLogParts(sys.argv[1], sys.argv[2], day)
+    print(f"Compacted {count} {sys.argv[2]} entries for {day}")
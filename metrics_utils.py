@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from aws_lambda_powertools import Logger
+from lazy_utils import lazyImport
+
+powertools_metrics = lazyImport("aws_lambda_powertools.metrics")
+
+METRICS_NAMESPACE = "TexasHL7"
+# sub-buckets per power of two in a Histogram; 8 keeps percentiles within ~9%
+HISTOGRAM_PRECISION_BITS = 3
+DEFAULT_SEGMENT_SAMPLE = 32
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# METRICS_ENABLED=0 turns every timer and counter into a no-op
+def metricsEnabled():
+    return os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+# the segment builders are timed for one message in METRICS_SEGMENT_SAMPLE: recording
+# seven timings for every message cost about a third of the time spent generating it
+def segmentSampleEvery():
+    return max(1, int(os.environ.get("METRICS_SEGMENT_SAMPLE", DEFAULT_SEGMENT_SAMPLE)))
+
+
+# Durations in nanoseconds, kept as counts per log-scale bucket (the top few bits of the
+# value), so recording is a few integer operations and the memory does not grow with
+# the number of rows. Percentiles come back as the upper bound of their bucket.
+class Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = dict()
+
+    @staticmethod
+    def bucketOf(value):
+        shift = max(0, value.bit_length() - HISTOGRAM_PRECISION_BITS - 1)
+        return (shift, value >> shift)
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = self.bucketOf(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for shift, mantissa in sorted(self.buckets):
+            seen += self.buckets[(shift, mantissa)]
+            if seen >= rank:
+                return min(self.max, ((mantissa + 1) << shift) - 1)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_ms": self.total / 1e6,
+            "p50_ms": self.percentile(0.50) / 1e6,
+            "p99_ms": self.percentile(0.99) / 1e6,
+            "max_ms": self.max / 1e6,
+        }
+
+
+# The timers and counters of one invocation. Stages record into it from the file,
+# pipeline and generation threads, so updates are locked; a stage is timed once per
+# row or chunk at most, which keeps the lock uncontended next to the work it measures.
+class RunMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timers = dict()
+        self.counters = dict()
+        self.gauges = dict()
+
+    def observe(self, name, nanoseconds):
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = Histogram()
+            histogram.record(nanoseconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # a level rather than an event, e.g. a concurrency limit: keeps the last, lowest and
+    # highest value set
+    def gauge(self, name, value):
+        with self._lock:
+            current = self.gauges.get(name)
+            if current is None:
+                self.gauges[name] = {"last": value, "min": value, "max": value}
+            else:
+                current["last"] = value
+                current["min"] = min(current["min"], value)
+                current["max"] = max(current["max"], value)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "elapsed_s": time.time() - self.started,
+                "timers": {
+                    name: histogram.summary()
+                    for name, histogram in sorted(self.timers.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": {
+                    name: dict(values) for name, values in sorted(self.gauges.items())
+                },
+            }
+
+
+_current = RunMetrics()
+# read once per invocation rather than on every timer
+_enabled = metricsEnabled()
+_segment_sample = segmentSampleEvery()
+_messages = itertools.count()
+
+
+# starts a fresh set of metrics for an invocation; the handler calls this first
+def startMetrics():
+    global _current, _enabled, _segment_sample
+    _current = RunMetrics()
+    _enabled = metricsEnabled()
+    _segment_sample = segmentSampleEvery()
+    return _current
+
+
+def currentMetrics():
+    return _current
+
+
+# whether to time the segments of the message being generated; true for one call in
+# METRICS_SEGMENT_SAMPLE, so the segment.* timers hold a sample of the messages
+def sampleSegments():
+    return _enabled and next(_messages) % _segment_sample == 0
+
+
+def observe(name, nanoseconds):
+    if _enabled:
+        _current.observe(name, nanoseconds)
+
+
+def count(name, value=1):
+    if _enabled:
+        _current.count(name, value)
+
+
+def gauge(name, value):
+    if _enabled:
+        _current.gauge(name, value)
+
+
+@contextmanager
+def timed(name):
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        _current.observe(name, time.perf_counter_ns() - started)
+
+
+# yields the items of iterable, timing each step under name, e.g. reading the next
+# chunk of a CSV
+def timedIteration(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter_ns()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter_ns() - started)
+        yield item
+
+
+# Emits the invocation's metrics once: as CloudWatch embedded metric format through
+# powertools Metrics (METRICS_EMF, default on; one metric per timer statistic,
+# counter and gauge statistic, no per-row lines), and as a plain JSON summary written to
+# METRICS_SUMMARY_PATH when it is set, for local runs. Returns the summary
+def publishMetrics(run_metrics=None):
+    run_metrics = run_metrics or _current
+    summary = run_metrics.summary()
+    if not _enabled:
+        return summary
+    if os.environ.get("METRICS_EMF", "1").lower() not in ("0", "false", "no"):
+        emitEmf(summary)
+    summary_path = os.environ.get("METRICS_SUMMARY_PATH")
+    if summary_path:
+        with open(summary_path, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    return summary
+
+
+def emitEmf(summary):
+    unit = powertools_metrics.MetricUnit
+    metrics = powertools_metrics.Metrics(
+        namespace=os.environ.get("METRICS_NAMESPACE", METRICS_NAMESPACE),
+        service="texasHL7sftp",
+    )
+    for name, timer in summary["timers"].items():
+        metrics.add_metric(f"{name}.count", unit.Count, timer["count"])
+        for statistic in ("total_ms", "p50_ms", "p99_ms", "max_ms"):
+            metrics.add_metric(
+                f"{name}.{statistic[: -len('_ms')]}",
+                unit.Milliseconds,
+                timer[statistic],
+            )
+    for name, value in summary["counters"].items():
+        metrics.add_metric(name, unit.Count, value)
+    for name, values in summary["gauges"].items():
+        for statistic, value in values.items():
+            metrics.add_metric(f"{name}.{statistic}", unit.Count, value)
+    metrics.add_metric("invocation.elapsed", unit.Seconds, summary["elapsed_s"])
+    metrics.flush_metrics()
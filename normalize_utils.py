@@ -0,0 +1,196 @@
+from HL7_utils import *
+from lazy_utils import lazyImport
+
+np = lazyImport("numpy")
+pd = lazyImport("pandas")
+
+ADMINISTERED_FORMAT = "%Y-%m-%dT%H:%MZ"
+# the strings datetime.strptime accepts for "%Y-%m-%d"
+DOB_PATTERN = r"\d{4}-\d{1,2}-\d{1,2}"
+
+# the columns normalizeFrame adds; the segment builders read these when present and fall
+# back to the scalar HL7_utils functions when a value is missing, see normalizedValue
+NORMALIZED_COLUMNS = (
+    "hl7_gender",
+    "hl7_race",
+    "hl7_ethnicity",
+    "hl7_state",
+    "hl7_phone",
+    "hl7_lot",
+    "hl7_expiration",
+    "hl7_dob",
+    "hl7_administered_date",
+    "hl7_procedure_date",
+    "hl7_route_code",
+    "hl7_route_description",
+    "hl7_site_code",
+    "hl7_site_description",
+)
+
+
+# the vectorised equivalent of hl7StringRead: non-strings become "" and blanks become "^"
+def hl7Strings(series):
+    is_string = series.map(type).eq(str)
+    strings = series.where(is_string, "")
+    return strings.mask(is_string & strings.eq(""), "^").astype(object)
+
+
+def selectFirst(lowered, rules, default):
+    conditions = []
+    choices = []
+    for test, pattern, value in rules:
+        if test == "startswith":
+            conditions.append(lowered.str.startswith(pattern).to_numpy(dtype=bool))
+        else:
+            conditions.append(
+                lowered.str.contains(pattern, regex=False).to_numpy(dtype=bool)
+            )
+        choices.append(value)
+    return pd.Series(
+        np.select(conditions, choices, default=default).astype(object),
+        index=lowered.index,
+    )
+
+
+# applies a scalar converter once per distinct value. A value the converter raises on
+# maps to None so the segment builder re-runs the scalar path and fails the same way
+def mapUnique(series, convert):
+    def safeConvert(value):
+        try:
+            return convert(value)
+        except Exception:
+            return None
+
+    # factorize gives missing values code -1, which picks the last entry
+    codes, uniques = pd.factorize(series)
+    converted = np.empty(len(uniques) + 1, dtype=object)
+    for position, value in enumerate(uniques):
+        converted[position] = safeConvert(value)
+    converted[-1] = safeConvert(np.nan)
+    return pd.Series(converted[codes], index=series.index, dtype=object)
+
+
+# parses a date column with a fixed format and formats it for HL7. Values that do not
+# parse, or that fall past the century cutoff, are left as None for the scalar path.
+# pandas parses ISO formats leniently (older versions take "19900105" or a trailing
+# time for "%Y-%m-%d"), so strings that do not fullmatch pattern are left to strptime
+def formatDates(series, input_format, output_format, century_cutoff=None, pattern=None):
+    is_string = series.map(type).eq(str)
+    candidates = is_string
+    if pattern is not None:
+        candidates = is_string & series.where(is_string, "").str.fullmatch(pattern)
+    parsed = pd.to_datetime(
+        series.where(candidates), format=input_format, errors="coerce"
+    )
+    keep = parsed.notna()
+    if century_cutoff is not None:
+        keep &= parsed < pd.Timestamp(century_cutoff)
+    formatted = pd.Series(None, index=series.index, dtype=object)
+    formatted[keep] = parsed[keep].dt.strftime(output_format)
+    return formatted, is_string
+
+
+def normalizeGender(series):
+    return selectFirst(
+        hl7Strings(series).str.lower(),
+        [
+            ("startswith", "m", "M"),
+            ("startswith", "f", "F"),
+            ("startswith", "n", "N"),
+            ("contains", "transgender", "T"),
+            ("startswith", "o", "O"),
+        ],
+        "",
+    )
+
+
+def normalizeRace(series):
+    return selectFirst(
+        hl7Strings(series).str.lower(),
+        [
+            ("startswith", "w", "2106-3^White"),
+            ("startswith", "asian", "2028-9^Asian"),
+            ("startswith", "black", "2054-5^Black"),
+            ("startswith", "africa", "2054-5^African_American"),
+            ("contains", "alaska", "1002-5^alaska_native"),
+            ("startswith", "other", "2131-1^Other_Race"),
+            ("contains", "hawaii", "2076-8^native_hawaiian"),
+            ("contains", "pacific", "2076-8^pacific_islander"),
+        ],
+        "2131-1^Other_Race",
+    )
+
+
+def normalizeEthnicity(series):
+    return selectFirst(
+        hl7Strings(series).str.lower(),
+        [
+            ("startswith", "not", "2186-5^Not Hispanic or Latino"),
+            ("startswith", "hispanic", "2135-2^Hispanic or Latino"),
+            ("startswith", "latino", "2135-2^Hispanic or Latino"),
+        ],
+        "2186-5^Not Hispanic or Latino",
+    )
+
+
+# same as findVaccineLot: the text after the last run of spaces or dashes
+def normalizeLot(series):
+    return hl7Strings(series).str.extract(r"([^\s-]*)\Z", expand=False).astype(object)
+
+
+def normalizeExpiration(series, century_cutoff):
+    formatted, is_string = formatDates(series, "%m/%d/%y", "%Y%m%d%H", century_cutoff)
+    # convertStringDateToHL7 returns "" for anything that is not a string
+    formatted[~is_string] = ""
+    return formatted
+
+
+# Adds HL7-ready hl7_* columns for gender, race, ethnicity, state, phone, lot, dates,
+# injection route and body site to a chunk in a handful of column operations, so the
+# per-row builders only assemble strings. Every value is identical to what the scalar
+# HL7_utils function returns for that cell; cells the vectorised pass cannot decide
+# (unparseable or pre-cutoff dates, failed lookups) are left None and the builder falls
+# back to the scalar function for them.
+def normalizeFrame(input_df, run):
+    frame = input_df.copy()
+    if frame.empty:
+        for column in NORMALIZED_COLUMNS:
+            frame[column] = pd.Series(dtype=object)
+        return frame
+
+    def column(name):
+        if name in frame:
+            return frame[name]
+        return pd.Series(np.nan, index=frame.index, dtype=object)
+
+    frame["hl7_gender"] = normalizeGender(column("Gender"))
+    frame["hl7_race"] = normalizeRace(column("Race"))
+    frame["hl7_ethnicity"] = normalizeEthnicity(column("Ethnicity"))
+    frame["hl7_state"] = mapUnique(column("State"), findStateAbbreviation)
+    frame["hl7_phone"] = mapUnique(
+        column("Phone Number"),
+        lambda value: convertPhoneNumberToHL7(hl7StringRead(value)),
+    )
+    frame["hl7_lot"] = normalizeLot(column("Lot"))
+    frame["hl7_expiration"] = normalizeExpiration(
+        column("Expiration"), run.century_cutoff
+    )
+    frame["hl7_dob"] = formatDates(
+        column("Date of Birth"), "%Y-%m-%d", "%Y%m%d", run.century_cutoff, DOB_PATTERN
+    )[0]
+    frame["hl7_administered_date"] = formatDates(
+        column("Vaccine Administered Date/Time"), ADMINISTERED_FORMAT, "%Y%m%d"
+    )[0]
+    frame["hl7_procedure_date"] = formatDates(
+        column("Vaccine Administered Date/Time"),
+        ADMINISTERED_FORMAT,
+        "%Y%m%d%H%M%S",
+        run.century_cutoff,
+    )[0]
+    routes = mapUnique(column("Injection Route"), getAdministration)
+    frame["hl7_route_code"] = routes.map(lambda route: route["code"])
+    frame["hl7_route_description"] = routes.map(lambda route: route["description"])
+    sites = mapUnique(column("Administration Site"), getBodySite)
+    frame["hl7_site_code"] = sites.map(lambda site: site["code"])
+    frame["hl7_site_description"] = sites.map(lambda site: site["description"])
+    return frame
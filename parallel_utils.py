@@ -0,0 +1,148 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from aws_lambda_powertools import Logger
+from segment_utils import buildHL7Message, currentRunContext
+
+# below this many rows per worker the pickling overhead outweighs the extra cores
+MIN_ROWS_PER_WORKER = 200
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+# the current shared pool; files of one event can generate side by side, so it is only
+# replaced or shut down under the lock, and only once no file is using it
+_pool = None
+_pool_lock = threading.Lock()
+
+def availableCores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# GENERATION_WORKERS is a worker count or "auto" for one per available core; the
+# default of 1 keeps generation in the handler process
+def generationWorkers():
+    setting = os.environ.get("GENERATION_WORKERS", "1").lower()
+    if setting == "auto":
+        return availableCores()
+    return max(1, int(setting))
+
+
+def buildRange(records, control_numbers, run):
+    return [
+        buildHL7Message(record, control_number, run=run)
+        for record, control_number in zip(records, control_numbers)
+    ]
+
+
+def splitRanges(row_count, workers):
+    # a few ranges per worker so one slow range does not leave the others idle
+    range_size = max(MIN_ROWS_PER_WORKER // 4, -(-row_count // (workers * 4)))
+    return [
+        (start, min(start + range_size, row_count))
+        for start in range(0, row_count, range_size)
+    ]
+
+
+# A process pool shared by the files of an event, with the number of files using it.
+# A pool that is replaced or found broken is retired: new callers get a fresh one, and
+# it is shut down when the last file using it lets go, so no file ever submits to a
+# pool another one has shut down
+class SharedPool:
+    def __init__(self, workers):
+        # spawn rather than fork: the handler process already runs pipeline and SSH
+        # threads, which must not be copied into the workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.workers = workers
+        self.users = 0
+        self.retired = False
+
+
+# The pool to generate on with workers processes. A pool of another size is replaced
+# only while nobody is using it; until then callers share it as it is
+def acquirePool(workers):
+    global _pool
+    idle = None
+    with _pool_lock:
+        if _pool is not None and _pool.workers != workers and not _pool.users:
+            idle = _pool
+            _pool = None
+        if _pool is None:
+            _pool = SharedPool(workers)
+        _pool.users += 1
+        pool = _pool
+    if idle is not None:
+        idle.executor.shutdown(wait=True)
+    return pool
+
+
+def releasePool(pool, broken=False):
+    global _pool
+    with _pool_lock:
+        pool.users -= 1
+        if broken:
+            pool.retired = True
+        if pool.retired and _pool is pool:
+            _pool = None
+        done = pool.retired and not pool.users
+    if done:
+        pool.executor.shutdown(wait=True)
+
+
+def shutdownPool():
+    global _pool
+    with _pool_lock:
+        pool = _pool
+        if pool is None:
+            return
+        pool.retired = True
+        _pool = None
+        done = not pool.users
+    if done:
+        pool.executor.shutdown(wait=True)
+
+
+# Builds one message per record and returns a (message, failure) pair per record in
+# input order, exactly as buildHL7Message would for each of them in turn. Control
+# numbers are assigned by the caller and the workers share the caller's RunContext, so
+# the output does not depend on how the rows were split. Small inputs, a single worker,
+# or a platform without working process pools (no /dev/shm on Lambda) fall back to
+# building everything in this process.
+def generateMessages(records, control_numbers, workers=None):
+    run = currentRunContext()
+    if workers is None:
+        workers = generationWorkers()
+    # the pool keeps the configured size; a small input only uses fewer ranges of it
+    pool_workers = workers
+    workers = min(workers, len(records) // MIN_ROWS_PER_WORKER)
+    if workers <= 1:
+        return buildRange(records, control_numbers, run)
+
+    ranges = splitRanges(len(records), workers)
+    try:
+        pool = acquirePool(pool_workers)
+    except (OSError, NotImplementedError) as ex:
+        logger.info(f"Process pool unavailable, generating in-process. {ex}")
+        return buildRange(records, control_numbers, run)
+    broken = False
+    try:
+        results = []
+        for part in pool.executor.map(
+            buildRange,
+            [records[start:end] for start, end in ranges],
+            [control_numbers[start:end] for start, end in ranges],
+            [run] * len(ranges),
+        ):
+            results.extend(part)
+        return results
+    except (OSError, NotImplementedError, BrokenProcessPool) as ex:
+        broken = True
+        logger.info(f"Process pool unavailable, generating in-process. {ex}")
+        return buildRange(records, control_numbers, run)
+    finally:
+        releasePool(pool, broken)
@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+from aws_lambda_powertools import Logger
+from sequence_utils import sequenceBlockSize
+
+DEFAULT_S3_WORKERS = 4
+DEFAULT_SFTP_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 16
+
+_STOP = object()
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+def pipelineSettings():
+    return {
+        "s3_workers": int(os.environ.get("PIPELINE_S3_WORKERS", DEFAULT_S3_WORKERS)),
+        "sftp_workers": int(
+            os.environ.get("PIPELINE_SFTP_WORKERS", DEFAULT_SFTP_WORKERS)
+        ),
+        "queue_size": int(os.environ.get("PIPELINE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+    }
+
+
+# One file on its way to ImmTrac: a single message or a batch. The document is encoded
+# once, here, and every sink writes the same bytes. records holds the (patient id,
+# vaccine date, message) of every message in it and results is the error_dict of the
+# input file it came from. error is set by the first stage that fails and the remaining
+# delivery stages are skipped; parked holds the reason when the upload was left in the
+# retry queue instead (see delivery_utils)
+class HL7Delivery:
+    def __init__(self, file_name, document_string, records, label, results=None):
+        self.file_name = file_name
+        self.document = document_string.encode("utf-8")
+        self.records = records
+        self.label = label
+        self.results = results
+        self.error = None
+        self.failed_stage = None
+        self.parked = None
+
+
+# Hands out HL7 file numbers. Every input file of an event reserves its numbers from
+# the same sequence, so files processed side by side never upload under the same name.
+# With a counter (see sequence_utils.SequenceCounter) numbers come from blocks of
+# SEQUENCE_BLOCK_SIZE reserved from it, so no other run gets them either; a block's
+# unused numbers are skipped, not reused. Without a counter, numbers at or past end
+# (a shard's block, say) are refused with a ValueError
+class FileSequence:
+    def __init__(self, start=0, counter=None, block_size=None, end=None):
+        self._next = start
+        self._end = start
+        self.counter = counter
+        self.block_size = block_size or sequenceBlockSize()
+        self.end = end
+        self._lock = threading.Lock()
+
+    # returns the first of count consecutive numbers nobody else will get
+    def reserve(self, count=1):
+        with self._lock:
+            if self.end is not None and self._next + count > self.end:
+                raise ValueError(
+                    f"{count} file numbers from {self._next} run past the end of "
+                    f"the block at {self.end}"
+                )
+            if self.counter is not None and self._next + count > self._end:
+                size = max(count, self.block_size)
+                self._next = self.counter.reserve(size)
+                self._end = self._next + size
+            first = self._next
+            self._next += count
+            return first
+
+    # skips past numbers an earlier invocation already used, e.g. on resume
+    def advanceTo(self, number):
+        with self._lock:
+            self._next = max(self._next, number)
+
+    @property
+    def next_number(self):
+        with self._lock:
+            return self._next
+
+
+# A chain of stages connected by bounded queues. Each stage runs its own worker
+# threads; submit() blocks once the first queue is full, so a slow stage pushes back on
+# the producer instead of letting work pile up in memory. A stage function that raises
+# marks the item failed; later stages only see failed items if they ask for them.
+class StagedPipeline:
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = max(1, queue_size)
+        self._stages = []
+
+    # func(item) does the work; with handles_failures the stage also receives failed
+    # items, which is how the last stage records every outcome. With batch, a
+    # (most items, seconds) pair, func gets a list instead: items that arrive no more
+    # than that many seconds apart, up to that many items. None of them moves on before
+    # func returns, and if it raises they all fail
+    def addStage(self, name, func, workers=1, handles_failures=False, batch=None):
+        self._stages.append(
+            {
+                "name": name,
+                "func": func,
+                "workers": max(1, workers),
+                "handles_failures": handles_failures,
+                "batch": batch,
+                "queue": queue.Queue(maxsize=self.queue_size),
+                "threads": [],
+            }
+        )
+        return self
+
+    def start(self):
+        for position, stage in enumerate(self._stages):
+            next_stage = (
+                self._stages[position + 1] if position + 1 < len(self._stages) else None
+            )
+            for worker in range(stage["workers"]):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, next_stage),
+                    name=f"{stage['name']}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                stage["threads"].append(thread)
+        return self
+
+    def submit(self, item):
+        self._stages[0]["queue"].put(item)
+
+    # drains every stage in order and waits for the workers to exit
+    def close(self):
+        for stage in self._stages:
+            for _ in stage["threads"]:
+                stage["queue"].put(_STOP)
+            for thread in stage["threads"]:
+                thread.join()
+
+    def _work(self, stage, next_stage):
+        while True:
+            items, stopped = self._take(stage)
+            todo = [
+                item
+                for item in items
+                if item.error is None or stage["handles_failures"]
+            ]
+            if todo:
+                try:
+                    stage["func"](todo if stage["batch"] else todo[0])
+                except Exception as ex:
+                    for item in todo:
+                        if item.error is None:
+                            item.error = ex
+                            item.failed_stage = stage["name"]
+                        else:
+                            logger.error(
+                                f"{stage['name']} failed for {item.label}. {ex}"
+                            )
+            if next_stage is not None:
+                for item in items:
+                    next_stage["queue"].put(item)
+            if stopped:
+                return
+
+    # the next item, or batch of items, for a worker of stage, and whether the worker
+    # took its stop marker
+    def _take(self, stage):
+        item = stage["queue"].get()
+        if item is _STOP:
+            return [], True
+        if not stage["batch"]:
+            return [item], False
+        most, seconds = stage["batch"]
+        items = [item]
+        while len(items) < most:
+            try:
+                item = stage["queue"].get(timeout=seconds)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return items, True
+            items.append(item)
+        return items, False
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+from pathlib import Path
+
+PRODUCT_RULES_FILE = str(Path(__file__).with_name("product_rules.json"))
+PRODUCT_FIELDS = (
+    "cvx_code",
+    "cvx_description",
+    "vis_description",
+    "vax_manufacturer",
+    "mfg_code",
+)
+DEFAULT_CACHE_SIZE = 4096
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def productRulesPath():
+    return os.environ.get("PRODUCT_RULES_PATH", PRODUCT_RULES_FILE)
+
+
+def productFields(entry):
+    return {field: str(entry[field]) for field in PRODUCT_FIELDS}
+
+
+# Classifies a vaccine by its appointment service name, manufacturer and age against an
+# ordered rule table. A rule matches when any of its service_terms is a substring of the
+# service name or any of its manufacturer_terms is a substring of the manufacturer
+# (both compared lower case) and the age falls within its optional min_age / max_age;
+# the first matching rule wins, the default entry applies when none does.
+#
+# Every term of every rule goes into one regex that is run once over each string. The
+# alternatives are longest first, so at each position the longest term starting there
+# is reported, and the shorter terms that are substrings of it are filled in from a
+# precomputed table. The age is reduced to the band between the rules' age boundaries,
+# so results can be cached on (service name, manufacturer, age band).
+class ProductClassifier:
+    def __init__(self, rules, default, cache_size=DEFAULT_CACHE_SIZE):
+        self.default = productFields(default)
+        self.rules = []
+        terms = set()
+        boundaries = set()
+        for rule in rules:
+            service_terms = frozenset(
+                term.lower() for term in rule.get("service_terms", [])
+            )
+            manufacturer_terms = frozenset(
+                term.lower() for term in rule.get("manufacturer_terms", [])
+            )
+            if not service_terms and not manufacturer_terms:
+                raise ValueError(f"Product rule {rule.get('name')} has no terms")
+            min_age = rule.get("min_age")
+            max_age = rule.get("max_age")
+            if min_age is not None:
+                boundaries.add(int(min_age))
+            if max_age is not None:
+                boundaries.add(int(max_age) + 1)
+            terms |= service_terms | manufacturer_terms
+            self.rules.append(
+                (
+                    service_terms,
+                    manufacturer_terms,
+                    min_age,
+                    max_age,
+                    productFields(rule),
+                )
+            )
+
+        ordered = sorted(terms, key=lambda term: (-len(term), term))
+        self._pattern = (
+            re.compile("(?=(" + "|".join(re.escape(term) for term in ordered) + "))")
+            if ordered
+            else None
+        )
+        self._contained = {
+            term: frozenset(other for other in terms if other in term) for term in terms
+        }
+        self._boundaries = sorted(boundaries)
+        # one age inside each band; every age in a band matches the same rules
+        self._band_ages = [
+            (self._boundaries[0] - 1) if self._boundaries else 0
+        ] + self._boundaries
+        self._classify = lru_cache(maxsize=cache_size)(self._evaluate)
+
+    def matchedTerms(self, text):
+        if self._pattern is None or not text:
+            return frozenset()
+        found = set()
+        for match in self._pattern.finditer(text):
+            found |= self._contained[match.group(1)]
+        return found
+
+    def ageBand(self, age):
+        return bisect_right(self._boundaries, age)
+
+    def _evaluate(self, vax_type, vax_manufacturer, age_band):
+        age = self._band_ages[age_band]
+        type_terms = self.matchedTerms(vax_type)
+        manufacturer_terms = self.matchedTerms(vax_manufacturer)
+        for service, manufacturer, min_age, max_age, fields in self.rules:
+            if service.isdisjoint(type_terms) and manufacturer.isdisjoint(
+                manufacturer_terms
+            ):
+                continue
+            if min_age is not None and age < min_age:
+                continue
+            if max_age is not None and age > max_age:
+                continue
+            return fields
+        return self.default
+
+    # vax_type and vax_manufacturer are expected lower case. The returned dict is
+    # shared by every caller with the same key and must not be modified
+    def classify(self, vax_type, vax_manufacturer, age):
+        return self._classify(vax_type, vax_manufacturer, self.ageBand(age))
+
+    def cacheInfo(self):
+        return self._classify.cache_info()
+
+
+def loadProductClassifier(path=None):
+    with open(path or productRulesPath()) as f:
+        table = json.load(f)
+    return ProductClassifier(table["rules"], table["default"])
+
+
+def productClassifier():
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = loadProductClassifier()
+    return _classifier
+
+
+# re-reads the rule table, e.g. after PRODUCT_RULES_PATH changed in a warm container
+def reloadProductRules():
+    global _classifier
+    classifier = loadProductClassifier()
+    with _classifier_lock:
+        _classifier = classifier
+    return classifier
+
+
+def classifyProduct(vax_type, vax_manufacturer, age):
+    return productClassifier().classify(vax_type, vax_manufacturer, age)
@@ -0,0 +1,59 @@
+import json
+from datetime import datetime
+from aws_lambda_powertools import Logger
+
+RETRY_PREFIX = "texas-vax/retry-queue/"
+RETRY_EVENT_KEY = "retry_queue"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# Deliveries that could not be uploaded, parked in S3 so a later invocation can send
+# them instead of the current one retrying until its time budget runs out. Each is one
+# JSON object under texas-vax/retry-queue/, named after its HL7 file, holding the
+# document, the (patient id, vaccine date, message) records it carries and why it was
+# parked. Parking the same file again overwrites it; it is removed once delivered.
+class RetryQueue:
+    def __init__(self, s3, bucket, prefix=RETRY_PREFIX):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, file_name):
+        return self.prefix + file_name + ".json"
+
+    def park(self, delivery, reason):
+        entry = {
+            "file_name": delivery.file_name,
+            "label": delivery.label,
+            "document": delivery.document.decode("utf-8"),
+            "records": [list(record) for record in delivery.records],
+            "reason": reason,
+            "parked_at": datetime.utcnow().isoformat(),
+        }
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.key(delivery.file_name),
+            Body=json.dumps(entry).encode("utf-8"),
+        )
+        logger.info(f"Parked HL7 {delivery.label} for retry. {reason}")
+
+    def keys(self):
+        keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                keys.append(item["Key"])
+        return sorted(keys)
+
+    def load(self, key):
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        return json.loads(body)
+
+    def remove(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=key)
+
+
+# the event that drains the retry queue, e.g. sent on a schedule
+def retryEvent():
+    return {RETRY_EVENT_KEY: {}}
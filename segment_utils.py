@@ -1,7 +1,11 @@
 from pathlib import Path
 from string import Template
-from datetime import date, timedelta, datetime
+from datetime import datetime
+import threading
+import time
 from HL7_utils import *
+from product_utils import classifyProduct
+from metrics_utils import observe, sampleSegments
 
 TEMPLATE_BASE = str(Path("templates"))
 MSH_TEMPLATE = "msh.txt"
@@ -13,16 +17,292 @@ RXA_TEMPLATE = "rxa.txt"
 RXR_TEMPLATE = "rxr.txt"
 PD1_TEMPLATE = "pd1.txt"
 
+# every template a message is built from, loaded and validated together on first use
+MESSAGE_TEMPLATES = (
+    MSH_TEMPLATE,
+    PID_TEMPLATE,
+    PD1_TEMPLATE,
+    ORC_TEMPLATE,
+    RXA_TEMPLATE,
+    RXR_TEMPLATE,
+    OBX_TEMPLATE,
+)
+
+_template_registry = {}
+_template_lock = threading.Lock()
+
 
 def loadFileTemplate(fileName):
     with open(TEMPLATE_BASE + "/" + fileName, "r") as file:
         return file.read()
 
 
+# turns a string.Template into a str.format_map render function. Placeholders become
+# format fields and literal braces are doubled, so rendering is a single C-level call
+# with the same KeyError on a missing value that Template.substitute raises
+def compileTemplate(template_name, template_string):
+    format_parts = []
+    position = 0
+    for match in Template.pattern.finditer(template_string):
+        literal = template_string[position : match.start()]
+        format_parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        position = match.end()
+        if match.group("escaped") is not None:
+            format_parts.append("$")
+            continue
+        key = match.group("named") or match.group("braced")
+        if key is None:
+            line_number = template_string.count("\n", 0, match.start()) + 1
+            raise ValueError(
+                f"Invalid placeholder in template {template_name} on line {line_number}"
+            )
+        format_parts.append("{" + key + "}")
+    literal = template_string[position:]
+    format_parts.append(literal.replace("{", "{{").replace("}", "}}"))
+    return "".join(format_parts).format_map
+
+
+def loadTemplateRegistry(template_names=MESSAGE_TEMPLATES):
+    registry = dict()
+    for template_name in template_names:
+        registry[template_name] = compileTemplate(
+            template_name, loadFileTemplate(template_name)
+        )
+    return registry
+
+
+# explicit reload hook for when the files under TEMPLATE_BASE change
+def reloadTemplates():
+    global _template_registry
+    with _template_lock:
+        _template_registry = loadTemplateRegistry(
+            set(MESSAGE_TEMPLATES) | set(_template_registry)
+        )
+
+
+def getTemplateRenderer(template_name):
+    global _template_registry
+    renderer = _template_registry.get(template_name)
+    if renderer is None:
+        with _template_lock:
+            if not _template_registry:
+                _template_registry = loadTemplateRegistry()
+            renderer = _template_registry.get(template_name)
+            if renderer is None:
+                registry = dict(_template_registry)
+                registry.update(loadTemplateRegistry([template_name]))
+                _template_registry = registry
+                renderer = registry[template_name]
+    return renderer
+
+
 def imprintTemplate(template_name, value_dict):
-    sectionTemplate = loadFileTemplate(template_name)
-    hl7Section = Template(sectionTemplate).substitute(value_dict)
-    return hl7Section
+    return getTemplateRenderer(template_name)(value_dict)
+
+
+ADMINISTERED_FORMAT = "%Y-%m-%dT%H:%MZ"
+
+
+# Values that are the same for every row of a run: the cutoff after which a parsed date
+# is taken to be in the previous century, and the RXA report date
+class RunContext:
+    __slots__ = ("century_cutoff", "report_date")
+
+    def __init__(self, now=None):
+        now = now or datetime.now()
+        self.century_cutoff = now + relativedelta(years=1)
+        self.report_date = now.strftime("%Y%m%d")
+
+
+_run_context = None
+
+
+# computes the run-level values once; the handler calls this at the start of each run
+def startRun(now=None):
+    global _run_context
+    _run_context = RunContext(now)
+    return _run_context
+
+
+def currentRunContext():
+    if _run_context is None:
+        return startRun()
+    return _run_context
+
+
+# One input row as a plain tuple of values. Columns are looked up by name through a
+# column -> position map that is resolved once per frame and shared by all of its rows,
+# so a RowRecord reads like the pandas Series the builders used to get from iloc
+# (a missing column raises KeyError) without building a Series per row.
+class RowRecord:
+    __slots__ = ("values", "fields")
+
+    def __init__(self, values, fields):
+        self.values = values
+        self.fields = fields
+
+    def __getitem__(self, column):
+        return self.values[self.fields[column]]
+
+    def __contains__(self, column):
+        return column in self.fields
+
+    def get(self, column, default=None):
+        position = self.fields.get(column)
+        if position is None:
+            return default
+        return self.values[position]
+
+
+def recordFields(columns):
+    return {column: position for position, column in enumerate(columns)}
+
+
+# every row of a frame as a RowRecord, in frame order and independent of its index
+def rowRecords(input_df):
+    fields = recordFields(input_df.columns)
+    return [
+        RowRecord(values, fields)
+        for values in input_df.itertuples(index=False, name=None)
+    ]
+
+
+# The parse-once view of a row that every createXXXBlock reads from. The administration
+# timestamp, the clinician name split and the lowered product names are worked out once
+# per row instead of once per segment. A value that cannot be worked out keeps its
+# exception, which is raised by the segment that reads it, so failures are still
+# reported against the same segment as before.
+class PreparedRecord:
+    __slots__ = (
+        "row",
+        "run",
+        "_administered_at",
+        "_clinician",
+        "vax_type",
+        "_vax_manufacturer",
+    )
+
+    def __init__(self, row, run=None):
+        self.row = row
+        self.run = run or currentRunContext()
+        # parsed on first use; rows with normalized date columns never need it
+        self._administered_at = None
+        try:
+            professional = row["Medical Professional"]
+            space = professional.find(" ")
+            self._clinician = (
+                hl7StringRead(professional[:space].replace(" ", "")),
+                hl7StringRead(professional[space:].replace(" ", "")),
+            )
+        except Exception as ex:
+            self._clinician = ex
+        try:
+            self.vax_type = hl7StringRead(row["Appointment Service Name"]).lower()
+        except Exception:
+            self.vax_type = ""
+        try:
+            self._vax_manufacturer = hl7StringRead(row["Manufacturer"]).lower()
+        except Exception as ex:
+            self._vax_manufacturer = ex
+
+    def __getitem__(self, column):
+        return self.row[column]
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    @property
+    def administered_at(self):
+        if self._administered_at is None:
+            try:
+                self._administered_at = datetime.strptime(
+                    self.row["Vaccine Administered Date/Time"], ADMINISTERED_FORMAT
+                )
+            except Exception as ex:
+                self._administered_at = ex
+        return self._value(self._administered_at)
+
+    # (first, last) of the "Medical Professional" column
+    @property
+    def clinician(self):
+        return self._value(self._clinician)
+
+    @property
+    def vax_manufacturer(self):
+        return self._value(self._vax_manufacturer)
+
+
+def prepareRecord(dataRow, run=None):
+    if isinstance(dataRow, PreparedRecord):
+        return dataRow
+    return PreparedRecord(dataRow, run)
+
+
+# returns the hl7_* column normalize_utils.normalizeFrame added for this row, or
+# compute() when the row was not normalized or the vectorised pass left it undecided
+def normalizedValue(dataRow, column, compute):
+    try:
+        value = dataRow[column]
+    except KeyError:
+        value = None
+    if isinstance(value, str):
+        return value
+    return compute()
+
+
+# the {"code", "description"} pair from the <prefix>_code/_description columns, falling
+# back to compute() like normalizedValue
+def normalizedCode(dataRow, prefix, compute):
+    code = normalizedValue(dataRow, prefix + "_code", lambda: None)
+    description = normalizedValue(dataRow, prefix + "_description", lambda: None)
+    if code is None or description is None:
+        return compute()
+    return {"code": code, "description": description}
+
+
+# moves a parsed date that lands past the run's cutoff back one century
+def pastCentury(timestamp, run):
+    if timestamp >= run.century_cutoff:
+        return timestamp.replace(year=timestamp.year - 100)
+    return timestamp
+
+
+# builds the seven segments of one message. Returns (message, None), or (None,
+# (segment name, error text)) for the first segment that could not be generated. It has
+# no side effects so it can run in a worker process, see parallel_utils
+def buildHL7Message(dataRow, control_number, message_timestamp=None, run=None):
+    dataRow = prepareRecord(dataRow, run)
+    if message_timestamp is None:
+        message_timestamp = datetime.now().strftime("%Y%m%d%H%M%S") + "+0000"
+    msh_dict = dict()
+    msh_dict["message_time_stamp"] = message_timestamp
+    msh_dict["message_control_id"] = control_number
+
+    segment_builders = [
+        ("MSH", lambda: createMSHBlock(msh_dict)),
+        ("PID", lambda: createPIDBlock(dataRow)),
+        ("PD1", lambda: createPD1Block(dataRow)),
+        ("ORC", lambda: createORCBlock(dataRow, control_number)),
+        ("RXA", lambda: createRXABlock(dataRow)),
+        ("RXR", lambda: createRXRBlock(dataRow)),
+        ("OBX", lambda: createOBXBlock(dataRow)),
+    ]
+    timing = sampleSegments()
+    hl7_document = []
+    for segment_name, build_segment in segment_builders:
+        started = time.perf_counter_ns() if timing else 0
+        try:
+            hl7_document.append(build_segment())
+        except Exception as ex:
+            return None, (segment_name, str(ex))
+        finally:
+            # builder timings from generation worker processes stay in the worker
+            if timing:
+                observe("segment." + segment_name, time.perf_counter_ns() - started)
+    return "".join(hl7_document), None
 
 
 # Generates a message header block by imprinting values from the data frame into a string
@@ -34,10 +314,9 @@ def createMSHBlock(msh_dict):
 # Generates a common order block by imprinting values from the data frame into a string
 # template that is loaded from the file system
 def createORCBlock(dataRow, control_number):
+    dataRow = prepareRecord(dataRow)
     orc_dict = dict()
-    space = dataRow["Medical Professional"].find(" ")
-    first = dataRow["Medical Professional"][:space].replace(" ","")
-    last = dataRow["Medical Professional"][space:].replace(" ","")
+    first, last = dataRow.clinician
 
     orc_dict["order_number"] = hl7StringRead(dataRow["Patient ID"])
     if len(orc_dict["order_number"]) > 20:
@@ -48,8 +327,8 @@ def createORCBlock(dataRow, control_number):
     orc_dict["provider_first_name"] = "JUNE"
     orc_dict["provider_phone_number"] = "385^3756419"
     orc_dict["checkedinby"] = dataRow["Patient Checked in By"]
-    orc_dict["clinician_first"] = hl7StringRead(first)
-    orc_dict["clinician_last"] = hl7StringRead(last)
+    orc_dict["clinician_first"] = first
+    orc_dict["clinician_last"] = last
 
     return imprintTemplate(ORC_TEMPLATE, orc_dict)
 
@@ -57,7 +336,7 @@ def createORCBlock(dataRow, control_number):
 # Generates a patient identification block by imprinting values from the data frame into a string
 # template that is loaded from the file system
 def createPIDBlock(dataRow):
-
+    dataRow = prepareRecord(dataRow)
     pid_dict = dict()
     pid_dict["patient_mrn"] = hl7StringRead(dataRow["Patient ID"])
     if len(pid_dict["patient_mrn"]) > 20:
@@ -68,29 +347,40 @@ def createPIDBlock(dataRow):
     pid_dict["patient_first"] = hl7StringRead(dataRow["First Name"])
     pid_dict["patient_mi"] = hl7StringRead(dataRow["Middle Initial"])
 
-    date_time_string = dataRow["Date of Birth"]
-    timestamp = datetime.strptime(date_time_string, "%Y-%m-%d")
-    future = datetime.today() + relativedelta(years=1)
-    if timestamp >= future:
-        timestamp = timestamp.replace(year=timestamp.year - 100)
-    pid_dict["patient_dob"] = timestamp.strftime("%Y%m%d")
+    pid_dict["patient_dob"] = normalizedValue(
+        dataRow,
+        "hl7_dob",
+        lambda: pastCentury(
+            datetime.strptime(dataRow["Date of Birth"], "%Y-%m-%d"), dataRow.run
+        ).strftime("%Y%m%d"),
+    )
 
     # pid_dict["patient_dob"] = convertStringDateToHL7(hl7StringRead(dataRow["Date of Birth"]))
-    pid_dict["patient_gender"] = convertPatientGender(dataRow["Gender"])
-    pid_dict["patient_race"] = convertPatientRace(dataRow["Race"])
+    pid_dict["patient_gender"] = normalizedValue(
+        dataRow, "hl7_gender", lambda: convertPatientGender(dataRow["Gender"])
+    )
+    pid_dict["patient_race"] = normalizedValue(
+        dataRow, "hl7_race", lambda: convertPatientRace(dataRow["Race"])
+    )
 
     pid_dict["patient_address_1"] = dataRow["Street Address"]
     pid_dict["patient_address_2"] = ""
     pid_dict["patient_address_city"] = hl7StringRead(dataRow["City"])
-    pid_dict["patient_address_state"] = findStateAbbreviation(dataRow["State"])
+    pid_dict["patient_address_state"] = normalizedValue(
+        dataRow, "hl7_state", lambda: findStateAbbreviation(dataRow["State"])
+    )
     pid_dict["patient_address_zip"] = dataRow["Zip Code"]
 
     # TODO - find and cast the phone number into an HL7 compliant format
-    pid_dict["patient_phone"] = convertPhoneNumberToHL7(
-        hl7StringRead(dataRow["Phone Number"])
+    pid_dict["patient_phone"] = normalizedValue(
+        dataRow,
+        "hl7_phone",
+        lambda: convertPhoneNumberToHL7(hl7StringRead(dataRow["Phone Number"])),
     )
     # pid_dict["patient_ethinicity"] = "U"
-    pid_dict["patient_ethinicity"] = convertPatientEthnicity(dataRow["Ethnicity"])
+    pid_dict["patient_ethinicity"] = normalizedValue(
+        dataRow, "hl7_ethnicity", lambda: convertPatientEthnicity(dataRow["Ethnicity"])
+    )
 
     return imprintTemplate(PID_TEMPLATE, pid_dict)
 
@@ -98,115 +388,39 @@ def createPIDBlock(dataRow):
 # Generates a vaccination block by imprinting values from the data frame into a string
 # template that is loaded from the file system
 def createRXABlock(dataRow):
+    dataRow = prepareRecord(dataRow)
     rxa_dict = dict()
-    # null out the clinical data block in case we have a bad / blank row in the data
-    rxa_dict["cvx_code"] = "999"
-    rxa_dict["cvx_description"] = "UNDEFINED"
-    rxa_dict["vis_description"] = "UNDEFINED"
-    rxa_dict["vax_manufacturer"] = "UNDEFINED"
-    rxa_dict["mfg_code"] = "UNK"
-
-    vax_type = ""
-    try:
-        vax_type = hl7StringRead(dataRow["Appointment Service Name"])
-    except Exception:
-        pass
-    vax_manufacturer = hl7StringRead(dataRow["Manufacturer"])
-
+    # the CVX code, manufacturer and VIS text come from the product rule table, see
+    # product_rules.json; rows that match no rule get the UNDEFINED / 999 entry
+    vax_manufacturer = dataRow.vax_manufacturer
     age = int(dataRow["Age"])
-    if (
-        VACCINE_TYPE_PFIZER.lower() in vax_type.lower()
-        or VACCINE_TYPE_PFR.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_PFIZER.lower() in vax_manufacturer.lower()
-    ) and age in range(5, 12):
-        rxa_dict["cvx_code"] = "218"
-        rxa_dict[
-            "cvx_description"
-        ] = "COVID-19, mRNA, LNP-S, PF, 10 mcg/0.2 mL dose, tris-sucrose"
-        rxa_dict["vis_description"] = "COVID-19 Pfizer Vaccine"
-        rxa_dict["vax_manufacturer"] = "Pfizer"
-        rxa_dict["mfg_code"] = "PFR"
-    elif (
-        VACCINE_TYPE_PFIZER.lower() in vax_type.lower()
-        or VACCINE_TYPE_PFR.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_PFIZER.lower() in vax_manufacturer.lower()
-    ):
-        rxa_dict["cvx_code"] = "208"
-        rxa_dict["cvx_description"] = "COVID-19, mRNA, LNP-S, PF, 30 mcg/0.3 mL dose"
-        rxa_dict["vis_description"] = "COVID-19 Pfizer Vaccine"
-        rxa_dict["vax_manufacturer"] = "Pfizer"
-        rxa_dict["mfg_code"] = "PFR"
-    elif (
-        VACCINE_TYPE_MODERNA.lower() in vax_type.lower()
-        or VACCINE_TYPE_MOD.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_MODERNA.lower() in vax_manufacturer.lower()
-    ):
-        rxa_dict["cvx_code"] = "207"
-        rxa_dict["cvx_description"] = "COVID-19, mRNA, LNP-S, PF, 100 mcg/0.5 mL dose"
-        rxa_dict["vis_description"] = "COVID-19 Moderna Vaccine"
-        rxa_dict["vax_manufacturer"] = "Moderna"
-        rxa_dict["mfg_code"] = "MOD"
-    elif (
-        VACCINE_TYPE_OXFORD.lower() in vax_type.lower()
-        or VACCINE_TYPE_ASZ.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_OXFORD.lower() in vax_manufacturer.lower()
-    ):
-        rxa_dict["cvx_code"] = "210"
-        rxa_dict[
-            "cvx_description"
-        ] = "COVID-19 vaccine, vector-nr, rS-ChAdOx1, PF, 0.5 mL"
-        rxa_dict["vis_description"] = "COVID-19 AstraZeneca Vaccine"
-        rxa_dict["vax_manufacturer"] = "AstraZeneca"
-        rxa_dict["mfg_code"] = "ASZ"
-    elif (
-        VACCINE_TYPE_JANSSEN.lower() in vax_type.lower()
-        or VACCINE_TYPE_JNJ.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_JOHNSON.lower() in vax_manufacturer.lower()
-        or VACCINE_TYPE_JANSSEN.lower() in vax_manufacturer.lower()
-    ):
-        rxa_dict["cvx_code"] = "212"
-        rxa_dict["cvx_description"] = "COVID-19 vaccine, vector-nr, rS-Ad26, PF, 0.5 mL"
-        rxa_dict["vis_description"] = "COVID-19 Janssen Vaccine"
-        rxa_dict["vax_manufacturer"] = "Janssen"
-        rxa_dict["mfg_code"] = "JSN"
-    elif INFLUENZA_TYPE_Afluria.lower() in vax_manufacturer.lower():
-        rxa_dict["cvx_code"] = "158"
-        rxa_dict["cvx_description"] = "Influenza vaccine, 5 mL"
-        rxa_dict["vis_description"] = "Influenza-19 Afluria Quadrivalent Vaccine"
-        rxa_dict["vax_manufacturer"] = "Afluria Quadrivalent"
-        rxa_dict["mfg_code"] = "SEQ"
-    elif INFLUENZA_TYPE_Fluad.lower() in vax_manufacturer.lower():
-        rxa_dict["cvx_code"] = "205"
-        rxa_dict["cvx_description"] = "Influenza vaccine, 0.5 mL"
-        rxa_dict["vis_description"] = "Influenza-19 Fluad Quadrivalent Vaccine"
-        rxa_dict["vax_manufacturer"] = "Fluad Quadrivalent"
-        rxa_dict["mfg_code"] = "SEQ"
-    elif(VACCINE_TYPE_JYNNEOS.lower() in vax_manufacturer.lower()):
-        rxa_dict["cvx_code"] = "206"
-        rxa_dict["cvx_description"] = "Vaccinia, smallpox monkeypox vaccine live, PF"
-        rxa_dict["vis_description"] = "Monkey Pox JYNNEOS Vaccine"
-        rxa_dict["vax_manufacturer"] = "JYNNEOS"
-        rxa_dict["mfg_code"] = "BN"
-
-
-    space = dataRow["Medical Professional"].find(" ")
-    first = dataRow["Medical Professional"][:space].replace(" ","")
-    last = dataRow["Medical Professional"][space:].replace(" ","")
-    rxa_dict["lot_number"] = findVaccineLot(dataRow["Lot"])
-    rxa_dict["lot_exiration_date"] = convertStringDateToHL7(dataRow["Expiration"])
-    date_time_string = dataRow["Vaccine Administered Date/Time"]
-    timestamp = datetime.strptime(date_time_string, "%Y-%m-%dT%H:%MZ")
-    future = datetime.today() + relativedelta(years=1)
-    if timestamp >= future:
-        timestamp = timestamp.replace(year=timestamp.year - 100)
-    rxa_dict["procedure_date"] = timestamp.strftime("%Y%m%d%H%M%S")
+    rxa_dict.update(classifyProduct(dataRow.vax_type, vax_manufacturer, age))
+
+    first, last = dataRow.clinician
+    rxa_dict["lot_number"] = normalizedValue(
+        dataRow, "hl7_lot", lambda: findVaccineLot(dataRow["Lot"])
+    )
+    rxa_dict["lot_exiration_date"] = normalizedValue(
+        dataRow,
+        "hl7_expiration",
+        lambda: convertStringDateToHL7(
+            dataRow["Expiration"], dataRow.run.century_cutoff
+        ),
+    )
+    rxa_dict["procedure_date"] = normalizedValue(
+        dataRow,
+        "hl7_procedure_date",
+        lambda: pastCentury(dataRow.administered_at, dataRow.run).strftime(
+            "%Y%m%d%H%M%S"
+        ),
+    )
     # rxa_dict["procedure_date"] = convertStringDateTimeToHL7(dataRow["Vaccine Administered Date/Time"])
-    rxa_dict["clinician_first"] = hl7StringRead(first)
-    rxa_dict["clinician_last"] = hl7StringRead(last)
+    rxa_dict["clinician_first"] = first
+    rxa_dict["clinician_last"] = last
     rxa_dict["location"] = ""
     # rxa_dict["location"] = hl7StringRead(dataRow["Appointment Location Name"])
 
-    rxa_dict["report_date"] = datetime.now().strftime("%Y%m%d")
+    rxa_dict["report_date"] = dataRow.run.report_date
 
     return imprintTemplate(RXA_TEMPLATE, rxa_dict)
 
@@ -216,8 +430,12 @@ def createRXABlock(dataRow):
 def createRXRBlock(dataRow):
     rxr_dict = dict()
 
-    injection_route = getAdministration(dataRow["Injection Route"])
-    injection_site = getBodySite(dataRow["Administration Site"])
+    injection_route = normalizedCode(
+        dataRow, "hl7_route", lambda: getAdministration(dataRow["Injection Route"])
+    )
+    injection_site = normalizedCode(
+        dataRow, "hl7_site", lambda: getBodySite(dataRow["Administration Site"])
+    )
 
     rxr_dict["admin_code"] = injection_route["code"]
     rxr_dict["admin_decription"] = injection_route["description"]
@@ -230,23 +448,29 @@ def createRXRBlock(dataRow):
 # Generates an ethinicity block by imprinting values from the data frame into a string
 # template that is loaded from the file system
 def createPD1Block(dataRow):
+    dataRow = prepareRecord(dataRow)
     pd1_dict = dict()
-    date_time_string = dataRow["Vaccine Administered Date/Time"]
-    timestamp = datetime.strptime(date_time_string, "%Y-%m-%dT%H:%MZ")
-    pd1_dict["Protection_Indicator"] = timestamp.strftime("%Y%m%d")
+    pd1_dict["Protection_Indicator"] = normalizedValue(
+        dataRow,
+        "hl7_administered_date",
+        lambda: dataRow.administered_at.strftime("%Y%m%d"),
+    )
     return imprintTemplate(PD1_TEMPLATE, pd1_dict)
 
 
 # Generates three observation segments by impriting values from the data frame into a string
 # template that is loaded from the file system
 def createOBXBlock(dataRow):
+    dataRow = prepareRecord(dataRow)
     obx_dict = dict()
 
-    date_time_string = dataRow["Vaccine Administered Date/Time"]
-    timestamp = datetime.strptime(date_time_string, "%Y-%m-%dT%H:%MZ")
     # timestamp = datetime.strptime(date_time_string, '%m/%d/%Y %H:%M')
     # future = datetime.today() + relativedelta(years=1)
     # if timestamp >= future:
     #    timestamp = timestamp.replace(year=timestamp.year - 100)
-    obx_dict["vaccination_date"] = timestamp.strftime("%Y%m%d")
+    obx_dict["vaccination_date"] = normalizedValue(
+        dataRow,
+        "hl7_administered_date",
+        lambda: dataRow.administered_at.strftime("%Y%m%d"),
+    )
     return imprintTemplate(OBX_TEMPLATE, obx_dict)
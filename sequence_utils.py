@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import random
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from aws_utils import conditionalPut, isConditionConflict, isMissingKey
+from metrics_utils import count
+
+SEQUENCE_PREFIX = "texas-vax/sequences/"
+HL7_SEQUENCE = "hl7-files"
+CONTROL_NUMBER_PREFIX = "7501"
+DEFAULT_BLOCK_SIZE = 1000
+MAX_RESERVE_ATTEMPTS = 20
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# how many numbers a run takes from the counter at a time (SEQUENCE_BLOCK_SIZE)
+def sequenceBlockSize():
+    return max(1, int(os.environ.get("SEQUENCE_BLOCK_SIZE", DEFAULT_BLOCK_SIZE)))
+
+
+# The MSH-10 control ID and ORC filler order number of the message with file index
+# index. Indices come from the counter below and are never handed out twice, so
+# neither are control numbers
+def controlNumber(index):
+    return CONTROL_NUMBER_PREFIX + str(index)
+
+
+# A counter kept in one small S3 object, {"next": N}, shared by every invocation that
+# numbers HL7 files. reserve() reads it and writes it back advanced with a conditional
+# PUT on the ETag it read, so when two runs race one of them gets 412 and reads again;
+# the numbers a reservation returns are never returned to anybody else. Runs take
+# blocks of numbers at a time (see pipeline_utils.FileSequence), so the counter is
+# touched once per block rather than once per message.
+class SequenceCounter:
+    def __init__(self, s3, bucket, name=HL7_SEQUENCE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = SEQUENCE_PREFIX + name + ".json"
+
+    # (next number, ETag), or (0, None) before the first reservation
+    def read(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except Exception as ex:
+            if isMissingKey(self.s3, ex):
+                return 0, None
+            raise
+        return json.loads(response["Body"].read())["next"], response["ETag"]
+
+    # returns the first of size consecutive numbers
+    def reserve(self, size):
+        for attempt in range(MAX_RESERVE_ATTEMPTS):
+            first, etag = self.read()
+            body = json.dumps(
+                {"next": first + size, "updated_at": datetime.utcnow().isoformat()}
+            ).encode("utf-8")
+            # the first reservation creates the object, which only one run can do
+            conditions = {"if_match": etag} if etag else {"if_none_match": "*"}
+            try:
+                conditionalPut(self.s3, self.bucket, self.key, body, **conditions)
+            except Exception as ex:
+                if not isConditionConflict(ex):
+                    raise
+                count("sequence.conflicts")
+                time.sleep(random.uniform(0, min(1.0, 0.05 * 2**attempt)))
+                continue
+            count("sequence.reservations")
+            logger.info(f"Reserved {size} numbers from {first} in {self.key}")
+            return first
+        raise RuntimeError(
+            f"Could not reserve numbers from {self.key} after {MAX_RESERVE_ATTEMPTS} attempts"
+        )
@@ -0,0 +1,174 @@
+import os
+import socket
+import threading
+from aws_lambda_powertools import Logger
+from lazy_utils import lazyImport
+from metrics_utils import timed, count
+
+paramiko = lazyImport("paramiko")
+
+SFTP_HOST = "immtrac-ftps1.dshs.state.tx.us"
+SFTP_PORT = 22
+SFTP_DROPOFF_DIR = "/users/NOMIHEALTV/hl7-dropoff/"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# errors that mean the session underneath us is gone and is worth one reconnect; a
+# function so that importing this module does not import paramiko. SFTP status errors
+# (no such file, permission denied) are OSErrors too but leave the session usable, so
+# a bare OSError only counts once the transport is down, see isConnectionError
+def connectionErrors():
+    return (paramiko.SSHException, EOFError, socket.timeout, ConnectionError)
+
+
+# a rejected login, which retrying with the same credentials will not fix
+def isAuthenticationError(ex):
+    return isinstance(ex, paramiko.AuthenticationException)
+
+
+# Owns a single SSH transport to the ImmTrac SFTP server and hands out SFTP channels
+# opened on it, one per thread. The transport is opened lazily on the first transfer,
+# health checked before every use and rebuilt transparently when the session drops.
+class SFTPConnectionManager:
+    def __init__(self, credentials, hostname=SFTP_HOST, port=SFTP_PORT):
+        # credentials is a callable returning (username, password); if it also has an
+        # invalidate() method a rejected login refetches the secret and retries once
+        self.credentials = credentials
+        self.hostname = hostname
+        self.port = port
+        self._client = None
+        self._lock = threading.Lock()
+        self._channels = threading.local()
+        self._generation = 0
+
+    def is_active(self):
+        if self._client is None:
+            return False
+        transport = self._client.get_transport()
+        return (
+            transport is not None
+            and transport.is_active()
+            and transport.is_authenticated()
+        )
+
+    def _connect(self):
+        with timed("sftp.connect"):
+            try:
+                self._login()
+            except paramiko.AuthenticationException:
+                if not hasattr(self.credentials, "invalidate"):
+                    raise
+                logger.info("SFTP authentication failed, refreshing credentials.")
+                self.credentials.invalidate()
+                self._login()
+        self._generation += 1
+        logger.info("Connection established.")
+
+    def _login(self):
+        username, password = self.credentials()
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(
+                hostname=self.hostname,
+                port=self.port,
+                username=username,
+                password=password,
+                look_for_keys=False,
+            )
+        except Exception:
+            ssh.close()
+            raise
+        ssh.get_transport().set_keepalive(30)
+        self._client = ssh
+
+    def _ensure_connected(self):
+        with self._lock:
+            if not self.is_active():
+                self._close_client()
+                self._connect()
+            return self._client, self._generation
+
+    # returns this thread's SFTP channel, reopening it if the transport was rebuilt
+    def get_sftp(self):
+        return self._channel(*self._ensure_connected())
+
+    def _channel(self, client, generation):
+        channels = self._channels
+        sftp = getattr(channels, "sftp", None)
+        if sftp is None or channels.generation != generation:
+            sftp = client.open_sftp()
+            channels.sftp = sftp
+            channels.generation = generation
+        return sftp
+
+    # a closed channel or transport shows up as a bare OSError ("Socket is closed")
+    def isConnectionError(self, ex, sftp=None):
+        if isinstance(ex, connectionErrors()):
+            return True
+        if not isinstance(ex, OSError):
+            return False
+        return not self.is_active() or (sftp is not None and sftp.get_channel().closed)
+
+    # a rejected login is not a dropped session, and an SFTP status error is the
+    # server's answer for this file, so both are raised without a retry
+    def putfo(self, fileobj, remote_path):
+        generation = sftp = None
+        try:
+            client, generation = self._ensure_connected()
+            sftp = self._channel(client, generation)
+            return sftp.putfo(fileobj, remote_path)
+        except Exception as ex:
+            if isAuthenticationError(ex) or not self.isConnectionError(ex, sftp):
+                raise
+            logger.info(f"SFTP session dropped, reconnecting. {ex}")
+            count("sftp.reconnects")
+            if generation is not None:
+                self._recover(generation)
+            fileobj.seek(0)
+            return self.get_sftp().putfo(fileobj, remote_path)
+
+    # the transport is shared by every thread, so it is only rebuilt once it is down;
+    # while it is still up only this thread's channel is dropped and reopened
+    def _recover(self, generation):
+        if not self.is_active():
+            self.reset(generation)
+            return
+        sftp = getattr(self._channels, "sftp", None)
+        self._channels.sftp = None
+        if sftp is not None:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    # Drops the current transport so the next transfer opens a fresh one. With
+    # generation, only if that transport is still the current one: another thread may
+    # already have replaced it, and closing the new one would fail its transfers too
+    def reset(self, generation=None):
+        with self._lock:
+            if generation is None or generation == self._generation:
+                self._close_client()
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._close_client()
+                logger.info("Connection closed.")
+
+    # keeps the session open across warm invocations when SFTP_KEEP_WARM is set,
+    # otherwise closes it at the end of the handler
+    def release(self):
+        if os.environ.get("SFTP_KEEP_WARM", "").lower() in ("1", "true", "yes"):
+            return
+        self.close()
+
+    def _close_client(self):
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+        self._client = None
+        self._channels = threading.local()
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+LOCAL_BUCKET = "local"
+INPUT_PREFIX = "texas-vax/input/"
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class PreconditionFailed(Exception):
+    response = {"Error": {"Code": "PreconditionFailed"}}
+
+
+# An S3 bucket kept in a directory, with the calls the handler makes (ranged and
+# conditional GETs and PUTs included). Objects are written to a temporary file and
+# renamed under a lock on the bucket, so the worker processes of a run can share one
+# bucket
+class LocalS3:
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _read(self, bucket, key):
+        try:
+            with open(self._path(bucket, key), "rb") as stored:
+                return stored.read()
+        except FileNotFoundError:
+            raise NoSuchKey(key)
+
+    @contextmanager
+    def _locked(self, bucket):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, bucket + ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._locked(Bucket):
+            if IfMatch is not None or IfNoneMatch is not None:
+                try:
+                    current = localETag(self._read(Bucket, Key))
+                except NoSuchKey:
+                    current = None
+                if IfNoneMatch == "*" and current is not None:
+                    raise PreconditionFailed(Key)
+                if IfMatch is not None and IfMatch != current:
+                    raise PreconditionFailed(Key)
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(descriptor, "wb") as stored:
+                stored.write(Body)
+            os.replace(temporary, path)
+        return {"ETag": localETag(Body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self._read(Bucket, Key)
+        return {"ETag": localETag(data), "ContentLength": len(data)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        data = self._read(Bucket, Key)
+        etag = localETag(data)
+        if IfMatch is not None and IfMatch != etag:
+            raise PreconditionFailed(Key)
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": BytesIO(data), "ETag": etag, "ContentLength": len(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete["Objects"]:
+            self.delete_object(Bucket, item["Key"])
+
+    def listKeys(self, bucket, prefix=""):
+        base = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, names in os.walk(base):
+            for name in names:
+                if name.startswith("tmp"):
+                    continue
+                relative = os.path.relpath(os.path.join(directory, name), base)
+                key = relative.replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def get_paginator(self, operation):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=""):
+                keys = s3.listKeys(Bucket, Prefix)
+                yield {"Contents": [{"Key": key} for key in keys]}
+
+        return Paginator()
+
+
+def localETag(data):
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+# stands in for boto3 in aws_utils, so every client the handler creates is the bucket
+class LocalAws:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def client(self, service, region_name=None, config=None):
+        if service != "s3":
+            raise ValueError(f"{service} is not available locally")
+        return self.s3
+
+
+class LocalContext:
+    invoked_function_arn = "local"
+    function_name = "texasHL7sftp-local"
+
+
+# Runs one invocation in this process: S3 goes to the bucket under work_dir, SFTP
+# uploads to work_dir/sftp, and the events the handler would send to other invocations
+# (shard workers, checkpoint continuations) are collected and written to out_path
+# with the handler's result
+def invoke(work_dir, event_path, out_path):
+    import aws_utils
+    import checkpoint_utils
+    import shard_utils
+
+    s3 = LocalS3(os.path.join(work_dir, "s3"))
+    aws_utils.boto3 = LocalAws(s3)
+    events = []
+    checkpoint_utils.invokeSelf = lambda context, event: events.append(event)
+    shard_utils.dispatchShard = lambda context, event: events.append(event)
+
+    import TexasHL7
+
+    sftp_dir = os.path.join(work_dir, "sftp")
+    os.makedirs(sftp_dir, exist_ok=True)
+
+    def putfo(fileobj, remote_path):
+        data = fileobj.read()
+        path = os.path.join(sftp_dir, os.path.basename(remote_path))
+        if os.path.exists(path):
+            raise FileExistsError(f"{remote_path} was already uploaded")
+        with open(path, "w" if isinstance(data, str) else "wb") as uploaded:
+            uploaded.write(data)
+
+    TexasHL7.sftp_connection.putfo = putfo
+    with open(event_path) as event_file:
+        event = json.load(event_file)
+    result = TexasHL7.lambda_handler(event, LocalContext())
+    with open(out_path, "w") as out_file:
+        json.dump({"result": result, "events": events}, out_file)
+
+
+# Drives a whole sharded run on this machine: puts the CSV in a local bucket, invokes the
+# handler for it (the coordinator), then every event it fans out (shard workers, and
+# their continuations) in subprocesses, up to workers at a time, until none are left.
+# Returns the result of every invocation in the order they finished
+def runLocal(csv_path, work_dir, workers=4, env=None):
+    s3 = LocalS3(os.path.join(work_dir, "s3"))
+    object_key = INPUT_PREFIX + os.path.basename(csv_path)
+    with open(csv_path, "rb") as csv_file:
+        s3.put_object(LOCAL_BUCKET, object_key, csv_file.read())
+
+    child_env = dict(os.environ, BUCKET_NAME=LOCAL_BUCKET, **(env or {}))
+    child_env.setdefault("AWS_REGION", "us-east-1")
+    child_env.setdefault("SHARD_MIN_BYTES", "1")
+    events_dir = os.path.join(work_dir, "events")
+    os.makedirs(events_dir, exist_ok=True)
+    counter = iter(range(1 << 30))
+
+    def run(event):
+        number = next(counter)
+        event_path = os.path.join(events_dir, f"{number:05d}.json")
+        out_path = os.path.join(events_dir, f"{number:05d}.out.json")
+        with open(event_path, "w") as event_file:
+            json.dump(event, event_file)
+        command = [sys.executable, os.path.abspath(__file__), "invoke"]
+        subprocess.run(
+            command + [work_dir, event_path, out_path],
+            env=child_env,
+            check=True,
+        )
+        with open(out_path) as out_file:
+            return json.load(out_file)
+
+    results = []
+    pending = [{"Records": [{"s3": {"object": {"key": object_key}}}]}]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending:
+            outputs = list(executor.map(run, pending))
+            pending = [event for output in outputs for event in output["events"]]
+            results.extend(output["result"] for output in outputs)
+    return results
+
+
+# python shard_runner.py <csv> [--work-dir DIR] [--shard-bytes N] [--workers N]
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "invoke":
+        invoke(*sys.argv[2:])
+        sys.exit(0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv")
+    parser.add_argument("--work-dir", default=None)
+    parser.add_argument("--shard-bytes", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="shards-"))
+    env = dict()
+    if args.shard_bytes:
+        env["SHARD_BYTES"] = str(args.shard_bytes)
+    results = runLocal(args.csv, work_dir, args.workers, env)
+    for result in results:
+        print(json.dumps(result))
+    print(f"uploaded files in {os.path.join(work_dir, 'sftp')}")
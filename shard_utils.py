@@ -0,0 +1,331 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+from datetime import datetime
+from aws_lambda_powertools import Logger
+from aws_utils import awsClient, conditionalPut, isConditionConflict, isMissingKey
+from checkpoint_utils import invokeSelf
+from ledger_utils import (
+    listLedgerKeys,
+    ledgerPartitionPrefix,
+    mergeLedgerParts,
+    newPartName,
+)
+from sequence_utils import SequenceCounter
+
+SHARD_PREFIX = "texas-vax/shards/"
+SHARD_EVENT_KEY = "shard"
+FINISH_EVENT_KEY = "finish"
+DEFAULT_SHARD_BYTES = 64 * 1024 * 1024
+# how much is fetched at a time when looking for the end of a line
+PROBE_BYTES = 64 * 1024
+# a finisher lock older than this belongs to an invocation that died (Lambda's limit is
+# 15 minutes) and is taken over
+FINISH_LOCK_SECONDS = 15 * 60
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# files of at least SHARD_MIN_BYTES are split into shards of about SHARD_BYTES and fanned
+# out to one invocation per shard; 0 (the default) never shards
+def shardMinBytes():
+    return int(os.environ.get("SHARD_MIN_BYTES", 0))
+
+
+def shardBytes():
+    return max(PROBE_BYTES, int(os.environ.get("SHARD_BYTES", DEFAULT_SHARD_BYTES)))
+
+
+def shouldShard(content_length):
+    minimum = shardMinBytes()
+    return minimum > 0 and content_length >= minimum
+
+
+# one id per version of an input object, used to name its manifest and ledger parts
+def exportId(object_key, etag):
+    return hashlib.sha1(f"{object_key}\x1f{etag}".encode("utf-8")).hexdigest()[:16]
+
+
+def exportPrefix(export_id):
+    return f"{SHARD_PREFIX}{export_id}/"
+
+
+def manifestKey(export_id):
+    return exportPrefix(export_id) + "manifest.json"
+
+
+def shardDoneKey(export_id, shard_number):
+    return f"{exportPrefix(export_id)}done/shard-{shard_number:04d}.json"
+
+
+def finishLockKey(export_id):
+    return exportPrefix(export_id) + "finishing.json"
+
+
+def shardPartKind(export_id, shard_number):
+    return f"shard-{export_id}-{shard_number:04d}"
+
+
+def getRange(s3, bucket, key, etag, start, end):
+    return s3.get_object(
+        Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", IfMatch=etag
+    )["Body"].read()
+
+
+# the offset just past the first newline at or after position, or size if there is none
+def lineStartAfter(s3, bucket, key, etag, size, position):
+    while position < size:
+        end = min(size, position + PROBE_BYTES)
+        data = getRange(s3, bucket, key, etag, position, end)
+        newline = data.find(b"\n")
+        if newline >= 0:
+            return position + newline + 1
+        position = end
+    return size
+
+
+# Splits an object into shards that start and end on line boundaries, using ranged GETs
+# around each nominal boundary instead of reading the object. Every shard gets a block
+# of file indices at least as large as the number of rows it can hold (a row is at least
+# one byte per column, commas and newline included), so the indices, and the control
+# numbers built from them, never overlap between shards. Short rows (fewer fields than
+# the header, or blank lines) can hold more rows than that; such a shard fails when it
+# runs out of indices instead of using the next shard's. Quoted fields spanning lines
+# are not supported: a boundary could fall inside one.
+def planShards(s3, bucket, object_key, etag, size, shard_bytes=None):
+    shard_bytes = shard_bytes or shardBytes()
+    header_end = lineStartAfter(s3, bucket, object_key, etag, size, 0)
+    header = getRange(s3, bucket, object_key, etag, 0, header_end)
+    columns = max(1, header.count(b",") + 1)
+
+    boundaries = [header_end]
+    target = header_end + shard_bytes
+    while target < size:
+        boundary = lineStartAfter(s3, bucket, object_key, etag, size, target - 1)
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+        target = max(target, boundary) + shard_bytes
+    boundaries.append(size)
+
+    shards = []
+    index_base = 0
+    for start, end in zip(boundaries, boundaries[1:]):
+        if end <= start:
+            continue
+        index_stride = -(-(end - start) // columns) + 1
+        shards.append(
+            {
+                "shard": len(shards),
+                "start": start,
+                "end": end,
+                "index_base": index_base,
+                "index_stride": index_stride,
+            }
+        )
+        index_base += index_stride
+    return {
+        "export_id": exportId(object_key, etag),
+        "object_key": object_key,
+        "etag": etag,
+        "size": size,
+        "header": header.decode("utf-8"),
+        "day": datetime.today().strftime("%Y-%m-%d"),
+        "created_at": datetime.utcnow().isoformat(),
+        "shards": shards,
+    }
+
+
+def writeManifest(s3, bucket, manifest):
+    key = manifestKey(manifest["export_id"])
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+    return key
+
+
+def loadManifest(s3, bucket, key):
+    return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+
+def shardEvent(manifest_key, shard_number):
+    return {SHARD_EVENT_KEY: {"manifest_key": manifest_key, "shard": shard_number}}
+
+
+# re-runs the finisher of an export, e.g. after a failed shard has been re-run
+def finishEvent(manifest_key):
+    return {FINISH_EVENT_KEY: {"manifest_key": manifest_key}}
+
+
+# how a shard event reaches its worker; replaced by the local runner
+def dispatchShard(context, event):
+    invokeSelf(context, event)
+
+
+# Coordinator: plans the shards of an object, reserves their blocks of file indices
+# from the bucket's counter (see sequence_utils), so they never overlap with any other
+# run's, writes the manifest and fans out one worker invocation per shard. Returns the
+# manifest
+def coordinate(s3, bucket, object_key, etag, size, context):
+    manifest = planShards(s3, bucket, object_key, etag, size)
+    shards = manifest["shards"]
+    first = SequenceCounter(s3, bucket).reserve(
+        sum(shard["index_stride"] for shard in shards)
+    )
+    for shard in shards:
+        shard["index_base"] += first
+    key = writeManifest(s3, bucket, manifest)
+    for shard in manifest["shards"]:
+        dispatchShard(context, shardEvent(key, shard["shard"]))
+    logger.info(f"Split {object_key} into {len(manifest['shards'])} shards, see {key}")
+    return manifest
+
+
+# The body of one shard as a raw binary stream: the header line followed by the shard's
+# bytes, streamed from a ranged GET, so it reads like a whole (smaller) CSV. A real
+# io stream rather than an object with read(), which pandas 1.1 does not take as a file
+class ShardBody(io.RawIOBase):
+    def __init__(self, header, stream):
+        super().__init__()
+        self._header = header
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._header:
+            data = self._header[: len(buffer)]
+            self._header = self._header[len(data) :]
+        else:
+            data = self._stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+# a get_object-like response for one shard
+def openShard(s3, bucket, manifest, shard_number):
+    shard = manifest["shards"][shard_number]
+    header = manifest["header"].encode("utf-8")
+    response = s3.get_object(
+        Bucket=bucket,
+        Key=manifest["object_key"],
+        Range=f"bytes={shard['start']}-{shard['end'] - 1}",
+        IfMatch=manifest["etag"],
+    )
+    return {
+        "Body": io.BufferedReader(ShardBody(header, response["Body"])),
+        "ContentLength": len(header) + shard["end"] - shard["start"],
+        "ETag": manifest["etag"],
+    }
+
+
+def markShardDone(s3, bucket, manifest, shard_number, result):
+    s3.put_object(
+        Bucket=bucket,
+        Key=shardDoneKey(manifest["export_id"], shard_number),
+        Body=json.dumps(result).encode("utf-8"),
+    )
+
+
+def shardResults(s3, bucket, manifest):
+    results = []
+    paginator = s3.get_paginator("list_objects_v2")
+    prefix = exportPrefix(manifest["export_id"]) + "done/"
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read()
+            results.append(json.loads(body))
+    return results
+
+
+def allShardsDone(s3, bucket, manifest):
+    return len(shardResults(s3, bucket, manifest)) >= len(manifest["shards"])
+
+
+# Takes the export's finisher lock, a small object created with a conditional PUT, so
+# two finishers never merge the same shard parts twice. Returns False while another
+# finisher holds it; a lock older than FINISH_LOCK_SECONDS is taken over
+def acquireFinishLock(s3, bucket, export_id):
+    key = finishLockKey(export_id)
+    body = json.dumps({"started_at": time.time()}).encode("utf-8")
+    try:
+        conditionalPut(s3, bucket, key, body, if_none_match="*")
+        return True
+    except Exception as ex:
+        if not isConditionConflict(ex):
+            raise
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except Exception as ex:
+        if isMissingKey(s3, ex):
+            return acquireFinishLock(s3, bucket, export_id)
+        raise
+    started_at = json.loads(response["Body"].read())["started_at"]
+    if time.time() - started_at < FINISH_LOCK_SECONDS:
+        return False
+    try:
+        conditionalPut(s3, bucket, key, body, if_match=response["ETag"])
+        return True
+    except Exception as ex:
+        if not isConditionConflict(ex):
+            raise
+        return False
+
+
+# Finisher: merges the ledger parts the shards wrote into an export part of its own
+# (bodies sidecar included) and writes result.json next to the manifest. Safe to run
+# more than once, e.g. after a failed shard has been re-run: each run merges only the
+# shard parts still there into a new export part, so the rows earlier runs merged stay
+# where they are. Returns None without merging while another finisher is running
+def finishExport(s3, bucket, manifest):
+    export_id = manifest["export_id"]
+    if not acquireFinishLock(s3, bucket, export_id):
+        logger.info(f"Another finisher is merging export {export_id}, leaving it")
+        return None
+    try:
+        return mergeExport(s3, bucket, manifest)
+    finally:
+        s3.delete_object(Bucket=bucket, Key=finishLockKey(export_id))
+
+
+def mergeExport(s3, bucket, manifest):
+    export_id = manifest["export_id"]
+    prefix = ledgerPartitionPrefix(manifest["day"])
+    shard_parts = [
+        key
+        for key in listLedgerKeys(s3, bucket, prefix)
+        if key[len(prefix) :].startswith(f"shard-{export_id}-")
+    ]
+    merged = mergeLedgerParts(
+        s3, bucket, shard_parts, prefix + newPartName(f"export-{export_id}"), minimum=1
+    )
+    results = sorted(shardResults(s3, bucket, manifest), key=lambda r: r["shard"])
+    summary = {
+        "export_id": export_id,
+        "object_key": manifest["object_key"],
+        "shards": len(manifest["shards"]),
+        "finished_shards": len(results),
+        "failed_shards": [r["shard"] for r in results if r["status"] == "failed"],
+        "rows": sum(r["rows"] for r in results),
+        "failed_rows": sum(r["failed_rows"] for r in results),
+        "merged_ledger_rows": merged,
+        "finished_at": datetime.utcnow().isoformat(),
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=exportPrefix(export_id) + "result.json",
+        Body=json.dumps(summary).encode("utf-8"),
+    )
+    logger.info(f"Finished export {export_id}: {summary}")
+    return summary
+
+
+# python shard_utils.py finish <bucket> <manifest key>, for an export whose last shard
+# never reported back
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "finish":
+        print("usage: python shard_utils.py finish <bucket> <manifest key>")
+        sys.exit(2)
+    s3 = awsClient("s3")
+    print(json.dumps(finishExport(s3, sys.argv[2], loadManifest(s3, *sys.argv[2:]))))
@@ -0,0 +1,230 @@
+import os
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+from aws_lambda_powertools import Logger
+from aws_utils import awsClient
+from credential_utils import CachedCredentialProvider
+from sftp_utils import SFTPConnectionManager, SFTP_DROPOFF_DIR, SFTP_PORT
+from metrics_utils import timed, count
+from archive_utils import BundleWriter, archiveSettings, ARCHIVE_PREFIX
+
+HL7_ARCHIVE_PREFIX = "texas-hl7-messages/"
+
+logger = Logger(service="texasHL7sftp", child=True)
+
+
+# Somewhere an HL7 file is delivered to. Each sink is one stage of the delivery
+# pipeline (see pipeline_utils), run on workers threads; write() gets the delivery with
+# its document already encoded, so every sink of a run sends the same bytes. A sink with
+# a batch gets lists of deliveries instead (see StagedPipeline.addStage). The sink
+# keeps totals of what it wrote for the run's summary
+class Sink:
+    name = "sink"
+    batch = None
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.deliveries = 0
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, delivery):
+        self.write(delivery)
+        with self._lock:
+            self.deliveries += 1
+            self.messages += len(delivery.records)
+            self.bytes += len(delivery.document)
+
+    def write(self, delivery):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def summary(self):
+        with self._lock:
+            return {
+                "sink": self.name,
+                "target": self.target(),
+                "deliveries": self.deliveries,
+                "messages": self.messages,
+                "bytes": self.bytes,
+            }
+
+    def target(self):
+        return None
+
+
+# archives each file under prefix in an S3 bucket
+class S3Sink(Sink):
+    name = "s3"
+
+    def __init__(self, s3, bucket, prefix=HL7_ARCHIVE_PREFIX, workers=1):
+        super().__init__(workers)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def write(self, delivery):
+        with timed("s3.archive"):
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self.prefix + delivery.file_name,
+                Body=delivery.document,
+            )
+        logger.info("Write to HL7 successful")
+
+    def target(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+
+# archives the files of a run in compressed bundles with an offset index under prefix
+# (see archive_utils.BundleWriter), so a run makes a few PUTs rather than one per file.
+# Deliveries come in batches of up to HL7_ARCHIVE_BATCH_FILES, ended early by a gap of
+# HL7_ARCHIVE_LINGER seconds between files, and a batch's bundles are written before
+# any of its files moves on to be uploaded; if they cannot be, the batch fails here
+# like a failed loose archive PUT, and none of its files is uploaded. A batch is held
+# outside the pipeline's bounded queues, so workers times the batch size is how far
+# generation can run ahead of the uploads, and how much later each file is uploaded
+class S3BundleSink(Sink):
+    name = "archive"
+
+    def __init__(self, s3, bucket, prefix=ARCHIVE_PREFIX, workers=1, settings=None):
+        super().__init__(workers)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.settings = settings or archiveSettings()
+        self.batch = (max(1, self.settings["batch_files"]), self.settings["linger"])
+
+    def __call__(self, deliveries):
+        self.write(deliveries)
+        with self._lock:
+            self.deliveries += len(deliveries)
+            self.messages += sum(len(delivery.records) for delivery in deliveries)
+            self.bytes += sum(len(delivery.document) for delivery in deliveries)
+
+    def write(self, deliveries):
+        writer = BundleWriter(self.s3, self.bucket, self.prefix, self.settings)
+        with timed("archive.write"):
+            for delivery in deliveries:
+                writer.add(delivery.file_name, delivery.document)
+            writer.flush()
+
+    def target(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+
+# uploads each file to directory on an SFTP server through an SFTPConnectionManager
+class SFTPSink(Sink):
+    name = "sftp"
+
+    def __init__(self, connection, directory=SFTP_DROPOFF_DIR, workers=1):
+        super().__init__(workers)
+        self.connection = connection
+        self.directory = directory
+
+    def write(self, delivery):
+        with timed("sftp.transfer"):
+            self.connection.putfo(
+                BytesIO(delivery.document), self.directory + delivery.file_name
+            )
+        count("sftp.bytes", len(delivery.document))
+        logger.info("HL7 file transferred.")
+
+    def close(self):
+        self.connection.release()
+
+    def target(self):
+        return (
+            f"sftp://{self.connection.hostname}:{self.connection.port}{self.directory}"
+        )
+
+
+# writes each file into a local directory, e.g. for an offline backfill
+class LocalDirectorySink(Sink):
+    name = "local"
+
+    def __init__(self, directory, workers=1):
+        super().__init__(workers)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, delivery):
+        with timed("local.write"):
+            with open(os.path.join(self.directory, delivery.file_name), "wb") as out:
+                out.write(delivery.document)
+
+    def target(self):
+        return self.directory
+
+
+# writes nothing; the totals and the generation timings are the point, for profiling
+# and for checking an export before sending it
+class DryRunSink(Sink):
+    name = "dry-run"
+
+    def write(self, delivery):
+        pass
+
+
+# (username, password) given on the command line, with the password from SFTP_PASSWORD
+def staticCredentials(username):
+    return lambda: (username, os.environ["SFTP_PASSWORD"])
+
+
+# Builds a sink from a command-line spec:
+#
+#   dir:PATH                        files in a local directory
+#   s3://BUCKET[/PREFIX]            objects under PREFIX (default texas-hl7-messages/)
+#   s3bundle://BUCKET[/PREFIX]      bundles under PREFIX (default texas-hl7-archive/)
+#   sftp                            the ImmTrac drop-off, as the Lambda uploads
+#   sftp://[USER@]HOST[:PORT][/DIR] another SFTP server; the password comes from
+#                                   SFTP_PASSWORD when USER is given, else from the
+#                                   SECRET_NAME secret
+#   dry-run                         count and time only
+#
+# sftp_connection is the connection used for plain "sftp"; workers maps a sink name to
+# its number of worker threads
+def parseSink(spec, sftp_connection=None, region=None, workers=None):
+    workers = workers or dict()
+    if spec == "dry-run":
+        return DryRunSink()
+    if spec.startswith("dir:"):
+        return LocalDirectorySink(spec[len("dir:") :], workers.get("local", 1))
+    if spec == "sftp":
+        return SFTPSink(sftp_connection, workers=workers.get("sftp", 1))
+    url = urlsplit(spec)
+    if url.scheme in ("s3", "s3bundle") and url.netloc:
+        prefix = url.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        if url.scheme == "s3bundle":
+            return S3BundleSink(
+                awsClient("s3", region, path_style=True),
+                url.netloc,
+                prefix or ARCHIVE_PREFIX,
+                workers.get("s3", 1),
+            )
+        return S3Sink(
+            awsClient("s3", region, path_style=True),
+            url.netloc,
+            prefix or HL7_ARCHIVE_PREFIX,
+            workers.get("s3", 1),
+        )
+    if url.scheme == "sftp" and url.hostname:
+        if url.username:
+            credentials = staticCredentials(url.username)
+        else:
+            credentials = CachedCredentialProvider()
+        directory = url.path or "/"
+        if not directory.endswith("/"):
+            directory += "/"
+        return SFTPSink(
+            SFTPConnectionManager(credentials, url.hostname, url.port or SFTP_PORT),
+            directory,
+            workers.get("sftp", 1),
+        )
+    raise ValueError(f"Unknown sink {spec!r}")